@@ -0,0 +1,152 @@
+import os
+import sys
+import threading
+from collections import namedtuple
+from logging import getLogger
+
+from .exception import BadArchiveFile
+from .exception import UnsupportedArchiveFile
+from .reader import Bzip2BlockMap
+from .reader import Bzip2Reader
+from .reader import GzipReader
+from .reader import InflateCheckpoints
+from .reader import XzBlockMap
+from .reader import lzma
+from .reader import xz_index
+from .reader import xz_reader
+from .reader import _gzip_magic
+from .reader import _xz_magic
+
+logger = getLogger(__name__)
+
+CompressedRecord = namedtuple('CompressedRecord', ['filename', 'file_size'])
+
+_bz2_magic = b'BZh'
+
+
+class CompressedFile(object):
+    """
+    A single compressed file (gzip, bzip2 or xz) presented as an archive
+    with a single file entry, named after the file without its final
+    extension.
+
+    The size of the decompressed data is taken from the index for xz,
+    while gzip and bzip2 require a first pass through the data; the
+    trailer of gzip is not used, as it only holds the size of the last
+    member modulo 4 GiB.  The first pass through gzip also produces the
+    checkpoints that allow random access, which can only be kept in
+    memory, so these are produced again by a background thread should
+    the size be found in the index_cache.
+
+    The scan results are persisted to the index_cache if provided.
+    """
+
+    # amount decompressed by the background thread per read, between
+    # checks on whether this was closed.
+    index_chunk = 1 << 20
+
+    def __init__(self, source, index_cache=None):
+        self.source = source
+        self.closed = False
+        self.index_thread = None
+        name = os.path.basename(source.name).rsplit('.', 1)[0]
+
+        stamp = source.stamp
+        if stamp is None:
+            # unable to validate a persisted index.
+            index_cache = None
+        index = None
+        if index_cache is not None:
+            index = index_cache.load(source.name, stamp)
+
+        save = index is None and index_cache is not None
+        head = source.pread(len(_xz_magic), 0)
+        if head.startswith(_gzip_magic):
+            self.stream_reader = GzipReader
+            self.stream_index = InflateCheckpoints()
+            if index is None:
+                index = self._scan_gzip()
+            else:
+                self.index_thread = threading.Thread(target=self._index)
+                self.index_thread.daemon = True
+        elif head.startswith(_bz2_magic):
+            self.stream_reader = Bzip2Reader
+            if index is None:
+                index = self._scan_bz2()
+            self.stream_index = Bzip2BlockMap(
+                [tuple(bounds) for bounds in index['bounds']])
+            for i, size in enumerate(index['sizes']):
+                self.stream_index.set_size(i, size)
+        elif head == _xz_magic:
+            if lzma is None:  # pragma: no cover
+                raise UnsupportedArchiveFile(
+                    'lzma module not available; '
+                    "install with 'pip install backports.lzma'.")
+            self.stream_reader = xz_reader
+            # the index of the stream is always available.
+            self.stream_index = XzBlockMap(xz_index(source, 0, source.size))
+            index = {'size': self.stream_index.size}
+            save = False
+        else:
+            raise BadArchiveFile('unknown compression format')
+
+        if save:
+            index_cache.save(source.name, stamp, index)
+        self.record = CompressedRecord(name, index['size'])
+        if self.index_thread is not None:
+            self.index_thread.start()
+
+    def _scan_bz2(self):
+        # the first pass, in parallel through the reader.
+        reader = Bzip2Reader(self.source, 0, self.source.size, sys.maxsize)
+        while reader.read(self.index_chunk):
+            pass
+        block_map = reader.index
+        return {
+            'size': block_map.offsets[-1],
+            'bounds': block_map.bounds,
+            'sizes': block_map.sizes,
+        }
+
+    def _scan_gzip(self):
+        # the first pass, which also produces the checkpoints.
+        reader = GzipReader(
+            self.source, 0, self.source.size, sys.maxsize,
+            index=self.stream_index)
+        while reader.read(self.index_chunk):
+            pass
+        return {'size': reader.pos}
+
+    def _index(self):
+        reader = GzipReader(
+            self.source, 0, self.source.size, sys.maxsize,
+            index=self.stream_index)
+        try:
+            while not self.closed and reader.read(self.index_chunk):
+                pass
+        except BadArchiveFile as e:
+            logger.warning('failed to index `%s`: %s', self.source.name, e)
+            return
+        if not self.closed and reader.pos != self.record.file_size:
+            logger.warning(
+                '`%s` has %d bytes of decompressed data rather than the %d '
+                'bytes found in the index cache; serving the former',
+                self.source.name, reader.pos, self.record.file_size)
+            self.record = CompressedRecord(self.record.filename, reader.pos)
+
+    def close(self):
+        self.closed = True
+
+    def infolist(self):
+        return [self.record]
+
+    def getinfo(self, name):
+        if name != self.record.filename:
+            raise KeyError(name)
+        return self.record
+
+    def open(self, name):
+        record = self.getinfo(name)
+        return self.stream_reader(
+            self.source, 0, self.source.size, record.file_size,
+            index=self.stream_index)
@@ -1,7 +1,29 @@
+import ctypes
+import io
+import threading
+from collections import OrderedDict
+from logging import getLogger
+
+try:
+    from queue import Empty
+    from queue import Full
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    from Queue import Empty
+    from Queue import Full
+    from Queue import Queue
+
 LIBUNRAR_MISSING = False
 
+# flag of a file header that continues the solid stream of the entries
+# preceding it.
+RHDF_SOLID = 0x10
+
 try:
+    from unrar import constants
+    from unrar import unrarlib
     from unrar.rarfile import RarFile as _RarFile
+    from unrar.rarfile import RarInfo
     from unrar.rarfile import BadRarFile
     UNRAR_SUPPORT = True
 except ImportError:  # pragma: no cover
@@ -11,8 +33,11 @@ except (LookupError, OSError):  # pragma: no cover
     LIBUNRAR_MISSING = True
 
 
+from .exception import BadArchiveFile
 from .exception import UnsupportedArchiveFile
 
+logger = getLogger(__name__)
+
 
 class FakeRarFile(object):
 
@@ -31,12 +56,376 @@ class FakeRarFile(object):
 
 
 if UNRAR_SUPPORT:
+
+    class RarStreamReader(object):
+        """
+        The decompressed data of a file entry in a RAR archive, produced
+        by a worker thread running the extraction through libunrar and
+        handed to the reader as it is produced, rather than buffering
+        the entire entry in memory up front.
+
+        At most max_pending chunks are queued ahead of the reader, after
+        which the extraction waits for them to be consumed.  Seeking
+        forward skips over the data, while seeking backward restarts the
+        extraction from the beginning.
+        """
+
+        max_pending = 16
+        # interval in seconds for the worker to check whether the reader
+        # has been closed while waiting on the queue.
+        poll_interval = 0.1
+
+        def __init__(self, rarfile, info, pwd=None):
+            self.filename = rarfile.filename
+            self.info = info
+            self.pwd = pwd
+            self.file_size = info.file_size
+            self.worker = None
+            self._start()
+
+        def _start(self):
+            self.pos = 0
+            self.chunk = b''
+            self.chunk_pos = 0
+            self.done = False
+            self.queue = Queue(self.max_pending)
+            self.cancelled = threading.Event()
+            self.worker = threading.Thread(
+                target=self._extract, args=(self.queue, self.cancelled))
+            self.worker.daemon = True
+            self.worker.start()
+
+        def _put(self, queue, cancelled, item):
+            while not cancelled.is_set():
+                try:
+                    queue.put(item, timeout=self.poll_interval)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def _extract(self, queue, cancelled):
+            def callback(msg, user_data, p1, p2):
+                if msg in (
+                        constants.UCM_NEEDPASSWORD,
+                        constants.UCM_NEEDPASSWORDW):
+                    state['missing_password'] = True
+                elif msg == constants.UCM_PROCESSDATA:
+                    chunk = ctypes.string_at(p1, p2)
+                    if not self._put(queue, cancelled, chunk):
+                        # abort the extraction.
+                        return -1
+                return 1
+
+            state = {'missing_password': False}
+            result = None
+            try:
+                handle = unrarlib.RAROpenArchiveEx(ctypes.byref(
+                    unrarlib.RAROpenArchiveDataEx(
+                        self.filename, mode=constants.RAR_OM_EXTRACT)))
+            except unrarlib.UnrarException:
+                self._put(queue, cancelled, BadArchiveFile(
+                    'invalid RAR file'))
+                return
+
+            # the reference to the callback must be kept for as long as
+            # the handle may invoke it.
+            c_callback = unrarlib.UNRARCALLBACK(callback)
+            try:
+                if self.pwd is not None:
+                    unrarlib.RARSetPassword(handle, self.pwd.encode('utf8'))
+                unrarlib.RARSetCallback(handle, c_callback, 0)
+                header = unrarlib.RARHeaderDataEx()
+                while True:
+                    unrarlib.RARReadHeaderEx(handle, ctypes.byref(header))
+                    if RarInfo(header=header).filename == self.info.filename:
+                        unrarlib.RARProcessFileW(
+                            handle, constants.RAR_TEST, None, None)
+                        break
+                    unrarlib.RARProcessFileW(
+                        handle, constants.RAR_SKIP, None, None)
+            except unrarlib.ArchiveEnd:
+                result = BadArchiveFile(
+                    'entry %r not found in archive' % self.info.filename)
+            except Exception as e:
+                if state['missing_password']:
+                    result = BadArchiveFile('entry is encrypted')
+                else:
+                    result = BadArchiveFile('bad RAR archive data: %s' % (
+                        str(e) or type(e).__name__))
+            finally:
+                try:
+                    unrarlib.RARCloseArchive(handle)
+                except unrarlib.UnrarException:  # pragma: no cover
+                    pass
+
+            if cancelled.is_set():
+                return
+            if result is not None:
+                logger.warning(
+                    'failed to extract `%s` from `%s`: %s',
+                    self.info.filename, self.filename, result)
+            self._put(queue, cancelled, result)
+
+        def _next_chunk(self):
+            if self.done:
+                return False
+            item = self.queue.get()
+            if item is None:
+                self.done = True
+                return False
+            if isinstance(item, Exception):
+                self.done = True
+                raise item
+            self.chunk = item
+            self.chunk_pos = 0
+            return True
+
+        def read(self, size=-1):
+            if self.worker is None:
+                raise ValueError('I/O operation on closed file.')
+            if size is None or size < 0:
+                size = max(self.file_size - self.pos, 0)
+            results = []
+            while size > 0:
+                if self.chunk_pos >= len(self.chunk):
+                    if not self._next_chunk():
+                        break
+                data = self.chunk[self.chunk_pos:self.chunk_pos + size]
+                self.chunk_pos += len(data)
+                self.pos += len(data)
+                size -= len(data)
+                results.append(data)
+            return b''.join(results)
+
+        def readinto(self, buffer):
+            data = self.read(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
+
+        def seek(self, offset, whence=0):
+            if whence == 1:
+                offset += self.pos
+            elif whence == 2:
+                offset += self.file_size
+            if offset < 0:
+                raise ValueError('negative seek position %d' % offset)
+            if offset < self.pos:
+                self._cancel()
+                self._start()
+            while self.pos < offset:
+                if not self.read(min(offset - self.pos, 1 << 20)):
+                    break
+            return self.pos
+
+        def tell(self):
+            return self.pos
+
+        def _cancel(self):
+            self.cancelled.set()
+            # unblock the worker if it is waiting on a full queue.
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except Empty:
+                pass
+
+        def close(self):
+            if self.worker is not None:
+                self._cancel()
+                self.worker = None
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.close()
+
+    class SolidRarScheduler(object):
+        """
+        Serves the file entries of a solid RAR archive, where producing
+        any entry requires decompressing every entry that precedes it.
+
+        A single worker thread makes a forward pass through the archive,
+        pausing whenever no open is waiting on an entry further ahead.
+        Opens waiting on entries are served in the order of the solid
+        stream, and the pass only restarts from the beginning once none
+        of them remain ahead of it.  Entries produced by the pass are
+        kept in a cache of up to cache_size bytes, evicted on a least
+        recently used basis, such that opening them again (or opening
+        the entries of a directory in turn) costs nothing further.
+        """
+
+        cache_size = 1 << 26
+
+        def __init__(self, rarfile, pwd=None, cache_size=None):
+            self.filename = rarfile.filename
+            self.pwd = pwd
+            if cache_size is not None:
+                self.cache_size = cache_size
+            # the position of every entry within the solid stream.
+            self.order = {}
+            for i, info in enumerate(rarfile.filelist):
+                self.order.setdefault(info.filename, i)
+            self.cache = OrderedDict()
+            self.cache_used = 0
+            # entries waiting on the pass, along with their positions.
+            self.pending = {}
+            # produced entries that are not kept by the cache, for the
+            # opens waiting on them.
+            self.ready = {}
+            self.errors = {}
+            self.cond = threading.Condition()
+            # the position of the next entry to be produced by the pass.
+            self.position = 0
+            # number of passes started, for reporting.
+            self.passes = 0
+            self.closed = False
+            self.worker = None
+
+        def open(self, name):
+            """
+            Return a file object for the named entry, waiting for the
+            pass to produce it if it is not already cached.
+            """
+
+            with self.cond:
+                while True:
+                    if self.closed:
+                        raise ValueError('scheduler is closed')
+                    if name in self.ready:
+                        return io.BytesIO(self.ready.pop(name))
+                    if name in self.cache:
+                        data = self.cache[name] = self.cache.pop(name)
+                        return io.BytesIO(data)
+                    if name in self.errors:
+                        raise self.errors.pop(name)
+                    self.pending[name] = self.order[name]
+                    if self.worker is None:
+                        self.worker = threading.Thread(target=self._run)
+                        self.worker.daemon = True
+                        self.worker.start()
+                    self.cond.notify_all()
+                    self.cond.wait()
+
+        def _keep(self, name, data):
+            if len(data) > self.cache_size:
+                return
+            while self.cache_used + len(data) > self.cache_size:
+                self.cache_used -= len(self.cache.popitem(last=False)[1])
+            self.cache[name] = data
+            self.cache_used += len(data)
+
+        def _wait(self):
+            # wait for an open on an entry ahead of the pass; return
+            # False if the pass has to restart or the scheduler closed.
+            while not self.closed:
+                if any(i >= self.position for i in self.pending.values()):
+                    return True
+                if self.pending:
+                    return False
+                self.cond.wait()
+            return False
+
+        def _run(self):
+            while True:
+                with self.cond:
+                    while not self.pending and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    self.position = 0
+                    self.passes += 1
+                try:
+                    self._pass()
+                except Exception as e:
+                    error = BadArchiveFile('bad RAR archive data: %s' % (
+                        str(e) or type(e).__name__))
+                    logger.warning(
+                        'failed to extract from `%s`: %s', self.filename,
+                        error)
+                    with self.cond:
+                        for name in self.pending:
+                            self.errors[name] = error
+                        self.pending.clear()
+                        self.cond.notify_all()
+
+        def _pass(self):
+            chunks = []
+
+            def callback(msg, user_data, p1, p2):
+                if self.closed:
+                    return -1
+                if msg == constants.UCM_PROCESSDATA and capture[0]:
+                    chunks.append(ctypes.string_at(p1, p2))
+                return 1
+
+            capture = [False]
+            try:
+                handle = unrarlib.RAROpenArchiveEx(ctypes.byref(
+                    unrarlib.RAROpenArchiveDataEx(
+                        self.filename, mode=constants.RAR_OM_EXTRACT)))
+            except unrarlib.UnrarException:
+                raise BadArchiveFile('invalid RAR file')
+
+            c_callback = unrarlib.UNRARCALLBACK(callback)
+            try:
+                if self.pwd is not None:
+                    unrarlib.RARSetPassword(handle, self.pwd.encode('utf8'))
+                unrarlib.RARSetCallback(handle, c_callback, 0)
+                header = unrarlib.RARHeaderDataEx()
+                while True:
+                    with self.cond:
+                        if not self._wait():
+                            return
+                        pending = set(self.pending)
+                    try:
+                        unrarlib.RARReadHeaderEx(handle, ctypes.byref(header))
+                    except unrarlib.ArchiveEnd:
+                        raise BadArchiveFile('unexpected end of archive')
+                    info = RarInfo(header=header)
+                    capture[0] = not info.flag_bits & 0x20 and (
+                        info.filename in pending or
+                        info.file_size <= self.cache_size)
+                    del chunks[:]
+                    # every entry in a solid archive has to be
+                    # decompressed, even the ones that are not needed.
+                    unrarlib.RARProcessFileW(
+                        handle, constants.RAR_TEST, None, None)
+                    with self.cond:
+                        self.position += 1
+                        if capture[0]:
+                            data = b''.join(chunks)
+                            if info.filename in self.pending:
+                                del self.pending[info.filename]
+                                self.ready[info.filename] = data
+                            self._keep(info.filename, data)
+                        self.cond.notify_all()
+            finally:
+                try:
+                    unrarlib.RARCloseArchive(handle)
+                except unrarlib.UnrarException:  # pragma: no cover
+                    pass
+
+        def close(self):
+            with self.cond:
+                self.closed = True
+                self.cache.clear()
+                self.cache_used = 0
+                self.cond.notify_all()
+
     # There are a few things that the RarFile class as implemented (as
     # of unrar-0.3), doesn't quite match up with zipfile implementation,
     # so some modifications are done to its subclass.
 
     class RarFile(_RarFile):
 
+        def __init__(self, *a, **kw):
+            super(RarFile, self).__init__(*a, **kw)
+            self.solid = any(
+                info.flag_bits & RHDF_SOLID for info in self.filelist)
+            self.scheduler = None
+
         def infolist(self):
             """
             Custom infolist implementation that appends a forward slash to
@@ -51,16 +440,29 @@ if UNRAR_SUPPORT:
                     r.filename += '/'
             return results
 
-    # This is done separately to not override future implementations
-    # that may include this.
+        def open(self, member, pwd=None):
+            """
+            Return a file object for the member; entries of a solid
+            archive go through the SolidRarScheduler, while the others
+            are streamed through a RarStreamReader.
+            """
+
+            if isinstance(member, RarInfo):
+                member = member.filename
+            info = self.NameToInfo.get(member)
+            if info is None:
+                raise KeyError(
+                    'There is no item named %r in the archive' % member)
+            if self.solid:
+                if self.scheduler is None:
+                    self.scheduler = SolidRarScheduler(self, self.pwd)
+                return self.scheduler.open(info.filename)
+            return RarStreamReader(self, info, pwd or self.pwd)
 
-    if not hasattr(RarFile, 'close'):
-        # Again, if these lines are not hit in coverage, it means
-        # ``RarFile`` has implemented this.
         def close(self):
-            pass
-
-        RarFile.close = close
+            if self.scheduler is not None:
+                self.scheduler.close()
+                self.scheduler = None
 
 else:  # pragma: no cover
     RarFile = FakeRarFile
@@ -0,0 +1,132 @@
+import sys
+import tarfile
+from collections import namedtuple
+from logging import getLogger
+
+from .exception import BadArchiveFile
+from .exception import UnsupportedArchiveFile
+from .reader import GzipReader
+from .reader import InflateCheckpoints
+from .reader import StoredReader
+from .reader import XzBlockMap
+from .reader import lzma
+from .reader import xz_index
+from .reader import xz_reader
+from .reader import _gzip_magic
+from .reader import _xz_magic
+
+logger = getLogger(__name__)
+
+# The offset is where the data of the file entry begins within the
+# (decompressed) tar stream.
+TarRecord = namedtuple('TarRecord', ['filename', 'file_size', 'offset'])
+
+
+def _normalize(name):
+    while name.startswith('./'):
+        name = name[2:]
+    return name
+
+
+class IndexedTarFile(object):
+    """
+    A tar archive, optionally compressed with gzip or xz, which is scanned
+    once to record the offset of the data for every file entry, such
+    that each entry can be read directly rather than going through
+    all the headers that precede it.
+
+    The source must provide ``pread(size, offset)`` along with its size,
+    name and stamp (e.g. a LocalFile or an EntryView).  If an index_cache is provided, the
+    records produced by the scan are persisted there such that a later
+    mount need not scan the archive again.
+    """
+
+    def __init__(self, source, index_cache=None):
+        self.source = source
+        # the reader for the compressed stream, along with its index
+        # that is shared by every reader of the stream.
+        self.stream_reader = None
+        self.stream_index = None
+        head = source.pread(len(_xz_magic), 0)
+        if head.startswith(_gzip_magic):
+            self.stream_reader = GzipReader
+            self.stream_index = InflateCheckpoints()
+        elif head == _xz_magic:
+            if lzma is None:  # pragma: no cover
+                raise UnsupportedArchiveFile(
+                    'lzma module not available; '
+                    "install with 'pip install backports.lzma'.")
+            self.stream_reader = xz_reader
+            self.stream_index = XzBlockMap(xz_index(source, 0, source.size))
+
+        stamp = source.stamp
+        if stamp is None:
+            # unable to validate a persisted index.
+            index_cache = None
+        index = None
+        if index_cache is not None:
+            index = index_cache.load(source.name, stamp)
+        if index is None:
+            index = self._scan()
+            if index_cache is not None:
+                index_cache.save(source.name, stamp, index)
+
+        if self.stream_index is not None:
+            self.stream_index.size = index['size']
+        self.records = [TarRecord(*record) for record in index['records']]
+        self.lookup = {record.filename: record for record in self.records}
+
+    def _stream(self):
+        if self.stream_reader is None:
+            return StoredReader(
+                self.source, 0, self.source.size, self.source.size)
+        size = self.stream_index.size
+        return self.stream_reader(
+            self.source, 0, self.source.size,
+            sys.maxsize if size is None else size,
+            index=self.stream_index,
+        )
+
+    def _scan(self):
+        stream = self._stream()
+        records = []
+        try:
+            tf = tarfile.open(fileobj=stream, mode='r:')
+            while True:
+                info = tf.next()
+                if info is None:
+                    break
+                # not needed, as the records are kept instead.
+                tf.members = []
+                name = _normalize(info.name)
+                if name in ('', '.'):
+                    continue
+                if info.isdir():
+                    records.append(
+                        (name.rstrip('/') + '/', 0, info.offset_data))
+                elif info.isreg() and not info.issparse():
+                    records.append((name, info.size, info.offset_data))
+                else:
+                    logger.info(
+                        'skipping `%s` as it is not a regular file', name)
+            # continue to the end for the size of the decompressed
+            # stream, which also verifies it.
+            stream.seek(0, 2)
+        except tarfile.TarError as e:
+            raise BadArchiveFile(str(e))
+        return {'size': stream.tell(), 'records': records}
+
+    def close(self):
+        pass
+
+    def infolist(self):
+        return list(self.records)
+
+    def getinfo(self, name):
+        return self.lookup[name]
+
+    def open(self, name):
+        record = self.getinfo(name)
+        source = self._stream() if self.stream_reader else self.source
+        return StoredReader(
+            source, record.offset, record.file_size, record.file_size)
@@ -1,6 +1,21 @@
+import os
 import os.path
+import struct
+import threading
+from bisect import bisect_right
+from collections import namedtuple
+from collections import OrderedDict
+from errno import EINVAL
+from errno import ENOENT
 
 from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
+try:
+    from zipfile import ZIP_BZIP2
+except ImportError:  # pragma: no cover
+    # python 2 zipfile does not support bzip2.
+    ZIP_BZIP2 = 12
 try:
     from zipfile import BadZipFile
     FileNotFoundError = FileNotFoundError
@@ -9,30 +24,818 @@ except ImportError:  # pragma: no cover
     from zipfile import BadZipfile as BadZipFile
     FileNotFoundError = IOError  # This is raised by zipfile.
 
+try:
+    from http.client import HTTPConnection
+    from http.client import HTTPException
+    from http.client import HTTPSConnection
+    from urllib.parse import urlsplit
+except ImportError:  # pragma: no cover
+    # Assume python 2
+    from httplib import HTTPConnection
+    from httplib import HTTPException
+    from httplib import HTTPSConnection
+    from urlparse import urlsplit
+
+try:
+    from os import pread
+    from os import pwrite
+except ImportError:  # pragma: no cover
+    # Assume python 2, emulate with a seek followed by the operation;
+    # callers are single threaded for the mean time.
+    def pread(fd, size, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+    def pwrite(fd, data, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
 from ._rarfile import RarFile
 from ._rarfile import BadRarFile
+from ._compressed import CompressedFile
+from ._tarfile import IndexedTarFile
 
 from .exception import BadArchiveFile
 from .exception import UnsupportedArchiveFile
+from .reader import Bzip2Reader
+from .reader import InflateCheckpoints
+from .reader import InflateReader
+from .reader import StoredReader
+from .reader import zip_data_offset
 
 
 # Lookup table for archive filename extension to its respective class.
 _archive_lookup = {
     'zip': ZipFile,
     'rar': RarFile,
+    'tar': IndexedTarFile,
+    'tar.gz': IndexedTarFile,
+    'tgz': IndexedTarFile,
+    'tar.xz': IndexedTarFile,
+    'txz': IndexedTarFile,
+    'gz': CompressedFile,
+    'bz2': CompressedFile,
+    'xz': CompressedFile,
 }
 
+# Archive classes that can be constructed with a file object, such that
+# a LocalFile (or another source) can provide the underlying bytes.
+_sourced = (ZipFile, IndexedTarFile, CompressedFile)
+
+# Archive classes that are constructed with a source along with the
+# cache for the indexes they produce.
+_indexed = (IndexedTarFile, CompressedFile)
+
+# Readers for zip file entries that can be read directly from the source
+# without going through zipfile, by compression type.
+_zip_readers = {
+    ZIP_STORED: StoredReader,
+    ZIP_DEFLATED: InflateReader,
+    ZIP_BZIP2: Bzip2Reader,
+}
+
+
+# The access pattern hints for the advise method of sources, passed on
+# to posix_fadvise for local files; None where it is not available
+# (e.g. python 2), which makes advise a no-op.
+FADV_NORMAL = getattr(os, 'POSIX_FADV_NORMAL', None)
+FADV_RANDOM = getattr(os, 'POSIX_FADV_RANDOM', None)
+FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', None)
+FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', None)
+
+
+def file_key(st):
+    """
+    Return the identity of a version of a file from the result of stat
+    on it, which changes as the file is modified or replaced.
+    """
+
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+class _SourceFile(object):
+    # the file object methods for sources, implemented using pread.
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            # as per regular files, which zipfile depends on.
+            raise IOError(EINVAL, 'Invalid argument')
+        self.pos = offset
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size
+        data = self.pread(size, self.pos)
+        self.pos += len(data)
+        return data
+
+
+class LocalFile(_SourceFile):
+    """
+    A read only file object for a local file, read with pread such that
+    reads from multiple threads do not interfere with one another.
+
+    An archive that is truncated or rewritten in place while its entries
+    are being read results in short reads, thus errors for those entries
+    rather than a SIGBUS for the whole process as it would be if the
+    file was memory mapped.  The file is closed when this and all file
+    objects derived from it are released.
+    """
+
+    def __init__(self, path):
+        self.fp = open(path, 'rb', 0)
+        st = os.fstat(self.fp.fileno())
+        self.size = st.st_size
+        self.name = path
+        # identifies the version of the file that was opened.
+        self.stamp = (st.st_mtime, st.st_size)
+        self.pos = 0
+
+    @property
+    def closed(self):
+        return self.fp.closed
+
+    def pread(self, size, offset):
+        """
+        Return up to size bytes starting from offset without affecting
+        the current position.
+        """
+
+        return pread(self.fp.fileno(), size, offset)
+
+    def advise(self, option, offset=0, length=None):
+        """
+        Hint the kernel on the expected access pattern for the range, if
+        supported.
+        """
+
+        if option is None or offset >= self.size:
+            return
+        if length is None:
+            length = self.size - offset
+        os.posix_fadvise(self.fp.fileno(), offset, length, option)
+
+    def close(self):
+        self.fp.close()
+
+
+class EntryView(_SourceFile):
+    """
+    A read only file object over the decompressed data of a file entry,
+    such that it may be used as the source of a nested archive.  Reads
+    go through the reader for the entry, with the most recently read
+    blocks kept as archives tend to read the same regions repeatedly.
+    """
+
+    block_size = 1 << 16
+    max_blocks = 64
+
+    def __init__(self, name, reader, size, stamp=None):
+        self.name = name
+        self.reader = reader
+        self.size = size
+        self.stamp = stamp
+        self.pos = 0
+        self.closed = False
+        # least recently used blocks are at the front.
+        self.blocks = OrderedDict()
+
+    def _block(self, i):
+        data = self.blocks.pop(i, None)
+        if data is None:
+            self.reader.seek(i * self.block_size)
+            data = self.reader.read(self.block_size)
+            while len(self.blocks) >= self.max_blocks:
+                self.blocks.popitem(last=False)
+        self.blocks[i] = data
+        return data
+
+    def pread(self, size, offset):
+        end = min(offset + size, self.size)
+        if offset >= end:
+            return b''
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        data = b''.join(self._block(i) for i in range(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start:start + end - offset]
+
+    def advise(self, option, offset=0, length=None):
+        # read through the reader of the entry.
+        pass
+
+    def close(self):
+        self.closed = True
+        self.blocks.clear()
+        self.reader.close()
+
+
+class _BlockSource(_SourceFile):
+    # sources that are read in blocks through a BlockCache, keyed by
+    # self.key, with every run of missing blocks fetched from the
+    # underlying storage by a single call to self._fetch(size, offset).
+
+    def pread(self, size, offset):
+        """
+        Return up to size bytes starting from offset without affecting
+        the current position.
+        """
+
+        end = min(offset + size, self.size)
+        if offset >= end:
+            return b''
+        block_size = self.block_cache.block_size
+        first = offset // block_size
+        last = (end - 1) // block_size
+        blocks = []
+        i = first
+        while i <= last:
+            data = self.block_cache.get((self.key, i))
+            if data is not None:
+                blocks.append(data)
+                i += 1
+                continue
+            # coalesce the run of missing blocks into a single read.
+            j = i + 1
+            while j <= last and (self.key, j) not in self.block_cache:
+                j += 1
+            raw = self._fetch(
+                min((j - i) * block_size, self.size - i * block_size),
+                i * block_size)
+            for k in range(0, len(raw), block_size):
+                block = raw[k:k + block_size]
+                self.block_cache.put((self.key, i + k // block_size), block)
+                blocks.append(block)
+            if len(raw) < (j - i) * block_size:
+                # the end of the file, or it was truncated.
+                break
+            i = j
+        start = offset - first * block_size
+        return b''.join(blocks)[start:start + end - offset]
+
+
+class CachedFile(_BlockSource):
+    """
+    A read only file object for a local file (e.g. on a network
+    filesystem) that is read through a BlockCache.  Reads are served
+    from the cached blocks where possible, with the runs of blocks that
+    are missing read from the file by a single pread for every run.
+
+    The blocks are keyed by the file_key of the file (its device, inode,
+    size and modification time), such that a modified file is not
+    served from stale blocks.  The file is opened again should it be read from after
+    being closed.
+    """
+
+    def __init__(self, path, block_cache):
+        self.name = path
+        self.block_cache = block_cache
+        self.lock = threading.Lock()
+        self.fd = None
+        st = os.fstat(self._fileno())
+        self.size = st.st_size
+        self.stamp = (st.st_mtime, st.st_size)
+        self.key = file_key(st)
+        self.pos = 0
+
+    def _fileno(self):
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.name, os.O_RDONLY)
+            return self.fd
+
+    def _fetch(self, size, offset):
+        return pread(self._fileno(), size, offset)
+
+    def advise(self, option, offset=0, length=None):
+        """
+        Hint the kernel on the expected access pattern for the range, if
+        supported.
+        """
+
+        if option is None or offset >= self.size:
+            return
+        if length is None:
+            length = self.size - offset
+        os.posix_fadvise(self._fileno(), offset, length, option)
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+def is_url(name):
+    """
+    Check whether name is the URL of a remote archive, rather than a
+    path.
+    """
+
+    return name.split('://', 1)[0].lower() in ('http', 'https')
+
+
+class HttpFile(_BlockSource):
+    """
+    A read only file object for an archive served over HTTP(S), read
+    with range requests through a BlockCache such that only the parts
+    of the archive that are actually read (e.g. the central directory
+    of a zip archive, followed by the file entries as they are opened)
+    are transferred, and at most once while they remain cached.
+
+    A single persistent connection is used for all the requests, which
+    is established again should the server close it.  The blocks are
+    keyed by the URL along with the ETag (or Last-Modified) and the
+    size, and the range requests are conditional on the former such
+    that a modified archive is reported rather than mixed with the
+    cached blocks.  A private block cache of cache_size is used if none
+    is provided.
+    """
+
+    cache_size = 1 << 26
+    timeout = 60
+
+    def __init__(self, url, block_cache=None):
+        if block_cache is None:
+            # cache imports from this module.
+            from .cache import BlockCache
+            block_cache = BlockCache(self.cache_size)
+        parts = urlsplit(url)
+        self.name = url
+        self.block_cache = block_cache
+        self.host = parts.netloc
+        self.target = parts.path or '/'
+        if parts.query:
+            self.target += '?' + parts.query
+        self.connection_class = (
+            HTTPSConnection if parts.scheme.lower() == 'https'
+            else HTTPConnection)
+        self.connection = None
+        self.lock = threading.Lock()
+        self.validator = None
+        self.pos = 0
+
+        # the size, along with whether ranges are supported at all.
+        status, headers, _ = self._request({'Range': 'bytes=0-0'})
+        if status == 416:
+            raise BadArchiveFile('empty file')
+        if status != 206:
+            raise UnsupportedArchiveFile(
+                'is served without support for range requests')
+        content_range = headers.get('content-range', '')
+        try:
+            self.size = int(content_range.rsplit('/', 1)[1])
+        except (IndexError, ValueError):
+            raise UnsupportedArchiveFile(
+                'is served without the size of the archive')
+        self.validator = headers.get('etag') or headers.get('last-modified')
+        # without a validator, modifications cannot be detected.
+        self.stamp = (
+            (self.validator, self.size) if self.validator else None)
+        self.key = (url, self.validator, self.size)
+
+    def _request(self, headers):
+        # return the status, headers and body of a GET request for the
+        # archive, connecting again once should the connection be lost.
+        if self.validator:
+            headers['If-Range'] = self.validator
+        with self.lock:
+            for retry in (False, True):
+                if self.connection is None:
+                    self.connection = self.connection_class(
+                        self.host, timeout=self.timeout)
+                try:
+                    self.connection.request('GET', self.target, headers=headers)
+                    response = self.connection.getresponse()
+                    body = response.read()
+                except (HTTPException, EnvironmentError):
+                    self.connection.close()
+                    self.connection = None
+                    if retry:
+                        raise
+                    continue
+                if response.getheader('connection', '').lower() == 'close':
+                    self.connection.close()
+                    self.connection = None
+                break
+        if response.status == 404:
+            raise FileNotFoundError(ENOENT, 'Not Found', self.name)
+        if response.status not in (200, 206, 416):
+            raise BadArchiveFile(
+                'HTTP %d %s' % (response.status, response.reason))
+        headers = dict(
+            (key.lower(), value) for key, value in response.getheaders())
+        return response.status, headers, body
+
+    def _fetch(self, size, offset):
+        status, _, body = self._request(
+            {'Range': 'bytes=%d-%d' % (offset, offset + size - 1)})
+        if status != 206:
+            # If-Range no longer matches, hence the full file was sent.
+            raise BadArchiveFile('archive was modified on the server')
+        return body
+
+    def advise(self, option, offset=0, length=None):
+        # the blocks are only fetched as they are read.
+        pass
+
+    def close(self):
+        # the connection is established again if read from afterwards.
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+def split_volumes(path):
+    """
+    Return the paths to the volumes of the split zip archive ending
+    with the volume at path (i.e. ``.z01``, ``.z02`` and so on, followed
+    by the ``.zip``), or an empty list if path is not part of one.
+    """
+
+    stem = os.path.splitext(path)[0]
+    volumes = []
+    while True:
+        volume = '%s.z%02d' % (stem, len(volumes) + 1)
+        if not os.path.isfile(volume):
+            break
+        volumes.append(volume)
+    if volumes:
+        volumes.append(path)
+    return volumes
+
+
+class SplitFile(_SourceFile):
+    """
+    A read only file object presenting the volumes of a split zip
+    archive as one concatenated stream, using the offset of every volume
+    within that stream.  The volumes are only opened as reads reach
+    them, with at most max_open of them kept open on a least recently
+    used basis.
+    """
+
+    max_open = 8
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        # the offset of every volume in the stream, followed by the size.
+        self.volume_offsets = [0]
+        mtime = 0
+        for path in self.paths:
+            st = os.stat(path)
+            mtime = max(mtime, st.st_mtime)
+            self.volume_offsets.append(self.volume_offsets[-1] + st.st_size)
+        self.size = self.volume_offsets.pop()
+        self.name = self.paths[-1]
+        self.stamp = (mtime, self.size)
+        self.pos = 0
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _pread_volume(self, i, size, offset):
+        with self.lock:
+            fp = self.files.pop(i, None)
+            if fp is None:
+                fp = open(self.paths[i], 'rb', 0)
+                while len(self.files) >= self.max_open:
+                    self.files.popitem(last=False)[1].close()
+            self.files[i] = fp
+            return pread(fp.fileno(), size, offset)
+
+    def pread(self, size, offset):
+        """
+        Return up to size bytes starting from offset without affecting
+        the current position, reading across the volumes as required.
+        """
+
+        results = []
+        end = min(offset + size, self.size)
+        while offset < end:
+            i = bisect_right(self.volume_offsets, offset) - 1
+            volume_end = (
+                self.volume_offsets[i + 1]
+                if i + 1 < len(self.volume_offsets) else self.size)
+            data = self._pread_volume(
+                i, min(end, volume_end) - offset,
+                offset - self.volume_offsets[i])
+            if not data:
+                break
+            results.append(data)
+            offset += len(data)
+        return b''.join(results)
+
+    def advise(self, option, offset=0, length=None):
+        pass
+
+    def close(self):
+        # volumes are opened again if read from afterwards.
+        with self.lock:
+            while self.files:
+                self.files.popitem()[1].close()
+
+
+def open_local(path):
+    """
+    Return a LocalFile for the path if possible, otherwise return None.
+    """
+
+    try:
+        source = LocalFile(path)
+    except EnvironmentError:
+        # let the archive class deal with the path directly, which may
+        # raise the appropriate error for a missing file.
+        return None
+    if not source.size:
+        # nothing that could be read; as above.
+        source.close()
+        return None
+    return source
+
+
+# Lightweight records of zip file entries from the central directory,
+# using the same attribute names as zipfile.ZipInfo.  The mtime is the
+# raw MS-DOS date (high 16 bits) and time (low 16 bits).
+ZipRecord = namedtuple('ZipRecord', [
+    'filename', 'file_size', 'compress_size', 'compress_type',
+    'header_offset', 'CRC', 'mtime', 'flag_bits'])
+
+_end_record = struct.Struct('<4s4H2LH')
+_end_record_magic = b'PK\005\006'
+_zip64_locator = struct.Struct('<4sLQL')
+_zip64_locator_magic = b'PK\006\007'
+_zip64_end_record = struct.Struct('<4sQ2H2L4Q')
+_zip64_end_record_magic = b'PK\006\006'
+_central_header = struct.Struct('<4s4B4HL2L5H2L')
+_central_header_magic = b'PK\001\002'
+_zip64_extra_id = 0x0001
+_utf8_flag = 0x800
+
+
+def zip_central_directory(source):
+    """
+    Locate the central directory of the zip archive in source, return a
+    tuple of its offset, size, the number of entries within and the
+    number of bytes that precede the archive (e.g. an executable).
+    """
+
+    # the end record is followed by a comment of up to 64 KiB, which is
+    # usually absent, so only the last few KiB are read at first.
+    for length in (1 << 12, _end_record.size + 0xffff):
+        tail_offset = max(0, source.size - length)
+        tail = source.pread(source.size - tail_offset, tail_offset)
+        i = tail.rfind(_end_record_magic)
+        if i != -1 and len(tail) - i >= _end_record.size:
+            break
+        if tail_offset == 0:
+            break
+    if i == -1 or len(tail) - i < _end_record.size:
+        raise BadArchiveFile('end of central directory record not found')
+    end_offset = tail_offset + i
+    (_, disk, cd_disk, _, count, cd_size, cd_offset,
+        _) = _end_record.unpack_from(tail, i)
+    location = end_offset
+
+    locator_offset = end_offset - _zip64_locator.size
+    if locator_offset >= 0:
+        locator = source.pread(_zip64_locator.size, locator_offset)
+        if locator[:4] == _zip64_locator_magic:
+            _, _, end64_offset, disks = _zip64_locator.unpack(locator)
+            # this is relative to the start of the archive, but the
+            # record should be right before the locator.
+            end64_offset = locator_offset - _zip64_end_record.size
+            record = source.pread(_zip64_end_record.size, end64_offset)
+            if record[:4] != _zip64_end_record_magic:
+                raise BadArchiveFile('zip64 end of central directory missing')
+            (_, _, _, _, disk, cd_disk, _, count, cd_size,
+                cd_offset) = _zip64_end_record.unpack(record)
+            location = end64_offset
+
+    if disk or cd_disk:
+        # offsets are relative to the start of the volume they are on.
+        volume_offsets = getattr(source, 'volume_offsets', ())
+        if disk != len(volume_offsets) - 1 or cd_disk > disk:
+            raise BadArchiveFile(
+                'zip archives spanning multiple disks are unsupported '
+                'unless all volumes are present')
+        return volume_offsets[cd_disk] + cd_offset, cd_size, count, 0
+    concat = location - cd_size - cd_offset
+    if concat < 0:
+        raise BadArchiveFile('bad offset for central directory')
+    return cd_offset + concat, cd_size, count, concat
+
+
+def _zip64_extra(extra, file_size, compress_size, header_offset):
+    # replace the values that overflowed with the ones from the zip64
+    # extended information extra field.
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, length = struct.unpack_from('<2H', extra, pos)
+        pos += 4
+        if tag == _zip64_extra_id:
+            values = []
+            for i in range(0, length - length % 8, 8):
+                values.append(struct.unpack_from('<Q', extra, pos + i)[0])
+            values.reverse()
+            if file_size == 0xffffffff and values:
+                file_size = values.pop()
+            if compress_size == 0xffffffff and values:
+                compress_size = values.pop()
+            if header_offset == 0xffffffff and values:
+                header_offset = values.pop()
+            break
+        pos += length
+    return file_size, compress_size, header_offset
+
+
+def _zip_filename(raw, flag_bits):
+    # as per zipfile.
+    filename = raw.decode('utf-8' if flag_bits & _utf8_flag else 'cp437')
+    null = filename.find(u'\x00')
+    if null >= 0:
+        filename = filename[:null]
+    if os.sep != '/' and os.sep in filename:  # pragma: no cover
+        filename = filename.replace(os.sep, '/')
+    return filename
+
+
+def iter_zip_central(source, central, window=1 << 22):
+    """
+    Stream through the central directory (as returned by
+    zip_central_directory) in source, yielding a tuple of the offset to
+    the header and its ZipRecord for every file entry.
+    """
+
+    cd_offset, cd_size, count, concat = central
+    volume_offsets = getattr(source, 'volume_offsets', None)
+    end = cd_offset + cd_size
+    pos = cd_offset
+    buf = b''
+    buf_offset = 0
+    header_size = _central_header.size
+    while pos < end:
+        i = pos - buf_offset
+        if i + header_size > len(buf):
+            buf = source.pread(min(window, end - pos), pos)
+            buf_offset, i = pos, 0
+            if len(buf) < header_size:
+                raise BadArchiveFile('truncated central directory')
+        (magic, _, _, _, _, flag_bits, compress_type, time, date, crc,
+            compress_size, file_size, name_length, extra_length,
+            comment_length, disk, _, _, header_offset,
+        ) = _central_header.unpack_from(buf, i)
+        if magic != _central_header_magic:
+            raise BadArchiveFile('bad magic number for central directory')
+        length = header_size + name_length + extra_length + comment_length
+        if i + length > len(buf):
+            # the variable length parts are not completely in buf.
+            buf = source.pread(max(min(window, end - pos), length), pos)
+            buf_offset, i = pos, 0
+            if len(buf) < length:
+                raise BadArchiveFile('truncated central directory')
+
+        name_start = i + header_size
+        extra_start = name_start + name_length
+        raw_name = buf[name_start:extra_start]
+        if 0xffffffff in (file_size, compress_size, header_offset):
+            file_size, compress_size, header_offset = _zip64_extra(
+                buf[extra_start:extra_start + extra_length],
+                file_size, compress_size, header_offset)
+        if volume_offsets:
+            if disk >= len(volume_offsets):
+                raise BadArchiveFile('bad disk number for file entry')
+            header_offset += volume_offsets[disk]
+
+        yield pos, ZipRecord(
+            _zip_filename(raw_name, flag_bits),
+            file_size,
+            compress_size,
+            compress_type,
+            header_offset + concat,
+            crc,
+            date << 16 | time,
+            flag_bits,
+        )
+        pos += length
+
+
+def archive_type(archive_filename):
+    """
+    Return the extension of the filename that identifies the type of
+    archive, preferring the longest (e.g. ``tar.gz`` over ``gz``).
+    """
+
+    if is_url(archive_filename):
+        archive_filename = urlsplit(archive_filename).path
+    parts = os.path.basename(archive_filename).split('.')
+    for i in range(1, len(parts)):
+        extension = '.'.join(parts[i:])
+        if extension in _archive_lookup:
+            return extension
+    return parts[-1]
+
+
+def is_archive(filename):
+    """
+    Check whether the filename is that of a supported archive.
+    """
+
+    return archive_type(filename) in _archive_lookup
+
 
 class ArchiveFile(object):
     """
     Generic archive file implementation.
+
+    For zip archives that can be read through a source (a LocalFile for
+    local files), file entries are read as ZipRecords directly from the
+    central directory, as it is needed;
+    zipfile is only used for the file entries that cannot be read by
+    the readers provided by this package.
+
+    The volumes of split zip archives (``.z01``, ``.z02`` and so on,
+    alongside the ``.zip``) are read as a single SplitFile.
+
+    Tar archives and single compressed files are indexed on open, with
+    the results persisted to the index_cache if provided (see
+    ``IndexCache``).
+
+    If a block_cache (see ``BlockCache``) is provided, the archive is
+    read through it rather than directly with pread, which is suited to
+    archives on slow or networked storage.  An archive_filename that is
+    an http or https URL is read with range requests as an HttpFile.
+
+    A source (e.g. an EntryView for a nested archive) may be provided
+    instead of reading from the file at archive_filename, for archive
+    classes that support it.
     """
 
-    def __init__(self, archive_filename):
-        archive_type = archive_filename.rsplit('.', 1)[-1]
-        archive_class = _archive_lookup.get(archive_type)
+    def __init__(self, archive_filename, index_cache=None, source=None,
+            block_cache=None):
+        archive_class = _archive_lookup.get(archive_type(archive_filename))
         if archive_class is None:
             raise UnsupportedArchiveFile('unsupported archive format.')
+        if source is not None and archive_class not in _sourced:
+            raise UnsupportedArchiveFile(
+                'unsupported archive format for a nested archive.')
+
+        # indexes produced by readers (e.g. the block maps for bzip2),
+        # by the name of the file entry.
+        self.entry_index = {}
+        self.closed = False
+        self.archive_file = None
+        self.source = None
+        # mapping of filename to the offset of its header within the
+        # central directory, built as required.
+        self.central_offsets = None
+        # location of the central directory, for zip archives that are
+        # read directly.
+        self.central = None
+        if source is None and is_url(archive_filename):
+            if archive_class not in _sourced:
+                raise UnsupportedArchiveFile(
+                    'unsupported archive format for a URL.')
+            source = HttpFile(archive_filename, block_cache)
+        if source is not None:
+            self.source = source
+        elif archive_class is ZipFile and split_volumes(archive_filename):
+            self.source = SplitFile(split_volumes(archive_filename))
+        elif archive_class in _sourced and block_cache is not None:
+            self.source = CachedFile(archive_filename, block_cache)
+        elif archive_class in _sourced:
+            self.source = open_local(archive_filename)
+
+        if archive_class in _indexed:
+            if self.source is None:
+                # raises the appropriate error for a missing file.
+                self.source = LocalFile(archive_filename)
+                if not self.source.size:
+                    self.source.close()
+                    raise BadArchiveFile()
+            self.archive_file = archive_class(
+                self.source, index_cache=index_cache)
+            return
+
+        if self.source:
+            self.central = zip_central_directory(self.source)
+            # accesses will be to individual entries all across the
+            # archive, other than the reading of the central directory.
+            self.source.advise(FADV_RANDOM)
+            return
 
         try:
             self.archive_file = archive_class(archive_filename)
@@ -57,10 +860,109 @@ class ArchiveFile(object):
         self.close()
 
     def close(self):
-        self.archive_file.close()
+        self.closed = True
+        self.central_offsets = None
+        if self.archive_file is not None:
+            self.archive_file.close()
+        if isinstance(self.source, (SplitFile, CachedFile, HttpFile)):
+            self.source.close()
+
+    def _zipfile(self):
+        # for file entries that must be handled by zipfile.
+        if self.archive_file is None:
+            if isinstance(self.source, SplitFile):
+                raise UnsupportedArchiveFile(
+                    'file entry of a split zip archive requires zipfile, '
+                    'which does not support them')
+            self.archive_file = ZipFile(self.source)
+        return self.archive_file
+
+    def _iter_central(self):
+        offset, size, _, _ = self.central
+        self.source.advise(FADV_SEQUENTIAL, offset, size)
+        self.source.advise(FADV_WILLNEED, offset, size)
+        try:
+            for item in iter_zip_central(self.source, self.central):
+                yield item
+        finally:
+            self.source.advise(FADV_RANDOM, offset, size)
+
+    def getinfo(self, name):
+        if self.central is None:
+            return self.archive_file.getinfo(name)
+
+        if self.central_offsets is None:
+            self.central_offsets = {
+                record.filename: offset
+                for offset, record in self._iter_central()
+            }
+        offset = self.central_offsets[name]
+        for _, record in iter_zip_central(self.source, (
+                offset, self.central[0] + self.central[1] - offset,
+                1, self.central[3]), window=512):
+            return record
+
+    def iterinfo(self):
+        """
+        Iterate through the information of every file entry, without
+        holding all of them in memory where possible.
+        """
+
+        if self.central is None:
+            return iter(self.archive_file.infolist())
+        return (record for _, record in self._iter_central())
 
     def infolist(self):
-        return self.archive_file.infolist()
+        return list(self.iterinfo())
+
+    def open_view(self, name, archive_name):
+        """
+        Return an EntryView of the file entry identified by name, to be
+        opened as the nested archive identified by archive_name.
+        """
+
+        info = self.getinfo(name)
+        if self.central is not None and (
+                info.compress_type == ZIP_DEFLATED):
+            # checkpoints for random access, kept with the archive.
+            self.entry_index.setdefault(name, InflateCheckpoints())
+        stamp = getattr(self.source, 'stamp', None)
+        if stamp is not None:
+            stamp = tuple(stamp) + (getattr(info, 'CRC', None),)
+        return EntryView(
+            archive_name, self.open(name, verify=False), info.file_size,
+            stamp)
+
+    def open(self, name, verify=True):
+        """
+        Open the file entry identified by name.  The CRC of the entry is
+        verified once all of it has been read, unless verify is False.
+        """
+
+        if self.central is None:
+            return self.archive_file.open(name)
+
+        info = self.getinfo(name)
+        reader = _zip_readers.get(info.compress_type)
+        if reader is None or info.flag_bits & 0x1:
+            # other compression types and encrypted entries are left to
+            # zipfile.
+            return self._zipfile().open(name)
+
+        data_offset = zip_data_offset(self.source, info.header_offset)
+        length = data_offset - info.header_offset + info.compress_size
+        # hint the data of the entry will be read sequentially.
+        self.source.advise(FADV_SEQUENTIAL, info.header_offset, length)
+        self.source.advise(FADV_WILLNEED, info.header_offset, length)
 
-    def open(self, *a, **kw):
-        return self.archive_file.open(*a, **kw)
+        result = reader(
+            self.source,
+            data_offset,
+            info.compress_size,
+            info.file_size,
+            info.CRC if verify else None,
+            index=self.entry_index.get(name),
+        )
+        if result.index is not None:
+            self.entry_index[name] = result.index
+        return result
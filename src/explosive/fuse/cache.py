@@ -0,0 +1,350 @@
+import os
+import json
+from bisect import bisect_right
+from collections import OrderedDict
+from hashlib import sha1
+from logging import getLogger
+from os.path import exists
+from os.path import join
+from threading import Lock
+
+from .archive import pread
+from .archive import pwrite
+
+logger = getLogger(__name__)
+
+INDEX_FILENAME = 'index.json'
+
+
+class SpillEntry(object):
+    """
+    A file entry that has been fully or partially decompressed into a
+    sparse file inside the spill directory.
+    """
+
+    def __init__(self, name, stamp, size, extents=None):
+        self.name = name
+        self.stamp = list(stamp)
+        self.size = size
+        # sorted, non-overlapping and non-adjacent list of [start, end)
+        # ranges of the decompressed data that have been written.
+        self.extents = extents or []
+        self.fd = None
+        self.refs = 0
+
+    @property
+    def filled(self):
+        return sum(end - start for start, end in self.extents)
+
+    def covers(self, start, end):
+        """
+        Check whether the range from start to end has been written.
+        """
+
+        if start >= end:
+            return True
+        # all ends are bounded by size so this sorts after every extent
+        # that begins at start.
+        i = bisect_right(self.extents, [start, self.size + 1]) - 1
+        return i >= 0 and self.extents[i][1] >= end
+
+    def add(self, start, end):
+        """
+        Mark the range from start to end as written, return the number
+        of bytes that were newly added.
+        """
+
+        before = self.filled
+        merged = []
+        for s, e in self.extents:
+            if e < start or s > end:
+                merged.append([s, e])
+            else:
+                start, end = min(s, start), max(e, end)
+        merged.append([start, end])
+        merged.sort()
+        self.extents = merged
+        return self.filled - before
+
+
+class SpillCache(object):
+    """
+    A size bounded cache of decompressed file entries, stored as sparse
+    files inside a directory (ideally on tmpfs or a local SSD) and read
+    back using pread.
+
+    Entries are keyed by the archive path and the internal filename and
+    validated against a stamp (see ``DefaultMapper.stamp``), such that
+    the contents of the directory can be reused by a later mount once
+    ``close`` has persisted the index.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        # least recently used entries are at the front.
+        self.entries = OrderedDict()
+        self.used = 0
+        if not exists(path):
+            os.makedirs(path)
+        self._load_index()
+
+    @staticmethod
+    def keyname(key):
+        return sha1(u'\0'.join(key).encode('utf8')).hexdigest()
+
+    def _filename(self, name):
+        return join(self.path, name)
+
+    def _load_index(self):
+        index_path = self._filename(INDEX_FILENAME)
+        records = []
+        if exists(index_path):
+            try:
+                with open(index_path) as fd:
+                    records = json.load(fd)
+            except ValueError:
+                logger.warning(
+                    '`%s` is corrupted; discarding spilled entries',
+                    index_path)
+
+        for record in records:
+            if not exists(self._filename(record['name'])):
+                continue
+            entry = SpillEntry(record['name'], record['stamp'],
+                               record['size'], record['extents'])
+            self.entries[entry.name] = entry
+            self.used += entry.filled
+
+        # remove anything that the index does not account for, such as
+        # files left behind by a mount that was not cleanly shut down.
+        for name in os.listdir(self.path):
+            if name != INDEX_FILENAME and name not in self.entries:
+                os.unlink(self._filename(name))
+
+        self._reserve(0)
+        logger.info(
+            'spill cache at `%s` has %d entries using %d bytes',
+            self.path, len(self.entries), self.used)
+
+    def _discard(self, entry):
+        self.entries.pop(entry.name, None)
+        self.used -= entry.filled
+        if entry.fd is not None:
+            os.close(entry.fd)
+            entry.fd = None
+        try:
+            os.unlink(self._filename(entry.name))
+        except OSError:  # pragma: no cover
+            pass
+
+    def _reserve(self, size, keep=None):
+        """
+        Evict the least recently used entries that are not in use until
+        size bytes are available, return whether that succeeded.
+        """
+
+        for entry in list(self.entries.values()):
+            if self.used + size <= self.max_size:
+                break
+            if entry.refs or entry is keep:
+                continue
+            logger.debug('evicting spilled entry %s', entry.name)
+            self._discard(entry)
+        return self.used + size <= self.max_size
+
+    def acquire(self, key, stamp, size):
+        """
+        Return the entry for the key, discarding any previous version
+        that no longer match the stamp and size.  The returned entry
+        must be released when done.
+        """
+
+        name = self.keyname(key)
+        entry = self.entries.pop(name, None)
+        if entry is not None and (
+                entry.stamp != list(stamp) or entry.size != size):
+            if entry.refs:
+                # still being served to another handle; leave it be and
+                # let this handle go without a cache.
+                self.entries[name] = entry
+                return None
+            self._discard(entry)
+            entry = None
+
+        if entry is None:
+            entry = SpillEntry(name, stamp, size)
+        self.entries[name] = entry
+
+        if entry.fd is None:
+            entry.fd = os.open(
+                self._filename(name), os.O_RDWR | os.O_CREAT, 0o600)
+            # extending the file like so keeps it sparse.
+            os.ftruncate(entry.fd, size)
+        entry.refs += 1
+        return entry
+
+    def release(self, entry):
+        entry.refs -= 1
+        if not entry.refs and entry.fd is not None:
+            os.close(entry.fd)
+            entry.fd = None
+
+    def read(self, entry, size, offset):
+        """
+        Read from the entry, return None if any part of the requested
+        range was never written.
+        """
+
+        end = min(offset + size, entry.size)
+        if not entry.covers(offset, end):
+            return None
+        # mark as most recently used.
+        self.entries[entry.name] = self.entries.pop(entry.name)
+        if offset >= end:
+            return b''
+        return pread(entry.fd, end - offset, offset)
+
+    def write(self, entry, offset, data):
+        """
+        Write data that was decompressed for the entry at offset.  This
+        is skipped if space cannot be made for it.
+        """
+
+        end = offset + len(data)
+        if entry.covers(offset, end):
+            return True
+        if not self._reserve(len(data), keep=entry):
+            return False
+        pwrite(entry.fd, data, offset)
+        self.used += entry.add(offset, end)
+        return True
+
+    def sync(self):
+        """
+        Persist the index so that the spilled entries can be reused.
+        """
+
+        index_path = self._filename(INDEX_FILENAME)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as fd:
+            json.dump([{
+                'name': entry.name,
+                'stamp': entry.stamp,
+                'size': entry.size,
+                'extents': entry.extents,
+            } for entry in self.entries.values()], fd)
+        os.rename(tmp_path, index_path)
+
+    def close(self):
+        for entry in self.entries.values():
+            if entry.fd is not None:
+                os.close(entry.fd)
+                entry.fd = None
+            entry.refs = 0
+        self.sync()
+
+
+class IndexCache(object):
+    """
+    A directory of the indexes produced by scanning archives (e.g. the
+    offsets of the file entries inside tar archives), such that a later
+    mount can reuse them rather than scanning the archives again.
+
+    Each index is stored as JSON keyed by the archive path, and is only
+    returned if the stamp of the archive it was produced with matches.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not exists(path):
+            os.makedirs(path)
+
+    def _filename(self, key):
+        return join(self.path, SpillCache.keyname((key,)) + '.json')
+
+    def load(self, key, stamp):
+        """
+        Return the index for the key, or None if it is missing or stale.
+        """
+
+        try:
+            with open(self._filename(key)) as fd:
+                record = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return None
+        if record.get('key') != key or record.get('stamp') != list(stamp):
+            return None
+        return record.get('index')
+
+    def save(self, key, stamp, index):
+        filename = self._filename(key)
+        tmp_path = filename + '.tmp'
+        try:
+            with open(tmp_path, 'w') as fd:
+                json.dump({
+                    'key': key,
+                    'stamp': list(stamp),
+                    'index': index,
+                }, fd)
+            os.rename(tmp_path, filename)
+        except (IOError, OSError) as e:
+            logger.warning('unable to save index for `%s`: %s', key, e)
+
+
+class BlockCache(object):
+    """
+    A size bounded cache of the raw bytes of archive files, in aligned
+    blocks of block_size bytes keyed by the identity of the file (see
+    ``CachedFile``) and the index of the block, evicted on a least
+    recently used basis.  A single instance is meant to be shared by
+    every archive that is read.
+    """
+
+    def __init__(self, max_size, block_size=1 << 18):
+        self.max_size = max_size
+        self.block_size = block_size
+        # least recently used blocks are at the front.
+        self.blocks = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def __contains__(self, key):
+        return key in self.blocks
+
+    def get(self, key):
+        """
+        Return the block for key, or None if it is not cached.
+        """
+
+        with self.lock:
+            data = self.blocks.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self.blocks[key] = data
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_size:
+            return
+        with self.lock:
+            previous = self.blocks.pop(key, None)
+            if previous is not None:
+                self.used -= len(previous)
+            while self.blocks and self.used + len(data) > self.max_size:
+                self.used -= len(self.blocks.popitem(last=False)[1])
+            self.blocks[key] = data
+            self.used += len(data)
+
+    def discard(self, file_key):
+        """
+        Remove every block of the file identified by file_key.
+        """
+
+        with self.lock:
+            for key in [key for key in self.blocks if key[0] == file_key]:
+                self.used -= len(self.blocks.pop(key))
@@ -0,0 +1,188 @@
+import json
+import os
+import socket
+import stat
+import threading
+from collections import OrderedDict
+from errno import ECONNREFUSED
+from errno import ENOENT
+from logging import getLogger
+from os.path import isabs
+
+from .archive import is_url
+
+logger = getLogger(__name__)
+
+
+class ControlServer(object):
+    """
+    A local unix socket at path accepting batches of commands to load or
+    unload archives in the ExplosiveFUSE, one per line as ``load PATH``
+    or ``unload PATH``, with a batch ended by an empty line or the end
+    of the input.
+
+    The archives to be loaded are opened away from the thread serving
+    the filesystem, after which the whole batch is applied as a single
+    change to the mapping (see ``ExplosiveFUSE.apply_changes``), with a
+    line written back for every command in order; either ``ok`` or
+    ``error`` followed by the command, with the reason for the latter,
+    with the results of a batch ended by an empty line.
+
+    A ``stats`` command results in ``ok stats`` followed by the
+    statistics of the ExplosiveFUSE (see ``ExplosiveFUSE.stats``) as a
+    JSON object, once the rest of the batch is applied.
+
+    The socket is only accessible by its owner.
+    """
+
+    def __init__(self, path, fuse):
+        self.path = path
+        self.fuse = fuse
+        self.stopping = False
+        self._remove_stale()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        # only for the owner, as archives may be loaded through it; done
+        # before listening, as connections are refused until then.
+        os.chmod(path, 0o600)
+        self.socket.listen(8)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def _remove_stale(self):
+        # left behind by an instance that was not cleanly stopped, but
+        # do not take over one that is still being served.
+        try:
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                return
+        except OSError:
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except socket.error as e:
+            if e.args[0] in (ECONNREFUSED, ENOENT):
+                os.unlink(self.path)
+        finally:
+            probe.close()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        try:
+            # unblocks the accept.
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _run(self):
+        while not self.stopping:
+            try:
+                conn, _ = self.socket.accept()
+            except socket.error:
+                break
+            try:
+                self._serve(conn)
+            except Exception:
+                logger.exception('failed to serve control connection')
+            finally:
+                conn.close()
+
+    def _serve(self, conn):
+        stream = conn.makefile('rwb')
+        lines = []
+        while True:
+            line = stream.readline()
+            if line.strip():
+                lines.append(line.strip().decode('utf-8', 'surrogateescape'))
+                continue
+            if lines:
+                for result in self.execute(lines):
+                    stream.write(
+                        result.encode('utf-8', 'surrogateescape') + b'\n')
+                stream.write(b'\n')
+                stream.flush()
+                lines = []
+            if not line:
+                break
+
+    def execute(self, lines):
+        """
+        Apply the batch of commands, returning a result for every one.
+        """
+
+        results = [None] * len(lines)
+        commands = []
+        stats = []
+        for i, line in enumerate(lines):
+            op, _, archive_path = line.partition(' ')
+            archive_path = archive_path.strip()
+            if line == 'stats':
+                stats.append(i)
+            elif op not in ('load', 'unload') or not archive_path:
+                results[i] = 'error %s: unknown command' % line
+            elif not (is_url(archive_path) or isabs(archive_path)):
+                results[i] = 'error %s: path must be absolute' % line
+            else:
+                commands.append((i, op, archive_path))
+
+        mapping = self.fuse.mapping
+        errors = {}
+        prepared = {}
+        unloading = set()
+        for i, op, archive_path in commands:
+            if op == 'unload':
+                unloading.add(archive_path)
+            elif archive_path not in prepared and (
+                    archive_path in unloading or
+                    archive_path not in mapping.archives):
+                prepared[archive_path] = mapping.prepare_archive(
+                    archive_path, errors)
+
+        with self.fuse.lock:
+            # the state of every archive as the commands are applied.
+            loaded = OrderedDict()
+            for i, op, archive_path in commands:
+                line = '%s %s' % (op, archive_path)
+                state = loaded.get(
+                    archive_path, archive_path in mapping.archives)
+                if op == 'unload':
+                    if not state:
+                        results[i] = 'error %s: not loaded' % line
+                        continue
+                    loaded[archive_path] = False
+                elif state:
+                    results[i] = 'error %s: already loaded' % line
+                    continue
+                elif prepared.get(archive_path) is None:
+                    results[i] = 'error %s: %s' % (line, errors.get(
+                        archive_path, 'unloaded while being prepared'))
+                    continue
+                else:
+                    loaded[archive_path] = True
+                results[i] = 'ok %s' % line
+
+            changes = []
+            for archive_path, state in loaded.items():
+                result = prepared.pop(archive_path, None) if state else None
+                changes.append((archive_path, result))
+            self.fuse.apply_changes(changes)
+            if stats:
+                result = 'ok stats ' + json.dumps(
+                    self.fuse.stats(), sort_keys=True)
+                for i in stats:
+                    results[i] = result
+
+        # the ones that ended up not being loaded.
+        for result in prepared.values():
+            if result is not None:
+                result[0].close()
+        logger.info('applied %d control command(s)', len(lines))
+        return results
@@ -1,6 +1,7 @@
 import sys
 import logging
 from os.path import abspath
+from os.path import isdir
 from os.path import join
 from os import getcwd
 
@@ -9,11 +10,17 @@ from argparse import ArgumentParser
 from argparse import Action
 from argparse import _StoreAction
 from argparse import HelpFormatter
-from fuse import FUSE
 
 from explosive.fuse import pathmaker
+from explosive.fuse import reader
+from explosive.fuse.cache import BlockCache
+from explosive.fuse.cache import IndexCache
+from explosive.fuse.cache import SpillCache
 from explosive.fuse.fs import ExplosiveFUSE
 from explosive.fuse.fs import ManagedExplosiveFUSE
+from explosive.fuse.fs import PagedFUSE
+
+logger = logging.getLogger(__name__)
 
 
 class _Version(Action):
@@ -31,6 +38,7 @@ class _Version(Action):
             print('explode ?')
         except pkg_resources.DistributionNotFound:  # pragma: no cover
             print('explode ?')
+        print('inflate backend: ' + reader.inflate_backend)
         print(
             'License GPLv3+: GNU GPL version 3 or later '
             '<http://gnu.org/licenses/gpl.html>.\n'
@@ -82,6 +90,62 @@ class _PathmakerChoiceStoreAction(_StoreAction):
             raise ArgumentError(self, e.args[0])
 
 
+_size_units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def _size(value):
+    """
+    Convert a size with an optional K, M, G or T suffix into bytes.
+    """
+
+    value = value.strip().upper()
+    unit = value[-1:] if value[-1:] in _size_units else ''
+    number = value[:len(value) - len(unit)]
+    if not number.isdigit():
+        raise ValueError("invalid size: '%s'" % value)
+    return int(number) * _size_units[unit]
+
+
+# argparse uses this in its error messages.
+_size.__name__ = 'size'
+
+# Defaults for --throughput: the size of the buffer decompressed into
+# ahead of the reads for every open file entry, and the largest reads and
+# readahead requested from the kernel.
+_throughput_read_window = 1 << 22
+_throughput_max_read = 1 << 20
+
+
+_inflate_choices = ['auto'] + [name for name, _ in reader.inflate_backends]
+
+
+def _inflate_choice(args):
+    """
+    Return the value of --inflate within args if any, ahead of parsing
+    all of them.
+    """
+
+    parser = ArgumentParser(add_help=False)
+    parser.add_argument('--inflate', dest='inflate', default=None)
+    return parser.parse_known_args(args)[0].inflate
+
+
+def _fuse_options(parsed_args):
+    """
+    Return the options for FUSE from the parsed arguments.
+    """
+
+    options = {}
+    if parsed_args.throughput:
+        options['max_read'] = _throughput_max_read
+        options['max_readahead'] = _throughput_max_read
+    if parsed_args.max_read:
+        options['max_read'] = parsed_args.max_read
+    if parsed_args.max_readahead:
+        options['max_readahead'] = parsed_args.max_readahead
+    return options
+
+
 def get_argparse():
     layout_choices = sorted(
         i for i in pathmaker.__all__
@@ -136,6 +200,90 @@ def get_argparse():
         '--omit-arcname', dest='include_arcname', action='store_false',
         help='Omit the basename of the origin archive from the generated '
              'paths.')
+    parser.add_argument(
+        '--nested', dest='nested', action='store_true',
+        help='Present archives within the archives as directories, which '
+             'are only read once they are accessed.')
+    parser.add_argument(
+        '--lazy', dest='lazy', action='store_true',
+        help='Only index archives once their directory is first accessed, '
+             'rather than all of them as the filesystem is mounted.  Not '
+             'compatible with --omit-arcname.')
+    parser.add_argument(
+        '--max-entries', dest='max_entries', metavar='N', type=int,
+        default=None,
+        help='Most file entries of archives kept indexed in memory, beyond '
+             'which the least recently accessed archives are dropped back '
+             'to be indexed again on their next access.  Implies --lazy.')
+    parser.add_argument(
+        '--mapped-index', dest='mapped_index', metavar='DIR', default=None,
+        help='Keep the mapping as sorted arrays within a memory mapped '
+             'file created in this directory (and removed once mapped), '
+             'rather than in memory, for archives with tens of millions of '
+             'file entries.  It is merged anew from the sorted entries of '
+             'every archive as archives are loaded or unloaded.  Not compatible with --nested, --lazy or '
+             '--max-entries.')
+    parser.add_argument(
+        '--spill-dir', dest='spill_dir', metavar='DIR', default=None,
+        help='Directory (ideally on tmpfs or a local SSD) where decompressed '
+             'file entries are kept as sparse files, such that random and '
+             'repeated reads do not require decompressing again.  Its '
+             'contents are validated and reused by later mounts.')
+    parser.add_argument(
+        '--spill-size', dest='spill_size', metavar='SIZE', type=_size,
+        default='1G',
+        help='Maximum size of the spill directory, with an optional K, M, '
+             "G or T suffix.  Default is '%(default)s'.")
+    parser.add_argument(
+        '--index-cache', dest='index_cache', metavar='DIR', default=None,
+        help='Directory where the indexes produced by scanning archives '
+             'that lack a central directory (e.g. tar) are kept, such that '
+             'later mounts need not scan them again.')
+    parser.add_argument(
+        '--block-cache', dest='block_cache', metavar='SIZE', type=_size,
+        default=None,
+        help='Read archives through a cache of their raw bytes of up to '
+             'this size (with an optional K, M, G or T suffix) shared by '
+             'all of them, with the small reads coalesced into large '
+             'ones.  Suited to archives on slow or networked storage.')
+    parser.add_argument(
+        '--throughput', dest='throughput', action='store_true',
+        help='Optimize for large sequential reads (e.g. copying files out '
+             'of the mount), by decompressing ahead into a 4M buffer for '
+             'every open file and by requesting reads of up to 1M from the '
+             'kernel.')
+    parser.add_argument(
+        '--max-read', dest='max_read', metavar='SIZE', type=_size,
+        default=None,
+        help='Largest read requested by the kernel, passed to FUSE as the '
+             "'max_read' option.")
+    parser.add_argument(
+        '--max-readahead', dest='max_readahead', metavar='SIZE', type=_size,
+        default=None,
+        help="Largest readahead by the kernel, passed to FUSE as the "
+             "'max_readahead' option.")
+    parser.add_argument(
+        '--inflate', dest='inflate', metavar='BACKEND', default=None,
+        choices=_inflate_choices,
+        help='Implementation used for inflating deflated data, one of '
+             "'auto', '" + "', '".join(
+                 name for name, _ in reader.inflate_backends) + "'.  "
+             'If unspecified, the one named by the %s environment variable '
+             'is used, otherwise the fastest available one.' % (
+                 reader.INFLATE_BACKEND_ENV))
+    parser.add_argument(
+        '--watch', dest='watch_dirs', metavar='DIR', action='append',
+        default=[],
+        help='Keep the archives within this directory loaded as they are '
+             'added, replaced or removed, using inotify.  May be specified '
+             'multiple times, and in place of the archives.')
+    parser.add_argument(
+        '--control-socket', dest='control_socket', metavar='PATH',
+        default=None,
+        help='Create a unix socket at this path, accepting batches of '
+             "'load PATH' and 'unload PATH' commands (one per line, with "
+             'a batch ended by an empty line) that are applied to the '
+             'filesystem at once, with a result written back for each.')
     parser.add_argument(
         '-V', '--version', action='version_verbose',
         help='Print version information and exit.')
@@ -143,7 +291,7 @@ def get_argparse():
         'dir',
         help='The directory to mount the compressed archive(s) to.')
     parser.add_argument(
-        'archives', metavar='archives', nargs='+',
+        'archives', metavar='archives', nargs='*',
         help='The archive(s) to generate directory structures with')
 
     return parser
@@ -155,7 +303,38 @@ def main(args=None):
 
     parser = get_argparse()
 
+    # selected before the arguments are parsed, such that the backend
+    # reported by -V is the one that is used; unknown ones are left to
+    # be reported by the parser.
+    inflate = _inflate_choice(args)
+    if inflate in _inflate_choices:
+        try:
+            reader.set_inflate_backend(inflate)
+        except ValueError as e:
+            parser.error(str(e))
+
     parsed_args = parser.parse_args(args)
+    if not (parsed_args.archives or parsed_args.watch_dirs or
+            parsed_args.control_socket):
+        parser.error(
+            'at least one archive, --watch DIR or --control-socket PATH '
+            'is required')
+    if parsed_args.lazy and not parsed_args.include_arcname:
+        parser.error('--lazy cannot be used with --omit-arcname')
+    if parsed_args.max_entries is not None and not (
+            parsed_args.include_arcname and parsed_args.max_entries > 0):
+        parser.error(
+            '--max-entries must be positive, and cannot be used with '
+            '--omit-arcname')
+    if parsed_args.mapped_index and (
+            parsed_args.nested or parsed_args.lazy or
+            parsed_args.max_entries is not None):
+        parser.error(
+            '--mapped-index cannot be used with --nested, --lazy or '
+            '--max-entries')
+    for watch_dir in parsed_args.watch_dirs:
+        if not isdir(watch_dir):
+            parser.error('--watch: `%s` is not a directory' % watch_dir)
 
     if parsed_args.debug:
         logging.basicConfig(
@@ -163,27 +342,56 @@ def main(args=None):
             format='%(asctime)s %(levelname)s %(name)s %(message)s'
         )
 
+    logger.info('using %s for inflating', reader.inflate_backend)
+
+    spill_cache = None
+    if parsed_args.spill_dir:
+        spill_cache = SpillCache(
+            abspath(parsed_args.spill_dir), parsed_args.spill_size)
+
+    index_cache = None
+    if parsed_args.index_cache:
+        index_cache = IndexCache(abspath(parsed_args.index_cache))
+
+    block_cache = None
+    if parsed_args.block_cache:
+        block_cache = BlockCache(parsed_args.block_cache)
+
+    kwargs = dict(
+        _pathmaker=parsed_args.pathmaker,
+        overwrite=parsed_args.overwrite,
+        include_arcname=parsed_args.include_arcname,
+        spill_cache=spill_cache,
+        index_cache=index_cache,
+        nested=parsed_args.nested,
+        lazy=parsed_args.lazy,
+        max_entries=parsed_args.max_entries,
+        read_window=(
+            _throughput_read_window if parsed_args.throughput else None),
+        block_cache=block_cache,
+        watch_dirs=parsed_args.watch_dirs,
+        control_socket=(
+            abspath(parsed_args.control_socket)
+            if parsed_args.control_socket else None),
+        mapped_index=(
+            abspath(parsed_args.mapped_index)
+            if parsed_args.mapped_index else None),
+    )
+
     if parsed_args.manager:
         mount_root = abspath(join(getcwd(), parsed_args.dir))
         fuse = ManagedExplosiveFUSE(
             mount_root,
             parsed_args.manager_dir,
             parsed_args.archives,
-            _pathmaker=parsed_args.pathmaker,
-            overwrite=parsed_args.overwrite,
-            include_arcname=parsed_args.include_arcname,
+            **kwargs
         )
     else:
-        fuse = ExplosiveFUSE(
-            parsed_args.archives,
-            _pathmaker=parsed_args.pathmaker,
-            overwrite=parsed_args.overwrite,
-            include_arcname=parsed_args.include_arcname,
-        )
+        fuse = ExplosiveFUSE(parsed_args.archives, **kwargs)
 
     try:
-        FUSE(fuse, parsed_args.dir, foreground=parsed_args.foreground,
-             nothreads=True)
+        PagedFUSE(fuse, parsed_args.dir, foreground=parsed_args.foreground,
+                  nothreads=True, **_fuse_options(parsed_args))
     except RuntimeError:
         # assume error messages are properly handled.
         sys.exit(255)
@@ -1,7 +1,12 @@
 import logging
+import threading
+from bisect import bisect_left
+from bisect import insort
+from hashlib import sha1
 from os.path import join
 from os.path import abspath
 from os.path import basename
+from os.path import isfile
 from os import getcwd
 from os import getgid
 from os import getuid
@@ -14,10 +19,21 @@ from stat import S_IFLNK
 from stat import S_IFREG
 from time import time
 
-from fuse import FuseOSError, Operations, LoggingMixIn
+try:
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    # Assume python 2
+    from Queue import Queue
+
+from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 from fuse import ENOTSUP
 
+from explosive.fuse import reader
+from explosive.fuse.archive import is_url
+from explosive.fuse.control import ControlServer
+from explosive.fuse.mapped import MappedMapper
 from explosive.fuse.mapper import DefaultMapper
+from explosive.fuse.watch import DirectoryWatcher
 
 logger = logging.getLogger(__name__)
 
@@ -58,27 +74,150 @@ link_record = dict(
 )
 
 
+class ReadWindow(object):
+    """
+    A buffer allocated once for an open file entry, which is filled with
+    as much decompressed data as it can hold at a time, such that the
+    (much smaller) reads requested through FUSE are served from it.
+    """
+
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # offset of the start of the buffer within the file entry.
+        self.offset = 0
+        self.length = 0
+        # whether the end of the file entry is within the buffer.
+        self.eof = False
+
+    def get(self, size, offset):
+        """
+        Return up to size bytes from offset that are in the buffer, or
+        None if offset is outside of it.
+        """
+
+        start = offset - self.offset
+        if start < 0 or start > self.length:
+            return None
+        return bytes(self.view[start:min(start + size, self.length)])
+
+    def fill(self, reader, offset):
+        """
+        Fill the buffer from the reader, which is at offset.
+        """
+
+        self.offset = offset
+        self.length = 0
+        self.eof = False
+        while self.length < len(self.buffer):
+            # readinto may return less than requested before the end.
+            length = reader.readinto(self.view[self.length:])
+            if not length:
+                self.eof = True
+                break
+            self.length += length
+
+
 class ExplosiveFUSE(LoggingMixIn, Operations):
     """
     The interface between the mapping and the FUSE bindings (provided
     by the Operations class).
     """
 
+    # the most data that is read at once when skipping forward.
+    skip_chunk = 1 << 20
+    # operations that only read the mapping, which is replaced rather
+    # than modified by the changes made to it from other threads.
+    lock_free = frozenset(['getattr', 'readdir'])
+
     def __init__(self, archive_paths, pathmaker_name='default',
-            _pathmaker=None, overwrite=False, include_arcname=False):
+            _pathmaker=None, overwrite=False, include_arcname=False,
+            spill_cache=None, index_cache=None, nested=False,
+            read_window=None, block_cache=None, watch_dirs=(),
+            control_socket=None, lazy=False, max_entries=None,
+            mapped_index=None):
         # if include_arcname is not defined, define it based whether
         # there is a single or multiple archives.
-        self.mapping = DefaultMapper(
+        mapper_kw = {}
+        mapper_cls = DefaultMapper
+        if mapped_index is not None:
+            # the mapping is kept as an index within this directory.
+            mapper_kw['index_dir'] = mapped_index
+            mapper_cls = MappedMapper
+        self.mapping = mapper_cls(
             pathmaker_name=pathmaker_name,
             _pathmaker=_pathmaker,
             overwrite=overwrite,
             include_arcname=include_arcname,
+            index_cache=index_cache,
+            nested=nested,
+            block_cache=block_cache,
+            lazy=lazy,
+            max_entries=max_entries,
+            **mapper_kw
         )
-        loaded = sum(self.mapping.load_archive(abspath(p))
-                     for p in archive_paths)
+        with self.mapping.edit():
+            loaded = sum(
+                self.mapping.load_archive(p if is_url(p) else abspath(p))
+                for p in archive_paths)
         logger.info('loaded %d archive(s).', loaded)
 
+        # optional SpillCache for decompressed data.
+        self.spill_cache = spill_cache
+        # size of the ReadWindow for every open file entry, if any.
+        self.read_window = read_window
         self.open_entries = {}
+        # the archives in these directories are kept loaded once the
+        # filesystem is initialized.
+        self.watch_dirs = [abspath(p) for p in watch_dirs]
+        self.watchers = []
+        # path to the unix socket for a ControlServer, if any.
+        self.control_socket = control_socket
+        self.control_server = None
+        # held for every operation other than lock_free ones, as the
+        # archives may be loaded by the watchers from their own threads.
+        self.lock = threading.RLock()
+
+    def __call__(self, op, *args):
+        # unless archives are loaded as they are traversed into.
+        if op in self.lock_free and not self.mapping.loads_on_traverse:
+            return super(ExplosiveFUSE, self).__call__(op, *args)
+        with self.lock:
+            return super(ExplosiveFUSE, self).__call__(op, *args)
+
+    def init(self, path):
+        # only now, as the process may have been daemonized since.
+        for watch_dir in self.watch_dirs:
+            watcher = DirectoryWatcher(
+                watch_dir, self.mapping.prepare_archive, self.apply_changes)
+            watcher.start()
+            self.watchers.append(watcher)
+        if self.control_socket:
+            self.control_server = ControlServer(self.control_socket, self)
+            self.control_server.start()
+
+    def apply_change(self, archive_path, prepared):
+        """
+        Replace the archive at archive_path in the mapping with the
+        result of ``DefaultMapper.prepare_archive``, or remove it if
+        prepared is None.
+        """
+
+        self.apply_changes([(archive_path, prepared)])
+
+    def apply_changes(self, changes):
+        """
+        Apply a list of changes as per apply_change in one step, with the
+        archives that are replaced or removed unloaded together.
+        """
+
+        with self.lock, self.mapping.edit():
+            self.mapping.unload_archives([
+                archive_path for archive_path, _ in changes
+                if archive_path in self.mapping.archives])
+            for archive_path, prepared in changes:
+                if prepared is not None:
+                    self.mapping.load_archive(archive_path, prepared)
 
     def getattr(self, path, fh=None):
         key = path[1:]
@@ -101,6 +240,15 @@ class ExplosiveFUSE(LoggingMixIn, Operations):
             raise FuseOSError(ENOENT)
         return idfe_fp
 
+    def _spill_acquire(self, key):
+        if self.spill_cache is None:
+            return None
+        stamp = self.mapping.stamp(key)
+        if stamp is None:
+            return None
+        archive_path, filename, size = self.mapping.traverse(key)
+        return self.spill_cache.acquire((archive_path, filename), stamp, size)
+
     def open(self, path, flags):
         # TODO implement memory usage tracking by reusing cache.
         key = path[1:]
@@ -109,11 +257,18 @@ class ExplosiveFUSE(LoggingMixIn, Operations):
         # the idfe is the stable identifier for this "version" of the
         # given path (id of fileentry), fp is the file pointer.
         idfe, fp = self._mapping_open(key)
+        # not to be evicted from the mapping while open.
+        self.mapping.pin(key)
         # initial position is 0
         pos = 0
+        # the entry in the spill cache, if enabled.
+        spill = self._spill_acquire(key)
         # add this to mapping, accompanied by the current position of 0
         # this is the open_entry and its id is the fh returned.
-        open_entry = [fp, pos, idfe]
+        open_entry = [fp, pos, idfe, spill, None]
+        if self.read_window:
+            # a buffer to decompress ahead into, reused for every read.
+            open_entry[4] = ReadWindow(self.read_window)
         # TODO ideally, the idfe is returned as the fh, but we need
         # additional tracking on all open handles.  Reference counting
         # should be use.
@@ -122,21 +277,17 @@ class ExplosiveFUSE(LoggingMixIn, Operations):
         return fh
 
     def release(self, path, fh):
-        fp, pos, idfe = self.open_entries.pop(fh, None)
+        fp, pos, idfe, spill, window = self.open_entries.pop(fh, None)
+        self.mapping.unpin(path[1:])
         if fp:
             fp.close()
+        if spill is not None:
+            self.spill_cache.release(spill)
 
-    def read(self, path, size, offset, fh):
-        key = path[1:]
-        logger.info(
-            'reading data for %s (fh:%#x, size:%d, offset:%d)',
-            key, fh, size, offset)
-        open_entry = self.open_entries.get(fh)
-        if not open_entry:
-            raise FuseOSError(EIO)
-        zf, pos, idfe = open_entry
-        logger.debug(
-            'open_entry: zf: %s, pos: %d, idfe: %s', zf, pos, idfe)
+    def _position(self, key, open_entry, offset):
+        # move the reader of the open_entry to offset, reopening it if
+        # that is behind its current position, and return the reader.
+        zf, pos, idfe, spill, window = open_entry
         seek = offset - pos
         if seek < 0:
             # have to reopen...
@@ -146,28 +297,196 @@ class ExplosiveFUSE(LoggingMixIn, Operations):
                 # different file entry, ignoring by kiling this
                 raise FuseOSError(EIO)
             # overwrite the open_entry's zipfile with the new one.
+            open_entry[0].close()
             open_entry[0] = zf
             # reset rest of the values
             seek = offset
             pos = 0
-        junk = zf.read(seek)
-        open_entry[1] = pos + size
-        return zf.read(size)
+        while seek > 0:
+            # skip over in chunks, such that the skipped data need not
+            # be held in memory all at once.
+            junk = zf.read(min(seek, self.skip_chunk))
+            if not junk:
+                break
+            if spill is not None:
+                # keep everything that was decompressed, including the
+                # parts that were skipped over.
+                self.spill_cache.write(spill, pos, junk)
+            pos += len(junk)
+            seek -= len(junk)
+        open_entry[1] = pos
+        return zf
 
-    def readdir(self, path, fh):
+    def read(self, path, size, offset, fh):
+        key = path[1:]
+        logger.info(
+            'reading data for %s (fh:%#x, size:%d, offset:%d)',
+            key, fh, size, offset)
+        open_entry = self.open_entries.get(fh)
+        if not open_entry:
+            raise FuseOSError(EIO)
+        zf, pos, idfe, spill, window = open_entry
+        logger.debug(
+            'open_entry: zf: %s, pos: %d, idfe: %s', zf, pos, idfe)
+        if spill is not None:
+            data = self.spill_cache.read(spill, size, offset)
+            if data is not None:
+                return data
+
+        if window is None:
+            zf = self._position(key, open_entry, offset)
+            data = zf.read(size)
+            open_entry[1] = offset + len(data)
+            if spill is not None:
+                self.spill_cache.write(spill, offset, data)
+            return data
+
+        head = window.get(size, offset)
+        if head is not None and (len(head) == size or window.eof):
+            return head
+        head = head or b''
+        offset += len(head)
+        zf = self._position(key, open_entry, offset)
+        window.fill(zf, open_entry[1])
+        open_entry[1] = window.offset + window.length
+        if spill is not None:
+            self.spill_cache.write(
+                spill, window.offset, window.view[:window.length])
+        tail = window.get(size - len(head), offset)
+        if tail is None:
+            # starts past the data there is (e.g. past the end).
+            return head
+        return head + tail
+
+    def readdir(self, path, fh, offset=None):
+        # listed in full, whatever the offset.
         key = path[1:]
         return ['.', '..'] + self.mapping.readdir(key)
 
+    def stats(self):
+        """
+        Return a dict of statistics on this instance.
+        """
+
+        result = {
+            'archives': len(self.mapping.archives),
+            'open_entries': len(self.open_entries),
+            'inflate_backend': reader.inflate_backend,
+        }
+        if self.mapping.lazy:
+            result['archives_unindexed'] = len(self.mapping.lazy_archives)
+        if self.mapping.max_entries is not None:
+            result['indexed_entries'] = self.mapping.indexed_entries
+        if self.spill_cache is not None:
+            result['spill_used'] = self.spill_cache.used
+        block_cache = self.mapping.block_cache
+        if block_cache is not None:
+            result['block_cache_used'] = block_cache.used
+            result['block_cache_hits'] = block_cache.hits
+            result['block_cache_misses'] = block_cache.misses
+        return result
+
     def statfs(self, path):
         # TODO report total size of the zips?
         return dict(f_bsize=1024, f_blocks=1024, f_bavail=0)
 
+    def destroy(self, path):
+        for watcher in self.watchers:
+            watcher.stop()
+        if self.control_server is not None:
+            self.control_server.stop()
+        if self.spill_cache is not None:
+            self.spill_cache.close()
+
+
+class PagedFUSE(FUSE):
+    """
+    FUSE that also passes the offset requested by the kernel to the
+    readdir of the operations, such that the ones returning entries
+    along with their offsets (see ``_SymlinkFUSE.readdir``) are listed
+    a page at a time rather than in full for every page.
+    """
+
+    def readdir(self, path, buf, filler, offset, fip):
+        for item in self.operations(
+                'readdir', self._decode_optional_path(path),
+                fip.contents.fh, offset):
+            # the attributes are left to getattr.
+            if isinstance(item, tuple):
+                name, _, offset = item
+            else:
+                name, offset = item, 0
+            if filler(buf, name.encode(self.encoding), None, offset) != 0:
+                break
+        return 0
+
+
+class SymlinkIndex(dict):
+    """
+    The symlinks of the management directory by name, with the names
+    also kept in sorted order and the first name of every target, both
+    maintained as symlinks are added and removed.
+    """
+
+    def __init__(self):
+        super(SymlinkIndex, self).__init__()
+        self.names = []
+        self.targets = {}
+
+    def __setitem__(self, name, target):
+        if name in self:
+            self.pop(name)
+        insort(self.names, name)
+        dict.__setitem__(self, name, target)
+        self.targets.setdefault(target, name)
+
+    def __delitem__(self, name):
+        self.pop(name)
+
+    def pop(self, name, *default):
+        if name not in self:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        target = dict.pop(self, name)
+        del self.names[bisect_left(self.names, name)]
+        if self.targets.get(target) == name:
+            del self.targets[target]
+        return target
+
+    def name_for(self, target):
+        """
+        Return the name for a symlink to target, which is its basename
+        unless taken by another, otherwise suffixed by a digest of the
+        target such that it remains the same across mounts.
+        """
+
+        base = basename(target)
+        digest = sha1(target.encode('utf-8', 'surrogateescape')).hexdigest()
+        candidates = [base] + ['%s_%s' % (base, digest[:n]) for n in (8, 40)]
+        for name in candidates:
+            if self.get(name, target) == target:
+                return name
+        n = 1
+        while name in self:
+            name = '%s_%s_%d' % (base, digest, n)
+            n += 1
+        return name
+
+    def add(self, target):
+        name = self.name_for(target)
+        self[name] = target
+        return name
+
 
 class _SymlinkFUSE(LoggingMixIn, Operations):
     """
     A symlink only filesystem that exist in memory.
     """
 
+    # the most entries of base_path returned by a call to readdir.
+    readdir_page_size = 1024
+
     def __init__(self, mount_root, base_path='/'):
         """
         The base directory where the symlinks are exposed.
@@ -179,7 +498,9 @@ class _SymlinkFUSE(LoggingMixIn, Operations):
         self.base_path = base_path
         self.mount_root = mount_root
         self.fd = 0
-        self.symlinks = {}  # keys are the basename.
+        self.symlinks = SymlinkIndex()  # keys are the basename.
+        # read only symlinks alongside the others, e.g. to show status.
+        self.markers = {}
 
     def getattr(self, path, fh=None):
         if path == '/':
@@ -196,7 +517,7 @@ class _SymlinkFUSE(LoggingMixIn, Operations):
             return dir_record
 
         symkey = basename(path)
-        data = self.symlinks.get(symkey)
+        data = self.symlinks.get(symkey, self.markers.get(symkey))
         if data is None:
             raise FuseOSError(ENOENT)
         result = {'st_size': len(data)}
@@ -214,14 +535,32 @@ class _SymlinkFUSE(LoggingMixIn, Operations):
 
     def readlink(self, path):
         symkey = basename(path)
+        if symkey in self.markers:
+            return self.markers[symkey]
         return self.symlinks[symkey]
 
-    def readdir(self, path, fh):
+    def readdir(self, path, fh, offset=None):
+        """
+        Without an offset, the full listing is returned.  Otherwise the
+        entries of base_path (in order of name, followed by the markers)
+        are returned from offset along with the offset of the next one,
+        up to readdir_page_size of them.
+        """
+
         if not path == self.base_path:
             if path == '/':
                 path = ''
             return ['.', '..', self.base_path[len(path):].split('/')[1]]
-        return ['.', '..'] + list(self.symlinks.keys())
+        names = self.symlinks.names
+        markers = sorted(self.markers)
+        if offset is None:
+            return ['.', '..'] + names + markers
+        stop = offset + self.readdir_page_size
+        page = ['.', '..'][offset:stop]
+        page.extend(names[max(offset - 2, 0):max(stop - 2, 0)])
+        start = 2 + len(names)
+        page.extend(markers[max(offset - start, 0):max(stop - start, 0)])
+        return [(name, None, offset + i + 1) for i, name in enumerate(page)]
 
     def symlink(self, path, source):
         if not path.startswith(self.base_path):
@@ -230,7 +569,10 @@ class _SymlinkFUSE(LoggingMixIn, Operations):
 
         symkey = basename(path)
 
-        target = abspath(join(self.mount_root, self.base_path[1:], source))
+        if is_url(source):
+            target = source
+        else:
+            target = abspath(join(self.mount_root, self.base_path[1:], source))
         self.symlinks[symkey] = target
         # Warning: non-standard return value
         return target
@@ -262,8 +604,17 @@ class SymlinkFUSE(_SymlinkFUSE):
 class ManagedExplosiveFUSE(ExplosiveFUSE):
     """
     ExplosiveFS with a management path
+
+    Archives added or removed through the management path are loaded
+    and unloaded by a background worker, such that the filesystem
+    remains available while they are indexed; every archive that is
+    being loaded is marked by a read only symlink with the name of its
+    symlink followed by pending_suffix, until it has been added to the
+    mapping (in one step) or removed as it could not be loaded.
     """
 
+    pending_suffix = '.pending'
+
     def __init__(self, mount_root, management_node, *a, **kw):
         if '/' in management_node:
             raise ValueError('Management node must be a valid directory name')
@@ -271,36 +622,120 @@ class ManagedExplosiveFUSE(ExplosiveFUSE):
         base_path = '/' + management_node
         self.symlinkfs = _SymlinkFUSE(mount_root, base_path)
         super(ManagedExplosiveFUSE, self).__init__(*a, **kw)
-        symlinks = self.symlinkfs.symlinks
-        for n, k in enumerate(sorted(self.mapping.archives.keys())):
-            fn = basename(k)
-            fn = fn if fn not in symlinks else '%s_%d' % (basename(fn), n)
-            symlinks[fn] = k
-
-    def readdir(self, path, fh):
-        result = super(ManagedExplosiveFUSE, self).readdir(path, fh)
+        for k in sorted(self.mapping.archives.keys()):
+            self.symlinkfs.symlinks.add(k)
+        # the queued operation ('load' or 'unload') for archives, by path.
+        self.pending = {}
+        self.queue = Queue()
+        self.worker = None
+
+    def _submit(self, op, name, archive_path):
+        if self.worker is None:
+            # only as required, as the process may have been daemonized.
+            self.worker = threading.Thread(target=self._work)
+            self.worker.daemon = True
+            self.worker.start()
+        self.pending[archive_path] = op
+        if op == 'load':
+            self.symlinkfs.markers[name + self.pending_suffix] = archive_path
+        self.queue.put((op, name, archive_path))
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            op, name, archive_path = item
+            try:
+                if op == 'load':
+                    self._load(name, archive_path)
+                else:
+                    with self.lock:
+                        self._unload(archive_path)
+            except Exception:
+                logger.exception('failed to %s `%s`', op, archive_path)
+            finally:
+                self.queue.task_done()
+
+    def _load(self, name, archive_path):
+        prepared = self.mapping.prepare_archive(archive_path)
+        with self.lock:
+            self.symlinkfs.markers.pop(name + self.pending_suffix, None)
+            if self.pending.get(archive_path) == 'load':
+                self.pending.pop(archive_path)
+            if self.symlinkfs.symlinks.get(name) != archive_path:
+                # removed in the mean time.
+                if prepared is not None:
+                    prepared[0].close()
+            elif not (prepared and self.mapping.load_archive(
+                    archive_path, prepared)):
+                self.symlinkfs.symlinks.pop(name, None)
+
+    def _unload(self, archive_path):
+        if self.pending.get(archive_path) == 'unload':
+            self.pending.pop(archive_path)
+        self.mapping.unload_archive(archive_path)
+
+    def readdir(self, path, fh, offset=None):
+        result = super(ManagedExplosiveFUSE, self).readdir(path, fh, offset)
         if path == '/' and self.management_node not in result:
             result.append(self.management_node)
         return result
 
+    def apply_changes(self, changes):
+        # keep the symlinks in step with the changes made otherwise.
+        with self.lock:
+            loaded = set(
+                archive_path for archive_path, _ in changes
+                if archive_path in self.mapping.archives)
+            super(ManagedExplosiveFUSE, self).apply_changes(changes)
+            symlinks = self.symlinkfs.symlinks
+            removed = set(
+                archive_path for archive_path in loaded
+                if archive_path not in self.mapping.archives)
+            for archive_path in removed:
+                symlinks.pop(symlinks.targets.get(archive_path), None)
+            for archive_path, _ in changes:
+                if (archive_path in loaded or
+                        archive_path not in self.mapping.archives):
+                    continue
+                loaded.add(archive_path)
+                symlinks.add(archive_path)
+
+    def destroy(self, path):
+        if self.worker is not None:
+            self.queue.put(None)
+        super(ManagedExplosiveFUSE, self).destroy(path)
+
     def __call__(self, op, path, *args):
+        if not path.startswith(self.symlinkfs.base_path):
+            return super(ManagedExplosiveFUSE, self).__call__(op, path, *args)
+        with self.lock:
+            return self._call(op, path, *args)
+
+    def _call(self, op, path, *args):
         if path.startswith(self.symlinkfs.base_path):
             result = getattr(self.symlinkfs, op)(path, *args)
 
             if op == 'symlink':
-                if result in self.mapping.archives:
+                pending = self.pending.get(result)
+                if pending == 'load' or (
+                        result in self.mapping.archives and
+                        pending != 'unload'):
                     # no support of multiple symlinks to the same target
                     self.symlinkfs.unlink(path)
                     raise FuseOSError(ENOTSUP)
 
-                if not self.mapping.load_archive(result):
+                if not (is_url(result) or isfile(result)):
                     self.symlinkfs.unlink(path)
                     # Assume I/O error due to archive inaccessible.
                     raise FuseOSError(EIO)
+                # indexed by the worker.
+                self._submit('load', basename(path), result)
                 return None
 
             elif op == 'unlink':
-                self.mapping.unload_archive(result)
+                self._submit('unload', basename(path), result)
                 return None
 
             return result
@@ -0,0 +1,605 @@
+import heapq
+import json
+import marshal
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging import getLogger
+from os.path import basename
+from time import time
+
+from .archive import ArchiveFile
+from .mapper import DefaultMapper
+from .mapper import FileEntry
+
+logger = getLogger(__name__)
+
+MAGIC = b'EXFUSEMI'
+
+_int = struct.Struct('<q')
+_header = struct.Struct('<8sqq')
+
+# the columns of a MappedIndex, as arrays of 64-bit integers; the ones
+# of offsets have an extra element at the end.
+COLUMNS = ('parents', 'sizes', 'archive_ids', 'name_offsets',
+           'entry_offsets')
+
+
+def _encode(name):
+    return name.encode('utf-8', 'surrogateescape')
+
+
+class _Column(object):
+    """
+    Column of integers written to a temporary file as it is produced.
+    """
+
+    flush_size = 1 << 16
+
+    def __init__(self):
+        self.fd = tempfile.TemporaryFile()
+        self.items = array('q')
+
+    def append(self, value):
+        self.items.append(value)
+        if len(self.items) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        # tostring was renamed to tobytes.
+        tobytes = getattr(self.items, 'tobytes', None) or self.items.tostring
+        self.fd.write(tobytes())
+        self.items = array('q')
+
+
+def _dump(items, fd):
+    for item in items:
+        marshal.dump(item, fd)
+    fd.seek(0)
+
+
+def _load(fd):
+    fd.seek(0)
+    while True:
+        try:
+            yield marshal.load(fd)
+        except EOFError:
+            return
+
+
+def _sorted_runs(records, run_size):
+    # sort the records into runs of up to run_size, kept in temporary
+    # files, to be merged.
+    runs = []
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= run_size:
+            chunk.sort()
+            runs.append(tempfile.TemporaryFile())
+            _dump(chunk, runs[-1])
+            chunk = []
+    chunk.sort()
+    runs.append(tempfile.TemporaryFile())
+    _dump(chunk, runs[-1])
+    return runs
+
+
+def _merged(runs):
+    return heapq.merge(*[_load(run) for run in runs])
+
+
+def _tagged(archive_id, records):
+    # the records of a run as merged with the other ones, ordered by the
+    # archive (in order of load) then by their sequence within it.
+    for names, seq, ifilename, size in records:
+        yield (names, (archive_id, seq), archive_id if size >= 0 else -1,
+               ifilename, size)
+
+
+def _merged_runs(runs):
+    return heapq.merge(*[
+        _tagged(archive_id, _load(run)) for archive_id, run in enumerate(runs)])
+
+
+def _resolve(records, overwrite):
+    """
+    Return the directions for the paths claimed by both file entries
+    and directories (i.e. as the parent of something) among the sorted
+    records, True for the ones that end up as a directory.
+
+    As per DefaultMapper, a path is a directory if it was claimed as one
+    first, unless overwrite is set and a file entry was added there
+    (which replaces the directory); otherwise it is a file entry, and
+    the claims of it as a directory are ignored.
+    """
+
+    conflicts = {}
+    # the path being walked, with the first sequence number of the
+    # claims of each of them as a file entry and as a directory.
+    stack = []
+
+    def pop():
+        path, first_file, first_dir = stack.pop()
+        if first_file is not None and first_dir is not None:
+            conflicts[path] = first_dir < first_file and not overwrite
+        if stack:
+            # whatever is within the path claims the parent.
+            first = min(s for s in (first_file, first_dir) if s is not None)
+            if stack[-1][2] is None or first < stack[-1][2]:
+                stack[-1][2] = first
+
+    for path, seq, archive_id, _, _ in records:
+        if not path:
+            # the root, which is always a directory.
+            continue
+        while stack and stack[-1][0] != path[:len(stack[-1][0])]:
+            pop()
+        for depth in range(len(stack), len(path)):
+            stack.append([path[:depth + 1], None, None])
+        claim = 1 if archive_id >= 0 else 2
+        if stack[-1][claim] is None:
+            stack[-1][claim] = seq
+    while stack:
+        pop()
+    return conflicts
+
+
+def _tree(records, conflicts, overwrite):
+    """
+    Generate the path and the entry (None for a directory) of every
+    node of the tree produced by the sorted records, in order of path.
+    """
+
+    # the directories generated along the path of the last record.
+    current = ()
+    # the latest file entry, which is only generated once the last of
+    # the ones at its path is reached.
+    pending = None
+
+    for path, seq, archive_id, ifilename, size in records:
+        if not path:
+            continue
+        is_file = archive_id >= 0
+        if any(conflicts.get(path[:depth]) is False
+               for depth in range(1, len(path))):
+            # within a file entry.
+            continue
+        if conflicts.get(path) is is_file:
+            # the other of the two won.
+            continue
+        if pending is not None and pending[0] != path:
+            yield pending
+            pending = None
+        if is_file:
+            if pending is None or overwrite:
+                pending = (path, (archive_id, ifilename, size))
+            # these are claimed as a directory by the path of this.
+            dirs = path[:-1]
+        else:
+            dirs = path
+        depth = 0
+        while depth < min(len(current), len(dirs)) and (
+                current[depth] == dirs[depth]):
+            depth += 1
+        for depth in range(depth, len(dirs)):
+            yield dirs[:depth + 1], None
+        current = dirs
+    if pending is not None:
+        yield pending
+
+
+def write_run(fd, records, run_size=1 << 18):
+    """
+    Write the records of an archive to the file object fd, sorted by
+    path, as a run to be merged by write_index.  The records are tuples
+    of the path (as a tuple of names) and the FileEntry, or None for a
+    directory, in the order they would be added to a DefaultMapper.
+    Return the number of records.
+
+    The records are sorted on disk in runs of run_size, which are then
+    merged into fd, such that they are never all held in memory.
+    """
+
+    def encoded():
+        for seq, (names, entry) in enumerate(records):
+            names = tuple(_encode(name) for name in names)
+            if entry is None:
+                yield names, seq, b'', -1
+            else:
+                yield (names, seq, _encode(entry.ifilename),
+                       entry.ifile_size)
+
+    chunks = _sorted_runs(encoded(), run_size)
+    count = 0
+    try:
+        for record in _merged(chunks):
+            marshal.dump(record, fd)
+            count += 1
+    finally:
+        for chunk in chunks:
+            chunk.close()
+    fd.flush()
+    return count
+
+
+def write_index(path, runs, archive_paths, overwrite=False):
+    """
+    Write the tree produced by the runs (see write_run) of the archives
+    at archive_paths, in the order they were loaded, to path, to be read
+    as a MappedIndex.  The conflicts between the records are resolved as
+    per DefaultMapper.  Return the number of nodes.
+
+    The runs are merged, and the nodes then written out a level of the
+    tree at a time, such that the tree is never held in memory.
+    """
+
+    conflicts = _resolve(_merged_runs(runs), overwrite)
+    # the nodes at every depth, which are in order of path.
+    levels = [None]
+    for names, entry in _tree(_merged_runs(runs), conflicts, overwrite):
+        while len(levels) <= len(names):
+            levels.append([tempfile.TemporaryFile(), 0])
+        level = levels[len(names)]
+        marshal.dump((names, entry), level[0])
+        level[1] += 1
+
+    columns = OrderedDict((name, _Column()) for name in COLUMNS)
+    blobs = OrderedDict(
+        (name, tempfile.TemporaryFile()) for name in ('names', 'entries'))
+    offsets = {'names': 0, 'entries': 0}
+
+    def add(parent, name, entry):
+        columns['parents'].append(parent)
+        columns['name_offsets'].append(offsets['names'])
+        columns['entry_offsets'].append(offsets['entries'])
+        blobs['names'].write(name)
+        offsets['names'] += len(name)
+        if entry is None:
+            columns['sizes'].append(-1)
+            columns['archive_ids'].append(-1)
+            return
+        archive_id, ifilename, size = entry
+        columns['sizes'].append(size)
+        columns['archive_ids'].append(archive_id)
+        blobs['entries'].write(ifilename)
+        offsets['entries'] += len(ifilename)
+
+    # nodes are numbered breadth first, with the children of every
+    # directory in order of name, i.e. in order of depth then path.
+    add(-1, b'', None)
+    count = 1
+    parent_start = 0
+    for depth in range(1, len(levels)):
+        fd = levels[depth][0]
+        parents = _load(levels[depth - 1][0]) if depth > 1 else iter(
+            [((), None)])
+        parent, parent_id = next(parents)[0], parent_start
+        for names, entry in _load(fd):
+            while parent != names[:-1]:
+                parent, parent_id = next(parents)[0], parent_id + 1
+            add(parent_id, names[-1], entry)
+        parent_start = count
+        count += levels[depth][1]
+        if depth > 1:
+            levels[depth - 1][0].close()
+    if len(levels) > 1:
+        levels[-1][0].close()
+    columns['name_offsets'].append(offsets['names'])
+    columns['entry_offsets'].append(offsets['entries'])
+
+    # the sections follow the header, aligned to 8 bytes.
+    sections = OrderedDict()
+    meta = {'archives': archive_paths, 'sections': sections}
+    position = _header.size + len(json.dumps(meta)) + 1024
+    for name, column in columns.items():
+        column.flush()
+        sections[name] = position = (position + 7) // 8 * 8
+        position += column.fd.tell()
+    for name, blob in blobs.items():
+        sections[name] = position
+        position += blob.tell()
+    meta_data = json.dumps(meta).encode('utf-8')
+    # reserved enough room for the offsets above.
+    assert _header.size + len(meta_data) <= sections['parents']
+
+    with open(path, 'wb') as fd:
+        fd.write(_header.pack(MAGIC, count, len(meta_data)))
+        fd.write(meta_data)
+        for name, fobj in list(columns.items()) + list(blobs.items()):
+            fobj = getattr(fobj, 'fd', fobj)
+            fd.write(b'\0' * (sections[name] - fd.tell()))
+            fobj.seek(0)
+            shutil.copyfileobj(fobj, fd)
+            fobj.close()
+    return count
+
+
+class MappedIndex(object):
+    """
+    A directory tree held as sorted arrays within a memory mapped file
+    (see write_index), rather than as Python objects.
+
+    Nodes are numbered breadth first with the children of every
+    directory in order of name, such that the array of parents is
+    sorted and the children of any directory are contiguous, found by a
+    binary search of the parents and then of their names.  Every node
+    has its name, parent, size (-1 for directories), and for file
+    entries, the id of its archive and its name within the archive.
+    """
+
+    def __init__(self, path, version=0):
+        with open(path, 'rb') as fd:
+            self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, meta_size = _header.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('`%s` is not a mapped index' % path)
+        meta = json.loads(self.mm[
+            _header.size:_header.size + meta_size].decode('utf-8'))
+        self.archives = meta['archives']
+        self.sections = meta['sections']
+        # identifies this index among the ones produced by a mapper.
+        self.version = version
+
+    def __len__(self):
+        return self.count
+
+    def _get(self, column, i):
+        return _int.unpack_from(self.mm, self.sections[column] + 8 * i)[0]
+
+    def _blob(self, blob, column, i):
+        start = self._get(column, i)
+        end = self._get(column, i + 1)
+        offset = self.sections[blob]
+        return self.mm[offset + start:offset + end]
+
+    def name(self, node):
+        return self._blob('names', 'name_offsets', node)
+
+    def is_dir(self, node):
+        return self._get('sizes', node) < 0
+
+    def entry(self, node):
+        """
+        Return the archive path, name within it and size of the file
+        entry at node.
+        """
+
+        return (
+            self.archives[self._get('archive_ids', node)],
+            self._blob('entries', 'entry_offsets', node).decode(
+                'utf-8', 'surrogateescape'),
+            self._get('sizes', node),
+        )
+
+    def _bisect(self, parent, right):
+        lo, hi = 1, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self._get('parents', mid)
+            if value < parent or (right and value == parent):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def children(self, node):
+        """
+        Return the range of the nodes within the directory at node.
+        """
+
+        return self._bisect(node, False), self._bisect(node, True)
+
+    def lookup(self, node, name):
+        """
+        Return the node named name (as bytes) within the directory at
+        node, or None.
+        """
+
+        lo, hi = self.children(node)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self.name(mid)
+            if value == name:
+                return mid
+            if value < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def listdir(self, node):
+        lo, hi = self.children(node)
+        return [
+            self.name(i).decode('utf-8', 'surrogateescape')
+            for i in range(lo, hi)]
+
+
+class MappedDirectory(dict):
+    """
+    The directory at a node of a MappedIndex, as returned by traverse.
+    """
+
+    def __init__(self, index, node):
+        super(MappedDirectory, self).__init__()
+        self.index = index
+        self.node = node
+
+
+class MappedMapper(DefaultMapper):
+    """
+    Mapper that keeps the mapping as a MappedIndex, within a file in
+    index_dir (removed once mapped), such that it is held by the page
+    cache rather than as Python objects.
+
+    The entries of every archive are sorted on disk into a run as it is
+    prepared (see write_run), kept in an unnamed temporary file within
+    index_dir while it is loaded.  The index is built anew by merging
+    the runs of the loaded archives as they are loaded or unloaded (once
+    for all the changes made within edit), without reading the archives
+    again, then published by replacing the reference to it.  As every
+    change still writes out the whole index, this is suited to sets of
+    archives that rarely change.
+    """
+
+    def __init__(self, index_dir, path=None, **kw):
+        if kw.get('nested') or kw.get('lazy') or kw.get('max_entries'):
+            raise ValueError(
+                'nested, lazy and max_entries are not supported')
+        super(MappedMapper, self).__init__(**kw)
+        self.index_dir = index_dir
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        # in the order they were loaded.
+        self.archives = OrderedDict()
+        # the run of the entries of every loaded archive.
+        self.runs = {}
+        self.index = None
+        self._editing = False
+        self._changed = False
+        self._build()
+        if path:
+            self.load_archive(path)
+
+    @contextmanager
+    def edit(self):
+        if self._editing:
+            yield
+            return
+        self._editing = True
+        try:
+            yield
+        finally:
+            self._editing = False
+            if self._changed:
+                self._build()
+
+    def _records(self, archive_path, infolist):
+        # as per DefaultMapper._load_infolist.
+        archive_name = basename(archive_path) + '/'
+        for info in infolist:
+            if self.include_arcname:
+                raw_filename = archive_name + info.filename
+            else:
+                raw_filename = info.filename
+            frags, filename = self.pathmaker(raw_filename)
+            if not filename:
+                # was a directory entry
+                yield tuple(frags), None
+                continue
+            yield tuple(frags) + (filename,), FileEntry(
+                archive_path, info.filename, info.file_size)
+
+    def _build(self):
+        self._changed = False
+        archive_paths = list(self.archives)
+        fd, path = tempfile.mkstemp(prefix='mapping-', dir=self.index_dir)
+        os.close(fd)
+        try:
+            count = write_index(
+                path, [self.runs[p] for p in archive_paths], archive_paths,
+                overwrite=self.overwrite)
+            version = self.index.version + 1 if self.index else 0
+            index = MappedIndex(path, version)
+        finally:
+            os.unlink(path)
+        # the only modification that readers of the mapping see.
+        self.index = index
+        logger.info(
+            'built mapped index of %d node(s) for %d archive(s)',
+            count, len(archive_paths))
+
+    def prepare_archive(self, archive_path, errors=None):
+        """
+        As per DefaultMapper.prepare_archive, with the entries written to
+        the run of the archive rather than read into a list.
+        """
+
+        try:
+            key = self._archive_key(archive_path)
+            af = ArchiveFile(
+                archive_path, index_cache=self.index_cache,
+                block_cache=self.block_cache)
+            run = tempfile.TemporaryFile(prefix='run-', dir=self.index_dir)
+            try:
+                write_run(run, self._records(archive_path, af.iterinfo()))
+            except:
+                run.close()
+                af.close()
+                raise
+            return af, run, key
+        except Exception as e:
+            reason = self._load_failed(archive_path, e)
+            if errors is not None:
+                errors[archive_path] = reason
+        return None
+
+    def load_archive(self, archive_path, prepared=None):
+        if prepared is None:
+            prepared = self.prepare_archive(archive_path)
+            if prepared is None:
+                return False
+        af, run, key = prepared
+        with self.edit():
+            self._pool_put(archive_path, af)
+            if key is not None:
+                self.archive_keys[archive_path] = key
+            self._discard_run(archive_path)
+            self.runs[archive_path] = run
+            self.archives.pop(archive_path, None)
+            self.archives[archive_path] = time()
+            self._changed = True
+        logger.info('loaded `%s`', archive_path)
+        return True
+
+    def _discard_run(self, archive_path):
+        run = self.runs.pop(archive_path, None)
+        if run is not None:
+            run.close()
+
+    def unload_archives(self, archive_paths):
+        with self.edit():
+            for archive_path in archive_paths:
+                if self.archives.pop(archive_path, None) is None:
+                    continue
+                self._pool_discard(archive_path)
+                self._discard_run(archive_path)
+                self.archive_keys.pop(archive_path, None)
+                self._changed = True
+                logger.info('unloaded `%s`', archive_path)
+
+    def _lookup(self, index, path):
+        node = 0
+        for frag in path and path.split('/') or []:
+            if not index.is_dir(node):
+                return None
+            node = index.lookup(node, _encode(frag))
+            if node is None:
+                return None
+        return node
+
+    def traverse(self, path):
+        index = self.index
+        node = self._lookup(index, path)
+        if node is None:
+            return None
+        if index.is_dir(node):
+            return MappedDirectory(index, node)
+        return FileEntry(*index.entry(node))
+
+    def readdir(self, path):
+        info = self.traverse(path)
+        if not isinstance(info, MappedDirectory):
+            return []
+        return info.index.listdir(info.node)
+
+    def _identify(self, path, info):
+        # the entries are produced anew with every index, so these are
+        # identified by where they are from rather than by identity.
+        archive_path, ifilename, _ = info
+        return (archive_path, self.archive_keys.get(archive_path), ifilename)
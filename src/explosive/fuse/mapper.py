@@ -1,13 +1,20 @@
+from os import stat
 from time import time
+from contextlib import contextmanager
+from functools import wraps
 from collections import defaultdict
 from collections import deque
 from collections import namedtuple
+from collections import OrderedDict
 from os.path import basename
 from logging import getLogger
 
 from . import pathmaker
 from .archive import ArchiveFile
 from .archive import FileNotFoundError
+from .archive import file_key
+from .archive import is_archive
+from .archive import is_url
 from .exception import BadArchiveFile
 from .exception import UnsupportedArchiveFile
 
@@ -18,14 +25,60 @@ logger = getLogger(__name__)
 FileEntry = namedtuple(
     'FileEntry', ['archive_path', 'ifilename', 'ifile_size'])
 
+# Separates the path of an archive and the internal filename of a nested
+# archive within, to form the archive path of the latter.
+NESTED_SEP = '\0'
+
+
+class NestedArchive(dict):
+    """
+    The directory presented for a file entry that is an archive, which
+    is populated with the file entries from that archive as it is first
+    traversed into.
+    """
+
+    def __init__(self, fentry):
+        super(NestedArchive, self).__init__()
+        self.fentry = fentry
+        self.loaded = False
+
+
+class LazyArchive(dict):
+    """
+    The directory presented for archives that are not yet indexed (see
+    the lazy option of DefaultMapper), which are loaded in its place as
+    it is first traversed into.
+    """
+
+    def __init__(self, name, archive_paths):
+        super(LazyArchive, self).__init__()
+        self.name = name
+        self.archive_paths = archive_paths
+
+
+def _edits(f):
+    # the changes made by f are published once it returns.
+    @wraps(f)
+    def wrapper(self, *a, **kw):
+        with self.edit():
+            return f(self, *a, **kw)
+    return wrapper
+
 
 class DefaultMapper(object):
     """
     Mapper that tracks the nested structure within archive files.
+
+    The directories of a published mapping are never modified; changes
+    are made to copies of the directories along the way to them, with
+    the new version of the mapping published by replacing the reference
+    to its root (see edit), such that it may be read without a lock.
     """
 
     def __init__(self, path=None, pathmaker_name='default', _pathmaker=None,
-            overwrite=False, include_arcname=False):
+            overwrite=False, include_arcname=False, pool_size=16,
+            index_cache=None, nested=False, block_cache=None, lazy=False,
+            max_entries=None):
         """
         Initialize the mapping, optionally with a path to an archive
         file.
@@ -44,18 +97,102 @@ class DefaultMapper(object):
 
         # The actual filesystem mapping
         self.mapping = {}
+        # the version of the mapping being built within edit, along with
+        # the ids of the directories created for it (thus not published).
+        self._draft = None
+        self._owned = None
         # a mapping with keys of generated paths against source archive.
         # its keys includes a map of directory to its source archive.
         self.reverse_mapping = defaultdict(deque)
         # Tracked file added timestamps (see _load_infolist)
         self.archives = {}
+        # The file_key of every archive as it was loaded, such that
+        # modifications made to it since can be detected.
+        self.archive_keys = {}
         # A flattened mapping of archive to its list of internal entries
         # including directory entries.
         self.archive_ifilenames = {}
+        # Recently used ArchiveFile instances, least recently used first,
+        # kept open such that opening file entries does not require the
+        # archive to be opened and its central directory read again.
+        self.archive_pool = OrderedDict()
+        self.pool_size = pool_size
+        # persisted indexes of archives that must be scanned.
+        self.index_cache = index_cache
+        # shared cache of the raw bytes of archives, if any.
+        self.block_cache = block_cache
+        # present file entries that are archives as directories.
+        self.nested = nested
+        # NestedArchive instances by their FileEntry.
+        self.nested_archives = {}
+        # only index archives once their directory is traversed into,
+        # which requires include_arcname.
+        self.lazy = lazy or max_entries is not None
+        # the name of the LazyArchive of archives yet to be indexed.
+        self.lazy_archives = {}
+        # the most file entries kept indexed for lazy archives, beyond
+        # which the least recently used directories of archives are
+        # evicted back to a LazyArchive; None for no limit.
+        self.max_entries = max_entries
+        # the indexed archives by the name of their directory, least
+        # recently used first, along with the total of their entries.
+        self.indexed = OrderedDict()
+        self.indexed_entries = 0
+        # the number of open file entries within every directory, which
+        # are not evicted.
+        self.pinned = defaultdict(int)
 
         if path:
             self.load_archive(path)
 
+    @property
+    def loads_on_traverse(self):
+        """
+        Whether archives may be loaded (thus the mapping modified) as
+        the mapping is traversed.
+        """
+
+        return self.nested or self.lazy
+
+    @contextmanager
+    def edit(self):
+        """
+        Context within which the changes made to the mapping are built
+        on a new version of it, published as a whole once it exits.
+        Nested uses are part of the outermost one.
+        """
+
+        if self._draft is not None:
+            yield
+            return
+        self._draft = dict(self.mapping)
+        self._owned = set([id(self._draft)])
+        try:
+            yield
+        finally:
+            # the only modification that readers of the mapping see.
+            self.mapping = self._draft
+            self._draft = self._owned = None
+
+    def _writable(self, current, frag):
+        # the directory frag within current of the draft, copied first
+        # if it is one that was published.
+        child = current[frag]
+        if id(child) not in self._owned:
+            current[frag] = child = dict(child)
+            self._owned.add(id(child))
+        return child
+
+    def _writable_dir(self, path_fragments):
+        # the directory at path_fragments within the draft, or None.
+        current = self._draft
+        for frag in path_fragments:
+            if not isinstance(current.get(frag), dict):
+                return None
+            current = self._writable(current, frag)
+        return current
+
+    @_edits
     def mkdir(self, path_fragments):
         """
         Creates the dir entries identified by path if not already exists
@@ -63,12 +200,11 @@ class DefaultMapper(object):
         """
 
         # set current to root node
-        current = self.mapping
+        current = self._draft
 
         for c, frag in enumerate(path_fragments):
             if frag in current:
-                current = current[frag]
-                if not isinstance(current, dict):
+                if not isinstance(current[frag], dict):
                     raise ValueError(
                         'cannot create directory `%(filename)s` at '
                         '`%(path)s/`: file entry exists.' % {
@@ -76,9 +212,11 @@ class DefaultMapper(object):
                             'path': '/'.join(path_fragments[:c]),
                         }
                     )
+                current = self._writable(current, frag)
             else:
                 # create directory dict entry and set current.
                 current[frag] = current = {}
+                self._owned.add(id(current))
 
         return current
 
@@ -92,15 +230,211 @@ class DefaultMapper(object):
 
     def _traverse(self, path_fragments):
         current = self.mapping
+        if path_fragments and path_fragments[0] in self.indexed:
+            # now the most recently used.
+            self.indexed[path_fragments[0]] = self.indexed.pop(
+                path_fragments[0])
 
         for frag in path_fragments:
+            if isinstance(current, NestedArchive):
+                self._load_nested(current)
+            elif isinstance(current, LazyArchive):
+                current = self._load_lazy(current)
             if not isinstance(current, dict) or frag not in current:
                 # No such frag in dir.
                 return None
-            current = current[frag]
+            current = self._resolve(current[frag])
 
         return current
 
+    def _resolve(self, entry):
+        # a file entry that is an archive is presented as a directory
+        # if nested archives are enabled.
+        if not (self.nested and isinstance(entry, FileEntry) and
+                is_archive(entry.ifilename)):
+            return entry
+        result = self.nested_archives.get(entry)
+        if result is None:
+            result = self.nested_archives[entry] = NestedArchive(entry)
+        return result
+
+    def _load_nested(self, nested_archive):
+        if nested_archive.loaded:
+            return
+        nested_archive.loaded = True
+        fentry = nested_archive.fentry
+        archive_path = fentry.archive_path + NESTED_SEP + fentry.ifilename
+        # only the resulting mapping is needed from this.
+        mapper = DefaultMapper(
+            _pathmaker=self.pathmaker,
+            overwrite=self.overwrite,
+            include_arcname=False,
+        )
+        try:
+            af = self._pool_get(archive_path)
+            mapper._load_infolist(archive_path, list(af.iterinfo()))
+            nested_archive.update(mapper.mapping)
+            logger.info(
+                'loaded nested `%s` from `%s`',
+                fentry.ifilename, fentry.archive_path)
+        except BadArchiveFile:
+            logger.warning(
+                '`%s` in `%s` appears to be an invalid archive file',
+                fentry.ifilename, fentry.archive_path)
+        except UnsupportedArchiveFile as e:
+            logger.warning(
+                '`%s` in `%s` %s', fentry.ifilename, fentry.archive_path,
+                str(e))
+        except:
+            logger.exception('Exception')
+
+    def _lazy_name(self, archive_path):
+        # the name of the directory for the archive, if it may be lazy.
+        if not (self.lazy and self.include_arcname):
+            return None
+        frags, _ = self.pathmaker(basename(archive_path) + '/')
+        return frags[0] if len(frags) == 1 else None
+
+    @_edits
+    def _register_lazy(self, archive_path):
+        name = self._lazy_name(archive_path)
+        if name is None or (
+                self._archive_key(archive_path) is None and
+                not is_url(archive_path)):
+            # e.g. missing, which is left to be reported by loading.
+            return False
+        current = self._draft.get(name)
+        if current is None:
+            archive_paths = []
+        elif isinstance(current, LazyArchive):
+            archive_paths = current.archive_paths
+        else:
+            # merged with the already indexed ones.
+            return False
+        self._draft[name] = LazyArchive(name, archive_paths + [archive_path])
+        self.lazy_archives[archive_path] = name
+        self.archives[archive_path] = time()
+        logger.info('registered `%s` to be loaded on access', archive_path)
+        return True
+
+    @_edits
+    def _unregister_lazy(self, archive_path):
+        name = self.lazy_archives.pop(archive_path)
+        self.archives.pop(archive_path, None)
+        lazy = self._draft.get(name)
+        if not isinstance(lazy, LazyArchive):
+            return
+        archive_paths = [p for p in lazy.archive_paths if p != archive_path]
+        if archive_paths:
+            self._draft[name] = LazyArchive(name, archive_paths)
+        else:
+            self._draft.pop(name)
+
+    def _load_lazy(self, lazy):
+        # return the directory that replaced it, once loaded.
+        with self.edit():
+            if self._draft.get(lazy.name) is lazy:
+                self._draft.pop(lazy.name)
+                for archive_path in lazy.archive_paths:
+                    self.lazy_archives.pop(archive_path, None)
+                    # until it is loaded.
+                    self.archives.pop(archive_path, None)
+                    self._load_archive(
+                        archive_path, self._prepare_pooled(archive_path))
+            result = self._draft.get(lazy.name)
+        return result if isinstance(result, dict) else {}
+
+    def _prepare_pooled(self, archive_path):
+        # as per prepare_archive, but from the ArchiveFile still in the
+        # pool (e.g. after eviction) if it was not modified since.
+        key = self.archive_keys.get(archive_path)
+        if (archive_path not in self.archive_pool or key is None or
+                key != self._archive_key(archive_path)):
+            return None
+        af = self.archive_pool.pop(archive_path)
+        try:
+            return af, list(af.iterinfo()), key
+        except Exception:
+            # left to be reported as it is opened again.
+            af.close()
+            return None
+
+    def _index_added(self, archive_path):
+        name = self._lazy_name(archive_path)
+        if self.max_entries is None or name is None:
+            return
+        archive_paths = self.indexed.pop(name, [])
+        self.indexed[name] = archive_paths + [archive_path]
+        self.indexed_entries += len(self.archive_ifilenames[archive_path])
+        self._evict_cold(name)
+
+    def _index_removed(self, archive_path):
+        name = self._lazy_name(archive_path)
+        if name not in self.indexed:
+            return
+        archive_paths = [p for p in self.indexed[name] if p != archive_path]
+        if archive_paths:
+            self.indexed[name] = archive_paths
+        else:
+            self.indexed.pop(name)
+        self.indexed_entries -= len(self.archive_ifilenames[archive_path])
+
+    @_edits
+    def _evict_cold(self, keep):
+        for name in list(self.indexed):
+            if self.indexed_entries <= self.max_entries:
+                break
+            if name != keep and not self.pinned.get(name):
+                self._evict(name)
+
+    @_edits
+    def _evict(self, name):
+        # the index of every archive in the directory is dropped in one
+        # go, with the ArchiveFiles left in the pool to be reused.
+        archive_paths = self.indexed.pop(name)
+        for archive_path in archive_paths:
+            self.indexed_entries -= len(self.archive_ifilenames[archive_path])
+            self._unload_infolist(archive_path, prune=False)
+            for fentry in list(self.nested_archives):
+                if fentry.archive_path == archive_path:
+                    self.nested_archives.pop(fentry)
+        self._draft.pop(name, None)
+        for archive_path in archive_paths:
+            if not self._register_lazy(archive_path):
+                # no longer there.
+                self._pool_discard(archive_path)
+                self.archive_keys.pop(archive_path, None)
+        logger.info('evicted the index of `%s`', name)
+
+    def pin(self, path):
+        """
+        Keep the directory of archives containing path from being
+        evicted, e.g. while a file entry within is open, until unpin.
+        """
+
+        self.pinned[path.split('/', 1)[0]] += 1
+
+    def unpin(self, path):
+        name = path.split('/', 1)[0]
+        self.pinned[name] -= 1
+        if self.pinned[name] <= 0:
+            self.pinned.pop(name)
+            if (self.max_entries is not None and
+                    self.indexed_entries > self.max_entries):
+                # as it may have been kept over the limit.
+                self._evict_cold(None)
+
+    def _unload_nested(self, archive_path):
+        prefix = archive_path + NESTED_SEP
+        for fentry in list(self.nested_archives):
+            if (fentry.archive_path == archive_path or
+                    fentry.archive_path.startswith(prefix)):
+                self.nested_archives.pop(fentry)
+        for path in list(self.archive_pool):
+            if path.startswith(prefix):
+                self._pool_discard(path)
+
+    @_edits
     def _load_infolist(self, archive_path, infolist):
         self.archives[archive_path] = time()
         archive_name = basename(archive_path) + '/'
@@ -159,7 +493,8 @@ class DefaultMapper(object):
             # check the leftmost (oldest) item, pop from left
             return 0, deque.popleft
 
-    def _unload_infolist(self, archive_path):
+    @_edits
+    def _unload_infolist(self, archive_path, prune=True):
         # pop this out right away to mark this as to be pruned off.
         ifilenames = self.archive_ifilenames.pop(archive_path)
         index, pop = self._unload_functions()
@@ -200,7 +535,7 @@ class DefaultMapper(object):
             if frags:
                 all_frags.add(tuple(frags))
 
-            info = self._traverse(frags)
+            info = self._writable_dir(frags)
             if not info is None:
                 # The file's directory may not have been added to
                 # self.mapping, if its creation may have been blocked
@@ -228,55 +563,227 @@ class DefaultMapper(object):
             # will need more thought to do, given that files and dirs
             # are two different types.
 
-        # finally, purge all empty directories.  Yes this includes
-        # directories that may not be wholly owned by this archive.
+        # discard the date associated with this archive path too.
+        self.archives.pop(archive_path)
+        if prune:
+            self._prune(all_frags)
+        return all_frags
+
+    @_edits
+    def _prune(self, all_frags):
+        # purge all empty directories.  Yes this includes directories
+        # that may not be wholly owned by the unloaded archives.
         for frags in sorted(all_frags, key=lambda x: len(x)):
-            target = self._traverse(frags[:-1])
-            if target.get(frags[-1]) == {}:
+            target = self._writable_dir(frags[:-1])
+            if target is not None and target.get(frags[-1]) == {}:
                 target.pop(frags[-1])
 
-        # discard the date associated with this archive path too.
-        self.archives.pop(archive_path)
+    def _pool_put(self, archive_path, af):
+        old = self.archive_pool.pop(archive_path, None)
+        if old is not None and old is not af:
+            old.close()
+        self.archive_pool[archive_path] = af
+        while len(self.archive_pool) > self.pool_size:
+            self.archive_pool.popitem(last=False)[1].close()
+
+    def _pool_get(self, archive_path):
+        """
+        Return an open ArchiveFile for archive_path, which must not be
+        closed by the caller.
+        """
+
+        af = self.archive_pool.get(archive_path)
+        if af is None:
+            af = self._open_archive(archive_path)
+        self._pool_put(archive_path, af)
+        return af
+
+    def _open_archive(self, archive_path):
+        if NESTED_SEP not in archive_path:
+            return ArchiveFile(
+                archive_path, index_cache=self.index_cache,
+                block_cache=self.block_cache)
+        # read through the file entry of the archive containing it.
+        outer_path, ifilename = archive_path.rsplit(NESTED_SEP, 1)
+        view = self._pool_get(outer_path).open_view(ifilename, archive_path)
+        return ArchiveFile(
+            archive_path, index_cache=self.index_cache, source=view)
+
+    def _pool_discard(self, archive_path):
+        af = self.archive_pool.pop(archive_path, None)
+        if af is not None:
+            af.close()
+
+    def prepare_archive(self, archive_path, errors=None):
+        """
+        Open the archive identified by archive_path and read the
+        information of all its file entries without modifying the
+        mapping, such that this may be done away from the thread that
+        serves it.  Return the result to be passed to load_archive, or
+        None if the archive could not be opened, with the reason added
+        to the errors dict by archive_path if provided.
+        """
 
-    def load_archive(self, archive_path):
+        try:
+            # before it is opened, such that a modification made while
+            # it is read will be detected.
+            key = self._archive_key(archive_path)
+            af = ArchiveFile(
+                archive_path, index_cache=self.index_cache,
+                block_cache=self.block_cache)
+            try:
+                return af, list(af.iterinfo()), key
+            except:
+                af.close()
+                raise
+        except Exception as e:
+            reason = self._load_failed(archive_path, e)
+            if errors is not None:
+                errors[archive_path] = reason
+        return None
+
+    def load_archive(self, archive_path, prepared=None):
         """
         Load an archive file identified by archive_path into the
-        mapping.
+        mapping, using the result of prepare_archive if provided.
+        Without the latter, the archive is only registered if lazy.
         """
 
+        if prepared is None and self._register_lazy(archive_path):
+            return True
+        return self._load_archive(archive_path, prepared)
+
+    @_edits
+    def _load_archive(self, archive_path, prepared=None):
+        lazy = self._draft.get(self._lazy_name(archive_path))
+        if isinstance(lazy, LazyArchive):
+            # as the entries of these are merged with this one.
+            self._load_lazy(lazy)
         try:
-            with ArchiveFile(archive_path) as af:
-                self._load_infolist(archive_path, af.infolist())
+            if prepared is None:
+                key = self._archive_key(archive_path)
+                af = ArchiveFile(
+                    archive_path, index_cache=self.index_cache,
+                    block_cache=self.block_cache)
+                try:
+                    # read completely before anything is mapped, such
+                    # that a bad central directory leaves nothing behind.
+                    infolist = list(af.iterinfo())
+                except:
+                    af.close()
+                    raise
+            else:
+                af, infolist, key = prepared
+            try:
+                self._load_infolist(archive_path, infolist)
+            except:
+                af.close()
+                if archive_path in self.archive_ifilenames:
+                    # roll back the entries mapped so far.
+                    self._unload_infolist(archive_path)
+                raise
+            self._pool_put(archive_path, af)
+            if key is not None:
+                self.archive_keys[archive_path] = key
             logger.info('loaded `%s`', archive_path)
-            return True
-        except BadArchiveFile:
-            logger.warning(
-                '`%s` appears to be an invalid archive file', archive_path)
-        except UnsupportedArchiveFile as e:
-            logger.warning('`%s` %s', archive_path, str(e))
-        except FileNotFoundError:
-            logger.warning(
-                '`%s` does not exist.', archive_path)
-        except:
+        except Exception as e:
+            self._load_failed(archive_path, e)
+            return False
+        self._index_added(archive_path)
+        return True
+
+    def _load_failed(self, archive_path, e):
+        # called from the handler of the exception; return the reason.
+        if isinstance(e, BadArchiveFile):
+            reason = 'appears to be an invalid archive file'
+        elif isinstance(e, UnsupportedArchiveFile):
+            reason = str(e)
+        elif isinstance(e, FileNotFoundError):
+            reason = 'does not exist.'
+        else:
             logger.exception('Exception')
-        return False
+            return 'failed to load: %s' % e
+        logger.warning('`%s` %s', archive_path, reason)
+        return reason
 
     def unload_archive(self, archive_path):
-        self._unload_infolist(archive_path)
-        logger.info('unloaded `%s`', archive_path)
+        self.unload_archives([archive_path])
+
+    @_edits
+    def unload_archives(self, archive_paths):
+        """
+        Unload the archives identified by archive_paths, with the empty
+        directories left behind by all of them removed in one pass.
+        """
+
+        all_frags = set()
+        for archive_path in archive_paths:
+            if archive_path not in self.archives:
+                # e.g. already unloaded as it was removed.
+                continue
+            if archive_path in self.lazy_archives:
+                self._unregister_lazy(archive_path)
+                logger.info('unloaded `%s`', archive_path)
+                continue
+            self._index_removed(archive_path)
+            all_frags.update(
+                self._unload_infolist(archive_path, prune=False))
+            self._unload_nested(archive_path)
+            self._pool_discard(archive_path)
+            self.archive_keys.pop(archive_path, None)
+            logger.info('unloaded `%s`', archive_path)
+        self._prune(all_frags)
+
+    def _archive_key(self, archive_path):
+        if is_url(archive_path):
+            return None
+        try:
+            return file_key(stat(archive_path))
+        except OSError:
+            return None
+
+    def reload_modified(self, archive_path):
+        """
+        Reload the outermost archive of archive_path should it have been
+        modified or replaced since it was loaded (or unload it, if it was
+        removed), discarding its blocks from the block_cache.  This only
+        costs a stat otherwise.  Return whether it was reloaded.
+        """
+
+        outer_path = archive_path.split(NESTED_SEP, 1)[0]
+        key = self.archive_keys.get(outer_path)
+        if key is None:
+            return False
+        current = self._archive_key(outer_path)
+        if current == key:
+            return False
+        logger.info('`%s` was modified since it was loaded', outer_path)
+        # replaced in one step, as far as readers are concerned.
+        with self.edit():
+            self.unload_archive(outer_path)
+            if self.block_cache is not None:
+                self.block_cache.discard(key)
+            if current is not None:
+                self.load_archive(outer_path)
+        return True
 
     def open(self, path):
         info = self.traverse(path)
-        if info is None:
+        if not isinstance(info, tuple):
             return
+        if self.reload_modified(info[0]):
+            # the entry may have moved or no longer exist.
+            info = self.traverse(path)
+            if not isinstance(info, tuple):
+                return False
         archive_path, filename, _ = info
         # it is possible to return those values, but given that the
         # underlying files can change, or that new stack comes in, it's
         # best not to directly expose this.
         try:
-            with ArchiveFile(archive_path) as zf:
-                # zf does remain open because of this.
-                return (id(info), zf.open(filename))
+            return (
+                self._identify(path, info),
+                self._pool_get(archive_path).open(filename))
         except BadArchiveFile:  # pragma: no cover
             logger.warning(
                 '`%s` became an invalid archive file', archive_path)
@@ -288,6 +795,45 @@ class DefaultMapper(object):
             logger.exception('Exception')
         return False
 
+    def _identify(self, path, info):
+        # identifies this version of the file entry at path.
+        return id(info)
+
+    def stamp(self, path):
+        """
+        Return a stamp that identifies the current version of the file
+        entry at path, as a tuple of the modification time and size of
+        its archive (or the stamp of its HttpFile, for a URL) followed by
+        the CRC of the entry.
+        """
+
+        info = self.traverse(path)
+        if not isinstance(info, tuple):
+            return None
+        archive_path, filename, _ = info
+        try:
+            # nested archives are identified by the outermost archive
+            # along with the CRC of the file entry.
+            outer_path = archive_path.split(NESTED_SEP, 1)[0]
+            if is_url(outer_path):
+                stamp = self._pool_get(outer_path).source.stamp
+                if stamp is None:
+                    return None
+            else:
+                st = stat(outer_path)
+                stamp = (st.st_mtime, st.st_size)
+            info = self._pool_get(archive_path).getinfo(filename)
+            # not every archive format has a CRC for its entries.
+            crc = getattr(info, 'CRC', None)
+            return tuple(stamp) + (crc,)
+        except (OSError, FileNotFoundError, BadArchiveFile, KeyError):
+            logger.warning(
+                'unable to generate stamp for `%s` in `%s`',
+                filename, archive_path)
+        except:  # pragma: no cover
+            logger.exception('Exception')
+        return None
+
     def readfile(self, path):
         """
         Return the complete file with information contained in path.
@@ -300,9 +846,8 @@ class DefaultMapper(object):
         info = self.traverse(path)
 
         archive_filename, filename, _ = info
-        with ArchiveFile(archive_filename) as af:
-            with af.open(filename) as f:
-                return f.read()
+        with self._pool_get(archive_filename).open(filename) as f:
+            return f.read()
 
     def readdir(self, path):
         """
@@ -312,4 +857,8 @@ class DefaultMapper(object):
         info = self.traverse(path)
         if not isinstance(info, dict):
             return []
+        if isinstance(info, NestedArchive):
+            self._load_nested(info)
+        elif isinstance(info, LazyArchive):
+            info = self._load_lazy(info)
         return list(info.keys())
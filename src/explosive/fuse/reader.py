@@ -0,0 +1,1006 @@
+import bz2
+import importlib
+import os
+import zlib
+import struct
+from binascii import hexlify
+from binascii import unhexlify
+from bisect import bisect_right
+from collections import namedtuple
+from logging import getLogger
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    try:
+        # python 2 with the backport installed.
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from .exception import BadArchiveFile
+
+logger = getLogger(__name__)
+
+# Implementations of the zlib interface that may be used for inflating,
+# by name and module, in order of preference.
+inflate_backends = (
+    ('isal', 'isal.isal_zlib'),
+    ('zlib-ng', 'zlib_ng.zlib_ng'),
+    ('zlib', 'zlib'),
+)
+
+# Environment variable for selecting the inflate backend by name.
+INFLATE_BACKEND_ENV = 'EXPLOSIVE_FUSE_INFLATE'
+
+inflate = zlib
+inflate_backend = 'zlib'
+# whether the decompressors of the backend can be copied, as required
+# for checkpoints.
+inflate_copyable = True
+inflate_errors = (zlib.error,)
+
+
+def set_inflate_backend(name=None):
+    """
+    Select the inflate backend by name, or the first available one from
+    inflate_backends if name is None or 'auto'.  Return the name of the
+    selected backend; ValueError is raised if the named one is unknown
+    or not available.
+    """
+
+    global inflate, inflate_backend, inflate_copyable, inflate_errors
+    modules = dict(inflate_backends)
+    if name in (None, '', 'auto'):
+        candidates = [backend for backend, _ in inflate_backends]
+    elif name in modules:
+        candidates = [name]
+    else:
+        raise ValueError('unknown inflate backend: %r' % name)
+
+    for candidate in candidates:
+        try:
+            module = importlib.import_module(modules[candidate])
+        except ImportError:
+            continue
+        inflate = module
+        inflate_backend = candidate
+        inflate_copyable = hasattr(module.decompressobj(), 'copy')
+        inflate_errors = (zlib.error, module.error)
+        return candidate
+    raise ValueError('inflate backend %r is not available' % name)
+
+
+def decompressobj(wbits, copyable=False):
+    """
+    Return a decompressor from the selected inflate backend, or from
+    zlib if one that can be copied is required but the backend does not
+    support that.
+    """
+
+    if copyable and not inflate_copyable:
+        return zlib.decompressobj(wbits)
+    return inflate.decompressobj(wbits)
+
+
+try:
+    set_inflate_backend(os.environ.get(INFLATE_BACKEND_ENV))
+except ValueError as e:
+    logger.warning('%s; selecting the first available one', e)
+    set_inflate_backend()
+
+# Shared pool of workers for decompressing independent blocks, created
+# on demand such that it's not lost when daemonized.
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPool(cpu_count())
+    return _pool
+
+
+def _bits_to_int(data):
+    return int(hexlify(data) or b'0', 16)
+
+
+def _int_to_bytes(value, length):
+    return unhexlify('%0*x' % (length * 2, value))
+
+# The fixed portion of a zip local file header.
+_local_header = struct.Struct('<4s2B4HL2L2H')
+_local_header_magic = b'PK\003\004'
+
+
+def zip_data_offset(source, header_offset):
+    """
+    Return the offset to the start of the data of the zip file entry
+    with its local file header at header_offset.
+    """
+
+    header = source.pread(_local_header.size, header_offset)
+    if len(header) != _local_header.size:
+        raise BadArchiveFile('truncated local file header')
+    fields = _local_header.unpack(header)
+    if fields[0] != _local_header_magic:
+        raise BadArchiveFile('bad magic number for local file header')
+    return header_offset + _local_header.size + fields[-2] + fields[-1]
+
+
+class EntryReader(object):
+    """
+    Base file object for the decompressed data of a file entry, which
+    must be read sequentially unless random_access is supported;
+    otherwise seeking backwards starts decompressing from the beginning
+    again.
+
+    The source must provide ``pread(size, offset)``, and the compressed
+    data is the range of compress_size bytes starting at offset.  An
+    index produced by a previous reader for the same file entry (if the
+    subclass produces one) may be provided to avoid regenerating it.
+    """
+
+    random_access = False
+
+    def __init__(self, source, offset, compress_size, file_size, crc=None,
+            index=None):
+        self.source = source
+        self.start = offset
+        self.end = offset + compress_size
+        self.file_size = file_size
+        # verify against this once all data was read, if provided.
+        self.crc = crc
+        self.index = index
+        self.closed = False
+        self._reset()
+
+    def _reset(self):
+        # position of the decompressed data.
+        self.pos = 0
+        # position of the next unread compressed data in source.
+        self.src_pos = self.start
+        self.running_crc = 0
+
+    def _decompress(self, size):
+        """
+        Return up to size bytes of the decompressed data, must be
+        implemented by subclasses.
+        """
+
+        raise NotImplementedError
+
+    def _update(self, data):
+        self.pos += len(data)
+        if self.crc is None:
+            return
+        self.running_crc = inflate.crc32(data, self.running_crc)
+        if self.pos == self.file_size and (
+                self.running_crc & 0xffffffff) != self.crc:
+            raise BadArchiveFile('bad CRC-32 for file entry')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.file_size - self.pos
+        size = min(size, self.file_size - self.pos)
+        if size <= 0:
+            return b''
+        chunks = []
+        while size > 0:
+            data = self._decompress(size)
+            if not data:
+                break
+            self._update(data)
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def readinto(self, buffer):
+        """
+        Decompress directly into the buffer, return the number of bytes
+        that were written into it.
+        """
+
+        view = memoryview(buffer)
+        size = min(len(view), self.file_size - self.pos)
+        written = 0
+        while written < size:
+            data = self._decompress(size - written)
+            if not data:
+                break
+            self._update(data)
+            view[written:written + len(data)] = data
+            written += len(data)
+        return written
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.file_size
+
+        if self.random_access:
+            self._reset()
+            self.pos = max(0, min(offset, self.file_size))
+            if self.pos:
+                # unable to verify a partial read.
+                self.crc = None
+            return self.pos
+
+        if offset < self.pos:
+            self._reset()
+        while self.pos < offset:
+            if not self.read(min(offset - self.pos, 1 << 20)):
+                break
+        return self.pos
+
+    def pread(self, size, offset):
+        """
+        Read from the decompressed data, such that this can be used as
+        the source of another reader (e.g. for a tar stream).
+        """
+
+        self.seek(offset)
+        return self.read(size)
+
+    def close(self):
+        self.closed = True
+        self.source = None
+
+
+class StoredReader(EntryReader):
+    """
+    Reader for file entries that were stored without compression, which
+    are read directly from the source.
+    """
+
+    random_access = True
+
+    def _decompress(self, size):
+        offset = self.start + self.pos
+        data = self.source.pread(min(size, self.end - offset), offset)
+        if not data and offset < self.end:
+            raise BadArchiveFile('truncated file entry')
+        return data
+
+
+_gzip_magic = b'\x1f\x8b'
+
+
+class InflateCheckpoints(object):
+    """
+    Points from which decompression of a deflate stream can be resumed,
+    spaced by at least interval bytes of decompressed data, along with
+    the size of the decompressed stream once that becomes known.
+
+    As the state of the decompressor cannot be serialized, these only
+    exist in memory and are produced as the stream is decompressed,
+    possibly by multiple threads.
+    """
+
+    def __init__(self, interval=1 << 23):
+        self.interval = interval
+        self.lock = Lock()
+        # tuples of decompressed position, compressed offset and a copy
+        # of the decompressor at that point.
+        self.points = []
+        self.positions = []
+        self.size = None
+
+    def add(self, pos, offset, decompressor):
+        if self.positions and pos < self.positions[-1] + self.interval:
+            return
+        if not hasattr(decompressor, 'copy'):
+            # from an inflate backend that does not support this.
+            return
+        with self.lock:
+            if self.positions and pos < self.positions[-1] + self.interval:
+                return
+            self.points.append((pos, offset, decompressor.copy()))
+            self.positions.append(pos)
+
+    def find(self, pos):
+        """
+        Return the closest point at or before pos, or None.
+        """
+
+        i = bisect_right(self.positions, pos) - 1
+        if i < 0:
+            return None
+        return self.points[i]
+
+
+class InflateReader(EntryReader):
+    """
+    Reader for deflated file entries, which feeds large reads of the
+    compressed data into a raw inflate decompressor and only produce as
+    much output as requested.
+
+    If InflateCheckpoints is provided as the index, checkpoints are
+    recorded into it and seeking resumes from the closest one.  The
+    selected inflate backend is used, unless checkpoints are required
+    and its decompressors cannot be copied.
+    """
+
+    # size of each read of compressed data from the source.
+    chunk_size = 1 << 20
+    # size of compressed data fed into the decompressor per call, kept
+    # small as the unconsumed input gets copied on every call.
+    feed_size = 1 << 16
+    # raw deflate stream.
+    wbits = -zlib.MAX_WBITS
+
+    def _reset(self):
+        super(InflateReader, self)._reset()
+        self.decompressor = decompressobj(
+            self.wbits, copyable=self.index is not None)
+        self.buffer = memoryview(b'')
+        self.buffer_pos = 0
+
+    @property
+    def consumed(self):
+        """
+        Offset in source of the compressed data that has yet to be fed
+        into the decompressor.
+        """
+
+        return self.src_pos - len(self.buffer) + self.buffer_pos
+
+    def _decompress(self, size):
+        decompressor = self.decompressor
+        while not decompressor.eof:
+            if self.buffer_pos >= len(self.buffer):
+                if self.src_pos >= self.end:
+                    # drain the output still held by the decompressor,
+                    # as flush would return all of it regardless of size.
+                    data = decompressor.decompress(b'', size)
+                    if not data:
+                        return b''
+                else:
+                    self.buffer = memoryview(self.source.pread(
+                        min(self.chunk_size, self.end - self.src_pos),
+                        self.src_pos))
+                    if not len(self.buffer):
+                        raise BadArchiveFile('truncated compressed data')
+                    self.buffer_pos = 0
+                    self.src_pos += len(self.buffer)
+                    continue
+            else:
+                feed = self.buffer[
+                    self.buffer_pos:self.buffer_pos + self.feed_size]
+                data = decompressor.decompress(feed, size)
+                self.buffer_pos += len(feed) - len(
+                    decompressor.unconsumed_tail) - len(
+                    decompressor.unused_data)
+            if data:
+                if self.index is not None:
+                    self.index.add(
+                        self.pos + len(data), self.consumed, decompressor)
+                return data
+        return b''
+
+    def seek(self, offset, whence=0):
+        if self.index is None:
+            return super(InflateReader, self).seek(offset, whence)
+
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.file_size
+
+        point = self.index.find(offset)
+        if offset < self.pos or (point and point[0] > self.pos):
+            self._reset()
+            if point:
+                self.pos, self.src_pos, decompressor = point
+                self.decompressor = decompressor.copy()
+                # unable to verify a partial read.
+                self.crc = None
+
+        while self.pos < offset:
+            if not self.read(min(offset - self.pos, 1 << 20)):
+                break
+        return self.pos
+
+
+class GzipReader(InflateReader):
+    """
+    Reader for a gzip stream (including ones with multiple members) with
+    random access, which is achieved by resuming decompression from the
+    nearest checkpoint.  The CRC of every member is verified by zlib,
+    with any errors raised as BadArchiveFile.
+
+    The file_size may be provided as sys.maxsize if not known.
+    """
+
+    wbits = 16 + zlib.MAX_WBITS
+
+    def _reset(self):
+        if self.index is None:
+            self.index = InflateCheckpoints()
+        super(GzipReader, self)._reset()
+
+    def _decompress(self, size):
+        while True:
+            try:
+                data = super(GzipReader, self)._decompress(size)
+            except inflate_errors as e:
+                # e.g. incorrect CRC or length of a member.
+                raise BadArchiveFile(str(e))
+            if data:
+                return data
+            if not self.decompressor.eof:
+                raise BadArchiveFile('truncated compressed data')
+            offset = self.consumed
+            if offset >= self.end or self.source.pread(
+                    2, offset) != _gzip_magic:
+                # end of the stream, or trailing data such as padding.
+                self.index.size = self.file_size = self.pos
+                return b''
+            # start of the next member.
+            self.decompressor = decompressobj(self.wbits, copyable=True)
+
+    def seek(self, offset, whence=0):
+        if whence == 2 and self.index.size is None:
+            # size only known after reaching the end.
+            while self.read(1 << 20):
+                pass
+        return super(GzipReader, self).seek(offset, whence)
+
+
+# bzip2 streams consist of blocks that can be decompressed independently,
+# with each of them and the end of the stream marked by these magic
+# numbers, which are not aligned to bytes.
+_bz2_block_magic = 0x314159265359
+_bz2_eos_magic = 0x177245385090
+_bz2_magic_bits = 48
+_bz2_magic_mask = (1 << _bz2_magic_bits) - 1
+
+
+def _bz2_needles(magic):
+    # for every bit offset the magic may start at within a byte, the 5
+    # bytes that are fully covered by the magic.
+    for shift in range(8):
+        value = magic << (8 - shift)
+        yield shift, _int_to_bytes(value, 7)[1:6]
+
+
+def bz2_scan(source, start, end, window=1 << 23):
+    """
+    Scan the bzip2 stream in the range of source from start to end and
+    return a sorted list of (start, end) bit offsets of every block,
+    relative to start.
+    """
+
+    markers = set()
+    for magic, kind in ((_bz2_block_magic, True), (_bz2_eos_magic, False)):
+        needles = list(_bz2_needles(magic))
+        # overlap windows such that a magic is never split.
+        for pos in range(start, end, window - 7):
+            data = source.pread(min(window, end - pos), pos)
+            for shift, needle in needles:
+                i = data.find(needle, 1)
+                while i != -1:
+                    candidate = _bits_to_int(data[i - 1:i + 6])
+                    if len(data[i - 1:i + 6]) == 7 and (
+                            candidate >> (8 - shift) & _bz2_magic_mask
+                            ) == magic:
+                        markers.add(((pos - start + i - 1) * 8 + shift, kind))
+                    i = data.find(needle, i + 1)
+
+    markers = sorted(markers)
+    return [
+        (bit, next_bit)
+        for (bit, is_block), (next_bit, _) in zip(markers, markers[1:])
+        if is_block
+    ]
+
+
+def bz2_block_decompress(source, start, bounds):
+    """
+    Decompress the block with bounds in bits relative to start in the
+    source, by wrapping it into a complete stream of its own.
+    """
+
+    first, last = bounds
+    nbits = last - first
+    offset = first // 8
+    length = (last + 7) // 8 - offset
+    value = _bits_to_int(source.pread(length, start + offset))
+    # discard the bits that follow the block, then the ones preceding.
+    value >>= length * 8 - (last - offset * 8)
+    value &= (1 << nbits) - 1
+    # the combined CRC of a stream with a single block is the CRC of
+    # that block, which follows its magic number.
+    crc = (value >> (nbits - _bz2_magic_bits - 32)) & 0xffffffff
+    value = (((value << _bz2_magic_bits) | _bz2_eos_magic) << 32) | crc
+    nbits += _bz2_magic_bits + 32
+    padding = -nbits % 8
+    # the largest block size is always declared, which is accepted for
+    # blocks of any size.
+    return bz2.decompress(
+        b'BZh9' + _int_to_bytes(value << padding, (nbits + padding) // 8))
+
+
+class Bzip2BlockMap(object):
+    """
+    Location of every block within a bzip2 stream, along with the size
+    of each once decompressed, which becomes known as they are.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.sizes = [None] * len(bounds)
+        # decompressed offsets of the leading blocks with known sizes,
+        # followed by the end of the last of those blocks.
+        self.offsets = [0]
+
+    @property
+    def known(self):
+        return len(self.offsets) - 1
+
+    def set_size(self, i, size):
+        self.sizes[i] = size
+        while self.known < len(self.sizes) and (
+                self.sizes[self.known] is not None):
+            self.offsets.append(self.offsets[-1] + self.sizes[self.known])
+
+    def locate(self, pos):
+        """
+        Return the index of the block containing pos, or None if that is
+        not yet known.
+        """
+
+        i = bisect_right(self.offsets, pos) - 1
+        if i < self.known:
+            return i
+        return None
+
+    def merge(self, i):
+        """
+        Merge the block at i with the following one, for when the latter
+        was a false match of the magic number.
+        """
+
+        self.bounds[i:i + 2] = [(self.bounds[i][0], self.bounds[i + 1][1])]
+        self.sizes[i:i + 2] = [None]
+        del self.offsets[i + 1:]
+
+
+class Bzip2Reader(EntryReader):
+    """
+    Reader for bzip2 compressed file entries that provides random access
+    through its block map, with the blocks following the one being read
+    decompressed concurrently using the shared pool of workers.
+    """
+
+    random_access = True
+    # number of blocks decompressed ahead, including the current one.
+    readahead = cpu_count()
+
+    def __init__(self, *a, **kw):
+        super(Bzip2Reader, self).__init__(*a, **kw)
+        if self.index is None:
+            self.index = Bzip2BlockMap(
+                bz2_scan(self.source, self.start, self.end))
+        # pending results by block index, and the current block.
+        self.blocks = {}
+        self.current = None, None
+
+    def _fetch(self, i):
+        if self.current[0] == i:
+            return self.current[1]
+
+        block_map = self.index
+        pool = get_pool()
+        for j in list(self.blocks):
+            if j < i:
+                # no longer needed.
+                self.blocks.pop(j)
+
+        while True:
+            for j in range(i, min(i + self.readahead, len(block_map.bounds))):
+                if j not in self.blocks:
+                    self.blocks[j] = pool.apply_async(bz2_block_decompress, (
+                        self.source, self.start, block_map.bounds[j]))
+            try:
+                data = self.blocks.pop(i).get()
+                break
+            except (IOError, OSError, ValueError, EOFError):
+                if i + 1 >= len(block_map.bounds):
+                    raise BadArchiveFile('invalid bzip2 data')
+                logger.debug('merging bzip2 block %d with the next', i)
+                block_map.merge(i)
+                # indexes of the results no longer match.
+                self.blocks = {}
+
+        block_map.set_size(i, len(data))
+        self.current = i, data
+        return data
+
+    def _decompress(self, size):
+        block_map = self.index
+        i = block_map.locate(self.pos)
+        while i is None:
+            if block_map.known >= len(block_map.bounds):
+                return b''
+            # sizes of blocks up to pos are needed to locate it.
+            self._fetch(block_map.known)
+            i = block_map.locate(self.pos)
+        data = self._fetch(i)
+        offset = self.pos - block_map.offsets[i]
+        return data[offset:offset + size]
+
+    def close(self):
+        super(Bzip2Reader, self).close()
+        self.blocks = {}
+        self.current = None, None
+
+
+# xz streams are made up of blocks that can be decompressed on their own,
+# with their locations and sizes recorded in the index that precedes the
+# footer of the stream.
+_xz_magic = b'\xfd7zXZ\x00'
+_xz_footer_magic = b'YZ'
+_xz_header = struct.Struct('<6s2sL')
+_xz_footer = struct.Struct('<LL2s2s')
+
+XzBlock = namedtuple('XzBlock', [
+    'offset', 'unpadded_size', 'uncompressed_offset', 'uncompressed_size',
+    'flags'])
+
+
+def _xz_crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def _xz_varint(value):
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _xz_read_varint(data, pos):
+    value = 0
+    for i in range(9):
+        if pos + i >= len(data):
+            break
+        byte = bytearray(data[pos + i:pos + i + 1])[0]
+        value |= (byte & 0x7f) << (7 * i)
+        if not byte & 0x80:
+            return value, pos + i + 1
+    raise BadArchiveFile('invalid xz index')
+
+
+def _xz_stream_blocks(source, start, pos):
+    # parse the stream that ends at pos, return the offset where it
+    # starts along with its blocks.
+    footer = source.pread(_xz_footer.size, pos - _xz_footer.size)
+    crc, backward_size, flags, magic = _xz_footer.unpack(footer)
+    if magic != _xz_footer_magic or _xz_crc32(footer[4:10]) != crc:
+        raise BadArchiveFile('invalid xz stream footer')
+
+    index_size = (backward_size + 1) * 4
+    index_start = pos - _xz_footer.size - index_size
+    index = source.pread(index_size, index_start)
+    if (index_start < start or index[:1] != b'\0' or _xz_crc32(
+            index[:-4]) != struct.unpack('<L', index[-4:])[0]):
+        raise BadArchiveFile('invalid xz index')
+
+    count, i = _xz_read_varint(index, 1)
+    records = []
+    for _ in range(count):
+        unpadded_size, i = _xz_read_varint(index, i)
+        uncompressed_size, i = _xz_read_varint(index, i)
+        records.append((unpadded_size, uncompressed_size))
+
+    stream_start = index_start - _xz_header.size - sum(
+        (unpadded_size + 3) & ~3 for unpadded_size, _ in records)
+    if stream_start < start:
+        raise BadArchiveFile('invalid xz index')
+    magic, header_flags, crc = _xz_header.unpack(
+        source.pread(_xz_header.size, stream_start))
+    if (magic != _xz_magic or header_flags != flags or
+            _xz_crc32(header_flags) != crc):
+        raise BadArchiveFile('invalid xz stream header')
+
+    blocks = []
+    offset = stream_start + _xz_header.size
+    for unpadded_size, uncompressed_size in records:
+        blocks.append((offset, unpadded_size, uncompressed_size))
+        offset += (unpadded_size + 3) & ~3
+    return stream_start, flags, blocks
+
+
+def xz_index(source, start, end):
+    """
+    Parse the indexes of the xz streams in the range of source from
+    start to end, return a list of XzBlock for every block within.
+    """
+
+    streams = []
+    pos = end
+    while pos > start:
+        if source.pread(4, pos - 4) == b'\0\0\0\0':
+            # stream padding.
+            pos -= 4
+            continue
+        if pos - start < _xz_header.size + _xz_footer.size:
+            raise BadArchiveFile('invalid xz stream')
+        pos, flags, blocks = _xz_stream_blocks(source, start, pos)
+        streams.append((flags, blocks))
+
+    results = []
+    uncompressed_offset = 0
+    for flags, blocks in reversed(streams):
+        for offset, unpadded_size, uncompressed_size in blocks:
+            results.append(XzBlock(
+                offset, unpadded_size, uncompressed_offset,
+                uncompressed_size, flags))
+            uncompressed_offset += uncompressed_size
+    return results
+
+
+def _xz_block_stream(block):
+    # the header and the index and footer of a stream made up of only
+    # the block, to be put around its data.
+    flags = block.flags
+    index = b''.join([
+        b'\0', _xz_varint(1), _xz_varint(block.unpadded_size),
+        _xz_varint(block.uncompressed_size)])
+    index += b'\0' * (-len(index) % 4)
+    index += struct.pack('<L', _xz_crc32(index))
+    backward_size = struct.pack('<L', len(index) // 4 - 1)
+    header = b''.join([
+        _xz_magic, flags, struct.pack('<L', _xz_crc32(flags))])
+    footer = b''.join([
+        index, struct.pack('<L', _xz_crc32(backward_size + flags)),
+        backward_size, flags, _xz_footer_magic])
+    return header, footer
+
+
+def xz_block_decompress(source, block):
+    """
+    Decompress the block by wrapping it into a complete stream of its
+    own, such that its check is verified by lzma.
+    """
+
+    header, footer = _xz_block_stream(block)
+    stream = b''.join([
+        header,
+        source.pread((block.unpadded_size + 3) & ~3, block.offset),
+        footer,
+    ])
+    try:
+        return lzma.decompress(stream, format=lzma.FORMAT_XZ)
+    except lzma.LZMAError as e:
+        raise BadArchiveFile(str(e))
+
+
+class XzBlockMap(object):
+    """
+    Location of every block within xz streams, as recorded by their
+    indexes.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.offsets = [block.uncompressed_offset for block in blocks]
+        self.size = sum(block.uncompressed_size for block in blocks)
+
+    def locate(self, pos):
+        """
+        Return the index of the block containing pos, or None if it is
+        beyond the end.
+        """
+
+        if pos >= self.size:
+            return None
+        return bisect_right(self.offsets, pos) - 1
+
+
+class XzReader(EntryReader):
+    """
+    Reader for xz streams made up of multiple blocks, which provides
+    random access by only decompressing the blocks covering what is
+    read.  For sequential reads, and reads that span multiple blocks,
+    the blocks are decompressed concurrently using the shared pool of
+    workers.
+    """
+
+    random_access = True
+    # number of blocks decompressed ahead for sequential reads,
+    # including the current one.
+    readahead = cpu_count()
+    # as every block is held in memory, larger blocks are streamed.
+    max_block_size = 1 << 28
+
+    def __init__(self, *a, **kw):
+        super(XzReader, self).__init__(*a, **kw)
+        if self.index is None:
+            self.index = XzBlockMap(
+                xz_index(self.source, self.start, self.end))
+        # pending results by block index, and the current block.
+        self.blocks = {}
+        self.current = None, None
+
+    def _fetch(self, i, last):
+        if self.current[0] == i:
+            return self.current[1]
+
+        blocks = self.index.blocks
+        if self.current[0] == i - 1:
+            # sequential read.
+            last = max(last, i + self.readahead - 1)
+        last = min(last, len(blocks) - 1)
+
+        pool = get_pool()
+        for j in list(self.blocks):
+            if j < i or j > last:
+                self.blocks.pop(j)
+        for j in range(i, last + 1):
+            if j not in self.blocks:
+                self.blocks[j] = pool.apply_async(
+                    xz_block_decompress, (self.source, blocks[j]))
+        data = self.blocks.pop(i).get()
+        if len(data) != blocks[i].uncompressed_size:
+            raise BadArchiveFile('invalid xz block size')
+        self.current = i, data
+        return data
+
+    def _decompress(self, size):
+        index = self.index
+        i = index.locate(self.pos)
+        if i is None:
+            return b''
+        last = index.locate(min(self.pos + size, index.size) - 1)
+        data = self._fetch(i, last)
+        offset = self.pos - index.offsets[i]
+        return data[offset:offset + size]
+
+    def close(self):
+        super(XzReader, self).close()
+        self.blocks = {}
+        self.current = None, None
+
+
+class XzStreamReader(EntryReader):
+    """
+    Reader for xz streams with blocks that are too few or too large to
+    be held in memory, which streams through one block at a time, every
+    block wrapped into a stream of its own as per xz_block_decompress.
+
+    Seeking starts decompressing from the beginning of the block with
+    the position, as located by the index of the streams (see xz_index).
+    Within a block the state of the decompressor cannot be copied for
+    use as checkpoints, so seeking backwards within a block (e.g. the
+    only one of a stream produced by a single threaded ``xz``) still
+    starts again from the beginning of that block.
+    """
+
+    chunk_size = 1 << 20
+
+    def _reset(self):
+        super(XzStreamReader, self)._reset()
+        self.decompressor = None
+        # the index of the current block, and the input to be fed into
+        # the decompressor before and after the rest of its data.
+        self.block = None
+        self.pending = b''
+        self.footer = b''
+        self.block_end = self.start
+
+    def _index(self):
+        if self.index is None:
+            self.index = XzBlockMap(
+                xz_index(self.source, self.start, self.end))
+        return self.index
+
+    def _start(self, i):
+        block = self.index.blocks[i]
+        self.pending, self.footer = _xz_block_stream(block)
+        self.decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+        self.block = i
+        self.pos = block.uncompressed_offset
+        self.src_pos = block.offset
+        self.block_end = block.offset + ((block.unpadded_size + 3) & ~3)
+
+    def _input(self):
+        if self.pending:
+            data, self.pending = self.pending, b''
+            return data
+        if self.src_pos >= self.block_end:
+            data, self.footer = self.footer, b''
+            return data
+        data = self.source.pread(
+            min(self.chunk_size, self.block_end - self.src_pos), self.src_pos)
+        if not data:
+            raise BadArchiveFile('truncated compressed data')
+        self.src_pos += len(data)
+        return data
+
+    def _decompress(self, size):
+        index = self._index()
+        while True:
+            decompressor = self.decompressor
+            if decompressor is None or decompressor.eof:
+                i = index.locate(self.pos)
+                if i is None:
+                    return b''
+                if i == self.block:
+                    # the block ended before the size in the index.
+                    raise BadArchiveFile('invalid xz block size')
+                self._start(i)
+                continue
+            data = b''
+            if decompressor.needs_input:
+                data = self._input()
+                if not data:
+                    raise BadArchiveFile('truncated compressed data')
+            try:
+                result = decompressor.decompress(data, size)
+            except lzma.LZMAError as e:
+                raise BadArchiveFile(str(e))
+            if result:
+                return result
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.file_size
+        offset = max(0, min(offset, self.file_size))
+
+        i = self._index().locate(offset)
+        if i is None:
+            # at the end.
+            self._reset()
+            self.pos = offset
+            self.crc = None
+        elif offset < self.pos or i != self.block:
+            self._reset()
+            self._start(i)
+            if self.pos:
+                # unable to verify a partial read.
+                self.crc = None
+
+        while self.pos < offset:
+            if not self.read(min(offset - self.pos, 1 << 20)):
+                break
+        return self.pos
+
+
+def xz_reader(source, offset, compress_size, file_size, crc=None,
+        index=None):
+    """
+    Return a reader for the xz stream, with random access through its
+    blocks where possible.
+    """
+
+    if index is None:
+        index = XzBlockMap(xz_index(source, offset, offset + compress_size))
+    if len(index.blocks) > 1 and max(
+            block.uncompressed_size for block in index.blocks
+            ) <= XzReader.max_block_size:
+        cls = XzReader
+    else:
+        cls = XzStreamReader
+    return cls(source, offset, compress_size, file_size, crc, index=index)
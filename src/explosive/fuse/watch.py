@@ -0,0 +1,260 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+from collections import OrderedDict
+from errno import EAGAIN
+from errno import EINTR
+from errno import ENOSYS
+from logging import getLogger
+from os.path import join
+from time import time
+
+try:
+    from os import fsdecode
+except ImportError:  # pragma: no cover
+    # Assume python 2, where the names are kept as bytes.
+    fsdecode = str
+
+from .archive import is_archive
+
+logger = getLogger(__name__)
+
+# as per <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_event = struct.Struct('iIII')
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):  # pragma: no cover
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+def _check(result):
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+
+class Inotify(object):
+    """
+    Minimal binding to the inotify API of Linux, through ctypes.
+    """
+
+    # size of the buffer for reading events.
+    buffer_size = 1 << 16
+
+    def __init__(self):
+        if _libc is None:  # pragma: no cover
+            raise OSError(ENOSYS, 'inotify is not available')
+        self.fd = _check(_libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def add_watch(self, path, mask):
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8', 'surrogateescape')
+        return _check(_libc.inotify_add_watch(self.fd, path, mask))
+
+    def read(self, timeout=None):
+        """
+        Return the list of events as tuples of the watch descriptor,
+        mask, cookie and name, waiting up to timeout for them.
+        """
+
+        try:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return []
+            data = os.read(self.fd, self.buffer_size)
+        except (OSError, select.error) as e:
+            if e.args[0] in (EAGAIN, EINTR):
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos + _event.size <= len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, pos)
+            pos += _event.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            events.append((wd, mask, cookie, fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class DirectoryWatcher(object):
+    """
+    Keep the archives within a directory loaded, using inotify such that
+    the directory is only listed once at the start (or should the event
+    queue of the kernel overflow), no matter how many archives are
+    within.
+
+    The events are collected until none has arrived for debounce
+    seconds (or max_delay seconds passed since the first of them), then
+    applied as a batch where only the last event for every archive
+    counts.  Every archive that was written or moved into the directory
+    is opened by prepare (e.g. ``DefaultMapper.prepare_archive``) from
+    the thread of this watcher, then apply (e.g.
+    ``ExplosiveFUSE.apply_changes``) is called with a list of the paths
+    along with the results, with None for the archives that were
+    removed, such that they are applied as a single change.  Batches of
+    more than batch_size archives are applied in parts, as every
+    prepared archive is kept open until it is applied.
+    """
+
+    mask = (
+        IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE |
+        IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    def __init__(self, path, prepare, apply, debounce=0.5, max_delay=5.0,
+            batch_size=1024):
+        self.path = path
+        self.prepare = prepare
+        self.apply = apply
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        # the (mtime, size) of the archives loaded by this, by path.
+        self.loaded = {}
+        # number of batches applied.
+        self.batches = 0
+        self.stopping = False
+        self.inotify = Inotify()
+        self.inotify.add_watch(path, self.mask)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        # the thread stops once it is done with the current change, as
+        # waiting on it here could deadlock with apply.
+        self.stopping = True
+        if self.thread.ident is None:
+            self.inotify.close()
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _scan(self, pending):
+        # reconcile the archives in the directory with the loaded ones.
+        paths = set(
+            join(self.path, name) for name in os.listdir(self.path)
+            if is_archive(name))
+        for path in sorted(paths):
+            if self.loaded.get(path) != self._stat(path):
+                pending[path] = True
+        for path in sorted(set(self.loaded) - paths):
+            pending[path] = False
+
+    def _apply(self, pending):
+        changes = []
+        for path, present in pending.items():
+            if self.stopping:
+                break
+            stat = self._stat(path) if present else None
+            prepared = self.prepare(path) if stat is not None else None
+            if prepared is None and path not in self.loaded:
+                continue
+            changes.append((path, prepared, stat))
+            if len(changes) >= self.batch_size:
+                self._apply_changes(changes)
+                changes = []
+        if self.stopping:
+            for _, prepared, _ in changes:
+                if prepared is not None:
+                    prepared[0].close()
+            return
+        self._apply_changes(changes)
+        self.batches += 1
+
+    def _apply_changes(self, changes):
+        if not changes:
+            return
+        self.apply([(path, prepared) for path, prepared, _ in changes])
+        for path, prepared, stat in changes:
+            if prepared is None:
+                self.loaded.pop(path, None)
+            else:
+                self.loaded[path] = stat
+
+    def _run(self):
+        try:
+            self._watch()
+        except Exception:
+            logger.exception('stopped watching `%s`', self.path)
+        finally:
+            self.inotify.close()
+
+    def _watch(self):
+        # the archives already within are applied as the first batch.
+        pending = OrderedDict()
+        self._scan(pending)
+        self._apply(pending)
+        pending = OrderedDict()
+        # when the first and the last of the pending changes arrived.
+        first = last = time()
+        while not self.stopping:
+            timeout = self.debounce
+            if pending:
+                timeout = max(0, min(
+                    last + self.debounce, first + self.max_delay) - time())
+            events = self.inotify.read(timeout)
+            now = time()
+            for wd, mask, cookie, name in events:
+                if not pending:
+                    first = now
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning(
+                        'events for `%s` were lost; listing it again',
+                        self.path)
+                    self._scan(pending)
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    logger.warning(
+                        '`%s` is no longer watched as it was removed',
+                        self.path)
+                    self.stopping = True
+                    break
+                elif name and is_archive(name):
+                    path = join(self.path, name)
+                    # only the last event for every archive counts.
+                    pending.pop(path, None)
+                    pending[path] = bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))
+                else:
+                    continue
+                last = now
+            if pending and (
+                    now >= last + self.debounce or
+                    now >= first + self.max_delay):
+                logger.info(
+                    'applying %d change(s) to `%s`', len(pending), self.path)
+                self._apply(pending)
+                pending = OrderedDict()
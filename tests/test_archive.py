@@ -1,17 +1,60 @@
+import bz2
+import gzip
+import hashlib
 import unittest
+import tempfile
+import shutil
+import tarfile
+import zipfile
+import zlib
+import os
+from io import BytesIO
 from zipfile import ZipFile
 from zipfile import ZipInfo
+from zipfile import ZIP_STORED
 from os.path import dirname
 from os.path import join
 
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import threading
+
 try:
     from unrar.rarfile import RarFile
+    from explosive.fuse._rarfile import SolidRarScheduler
 except (ImportError, LookupError, OSError) as e:
     RarFile = None
 
+from explosive.fuse._compressed import CompressedFile
+from explosive.fuse._tarfile import IndexedTarFile
 from explosive.fuse.archive import ArchiveFile
+from explosive.fuse.archive import CachedFile
 from explosive.fuse.archive import FileNotFoundError
+from explosive.fuse.archive import HttpFile
+from explosive.fuse.archive import LocalFile
+from explosive.fuse.archive import SplitFile
+from explosive.fuse.archive import ZipRecord
+from explosive.fuse.archive import iter_zip_central
+from explosive.fuse.archive import FADV_SEQUENTIAL
+from explosive.fuse.archive import archive_type
+from explosive.fuse.archive import open_local
+from explosive.fuse.archive import split_volumes
+from explosive.fuse.cache import BlockCache
+from explosive.fuse.cache import IndexCache
+from explosive.fuse.exception import BadArchiveFile
+from explosive.fuse.mapper import DefaultMapper
 from explosive.fuse.exception import UnsupportedArchiveFile
+from explosive.fuse.reader import GzipReader
+from explosive.fuse.reader import XzReader
+from explosive.fuse.reader import XzStreamReader
+from explosive.fuse.reader import lzma
 
 path = lambda p: join(dirname(__file__), 'data', p)
 
@@ -48,7 +91,7 @@ class ArchiveFileZipTestCase(unittest.TestCase):
             'file1', 'file2', 'file3', 'file4', 'file5', 'file6'])
 
         # ensure it's closed outside of the `with` context.
-        self.assertIsNone(af.archive_file.fp)
+        self.assertTrue(af.closed)
 
     def test_load_archive_file_zip2(self):
         demo2 = path('demo2.zip')
@@ -62,6 +105,242 @@ class ArchiveFileZipTestCase(unittest.TestCase):
         ])
 
 
+class LocalFileTestCase(unittest.TestCase):
+
+    def test_file_object(self):
+        target = path('demo1.zip')
+        with open(target, 'rb') as fd:
+            raw = fd.read()
+
+        lf = LocalFile(target)
+        self.assertEqual(lf.size, len(raw))
+        self.assertEqual(lf.read(4), raw[:4])
+        self.assertEqual(lf.tell(), 4)
+        self.assertEqual(lf.seek(-22, 2), len(raw) - 22)
+        self.assertEqual(lf.read(), raw[-22:])
+        self.assertEqual(lf.read(), b'')
+        self.assertEqual(lf.seek(2), 2)
+        self.assertEqual(lf.seek(2, 1), 4)
+        self.assertEqual(lf.read(4), raw[4:8])
+        with self.assertRaises(IOError):
+            lf.seek(-1)
+        # pread leaves the position alone.
+        self.assertEqual(lf.pread(10, 30), raw[30:40])
+        self.assertEqual(lf.tell(), 8)
+        # advise should accept unaligned and out of bound ranges.
+        lf.advise(FADV_SEQUENTIAL, 30, 1 << 20)
+        lf.advise(FADV_SEQUENTIAL, 1 << 20)
+        lf.close()
+        self.assertTrue(lf.closed)
+
+    def test_open_local(self):
+        self.assertIsNone(open_local(path('empty.txt')))
+        self.assertIsNone(open_local(path('missing.zip')))
+        self.assertTrue(isinstance(open_local(path('demo1.zip')), LocalFile))
+
+
+class CachedFileTestCase(unittest.TestCase):
+
+    def test_file_object(self):
+        target = path('demo1.zip')
+        with open(target, 'rb') as fd:
+            raw = fd.read()
+
+        cache = BlockCache(1 << 20, block_size=64)
+        cf = CachedFile(target, cache)
+        self.assertEqual(cf.size, len(raw))
+        self.assertEqual(cf.read(4), raw[:4])
+        self.assertEqual(list(cache.blocks), [(cf.key, 0)])
+        # runs of missing blocks around the cached ones.
+        cf.pread(10, 130)
+        self.assertEqual(cf.pread(300, 10), raw[10:310])
+        self.assertEqual(
+            sorted(i for _, i in cache.blocks), [0, 1, 2, 3, 4])
+        self.assertEqual(cf.pread(1 << 20, 300), raw[300:])
+        self.assertEqual(cf.pread(10, len(raw)), b'')
+        self.assertEqual(cache.used, len(raw))
+        misses = cache.misses
+        self.assertEqual(cf.seek(-22, 2), len(raw) - 22)
+        self.assertEqual(cf.read(), raw[-22:])
+        self.assertEqual(cache.misses, misses)
+
+        cf.advise(FADV_SEQUENTIAL, 30, 1 << 20)
+        cf.advise(FADV_SEQUENTIAL, 1 << 20)
+        # reopened as required.
+        cf.close()
+        self.assertIsNone(cf.fd)
+        cf.advise(FADV_SEQUENTIAL)
+        self.assertEqual(cf.pread(4, 0), raw[:4])
+
+    def test_shared_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        target = join(tmpdir, 'demo.zip')
+        shutil.copy(path('demo3.zip'), target)
+        cache = BlockCache(1 << 20)
+        with ArchiveFile(target, block_cache=cache) as af:
+            self.assertTrue(isinstance(af.source, CachedFile))
+            self.assertEqual(af.open('demo/dir1/file1').read(), (
+                b'b026324c6904b2a9cb4b88d6d61c81d1\n'))
+        misses = cache.misses
+        with ArchiveFile(target, block_cache=cache) as af:
+            self.assertEqual(af.open('demo/dir1/file1').read(), (
+                b'b026324c6904b2a9cb4b88d6d61c81d1\n'))
+        self.assertEqual(cache.misses, misses)
+
+        # a modified archive is not served from the cached blocks.
+        with ZipFile(target, 'w') as zf:
+            zf.writestr('demo/dir1/file1', b'modified')
+        with ArchiveFile(target, block_cache=cache) as af:
+            self.assertEqual(af.open('demo/dir1/file1').read(), b'modified')
+
+        with self.assertRaises(FileNotFoundError):
+            ArchiveFile(path('missing.zip'), block_cache=cache)
+
+
+class SplitFileTestCase(unittest.TestCase):
+
+    volumes = [path('split.z01'), path('split.z02'), path('split.zip')]
+
+    def test_split_volumes(self):
+        self.assertEqual(split_volumes(path('split.zip')), self.volumes)
+        self.assertEqual(split_volumes(path('demo1.zip')), [])
+
+    def test_file_object(self):
+        raw = b''
+        for volume in self.volumes:
+            with open(volume, 'rb') as fd:
+                raw += fd.read()
+
+        sf = SplitFile(self.volumes)
+        sf.max_open = 2
+        self.assertEqual(sf.size, len(raw))
+        self.assertEqual(sf.volume_offsets, [0, 65536, 131072])
+        self.assertEqual(sf.read(4), b'PK\x07\x08')
+        # reads spanning volumes.
+        self.assertEqual(sf.pread(10, 65530), raw[65530:65540])
+        self.assertEqual(sf.pread(1 << 20, 65530), raw[65530:])
+        self.assertEqual(sf.pread(10, len(raw)), b'')
+        self.assertEqual(sorted(sf.files), [1, 2])
+        self.assertEqual(sf.pread(4, 0), b'PK\x07\x08')
+        # the least recently used volume was closed.
+        self.assertEqual(sorted(sf.files), [0, 2])
+        sf.close()
+        self.assertEqual(len(sf.files), 0)
+        self.assertEqual(sf.pread(4, 65536), raw[65536:65540])
+
+    def test_archive_file(self):
+        data = b''.join(
+            hashlib.sha1(str(i).encode()).digest() for i in range(8000))
+        with ArchiveFile(path('split.zip')) as af:
+            self.assertTrue(isinstance(af.source, SplitFile))
+            self.assertEqual(sorted(
+                (info.filename, info.file_size) for info in af.infolist()), [
+                ('demo/', 0),
+                ('demo/data', 160000),
+                ('demo/hello', 1200),
+            ])
+            self.assertEqual(af.open('demo/data').read(), data)
+            self.assertEqual(
+                af.open('demo/hello').read(), b'hello world\n' * 100)
+            # only the volumes with the central directory and the file
+            # entry were opened.
+            af.source.close()
+            self.assertEqual(af.open('demo/hello').read(3), b'hel')
+            self.assertEqual(sorted(af.source.files), [0, 2])
+
+    def test_missing_volume(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        for volume in self.volumes[1:]:
+            shutil.copy(volume, tmpdir)
+        with self.assertRaises(BadArchiveFile):
+            ArchiveFile(join(tmpdir, 'split.zip'))
+
+
+class ArchiveFileMappedTestCase(unittest.TestCase):
+
+    def test_zip_mapped(self):
+        with ArchiveFile(path('demo2.zip')) as af:
+            self.assertTrue(isinstance(af.source, LocalFile))
+            # zipfile is not needed.
+            self.assertIsNone(af.archive_file)
+            fp = af.open('demo/file1')
+        # entries remain readable after the archive file is closed.
+        self.assertEqual(fp.read(), b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+
+    def test_zip_truncated(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        target = join(tmpdir, 'demo.zip')
+        with ZipFile(target, 'w') as zf:
+            zf.writestr('stored', b'0' * 65536, compress_type=ZIP_STORED)
+        with ArchiveFile(target) as af:
+            fp = af.open('stored')
+            self.assertEqual(fp.read(10), b'0' * 10)
+            # rewritten in place while the entry is open.
+            with open(target, 'r+b') as fd:
+                fd.truncate(100)
+            with self.assertRaises(BadArchiveFile):
+                fp.read()
+
+    def test_zip_bad(self):
+        with self.assertRaises(BadArchiveFile):
+            ArchiveFile(path('bad.zip'))
+
+
+class EntryViewTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.target = join(self.tmpdir, 'outer.zip')
+        self.data = b''.join(
+            str(i).encode('ascii') + b'\n' for i in range(100000))
+        with ZipFile(self.target, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('data', self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_view(self):
+        with ArchiveFile(self.target) as af:
+            view = af.open_view('data', 'outer.zip/data')
+            self.assertIsNotNone(af.entry_index['data'])
+            crc = af.getinfo('data').CRC
+        self.assertEqual(view.name, 'outer.zip/data')
+        self.assertEqual(view.stamp[2], crc)
+        self.assertEqual(view.size, len(self.data))
+        view.block_size = 1000
+        view.max_blocks = 4
+        self.assertEqual(view.pread(10, 500000), self.data[500000:500010])
+        self.assertEqual(view.pread(2500, 999), self.data[999:3499])
+        self.assertEqual(len(view.blocks), 4)
+        self.assertEqual(list(view.blocks)[-1], 3)
+        self.assertEqual(view.pread(10, len(self.data) - 5), self.data[-5:])
+        self.assertEqual(view.pread(10, len(self.data)), b'')
+        view.seek(-10, 2)
+        self.assertEqual(view.read(), self.data[-10:])
+        view.close()
+        self.assertTrue(view.closed)
+
+    def test_nested_source(self):
+        inner = join(self.tmpdir, 'inner.zip')
+        with ZipFile(inner, 'w') as zf:
+            zf.writestr('file1', b'file1')
+        with ZipFile(self.target, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.write(inner, 'inner.zip')
+            zf.writestr('inner.rar', b'')
+
+        with ArchiveFile(self.target) as af:
+            view = af.open_view('inner.zip', 'outer.zip/inner.zip')
+            with ArchiveFile('outer.zip/inner.zip', source=view) as nested:
+                self.assertEqual(nested.open('file1').read(), b'file1')
+
+            view = af.open_view('inner.rar', 'outer.zip/inner.rar')
+            with self.assertRaises(UnsupportedArchiveFile):
+                ArchiveFile('outer.zip/inner.rar', source=view)
+
+
 @unittest.skipIf(RarFile is None, reason='unrar not found')
 class ArchiveFileRarTestCase(unittest.TestCase):
 
@@ -96,3 +375,587 @@ class ArchiveFileRarTestCase(unittest.TestCase):
             'demo/', 'demo/file1', 'demo/file2', 'demo/file3',
             'demo/file4', 'demo/file5', 'demo/file6',
         ])
+
+    def test_open_streaming(self):
+        with ArchiveFile(path('demo2.rar')) as af:
+            fp = af.open('demo/file1')
+            self.assertEqual(fp.read(3), b'b02')
+            self.assertEqual(fp.tell(), 3)
+            # seeking backwards restarts the extraction.
+            self.assertEqual(fp.seek(1), 1)
+            self.assertEqual(fp.read(), b'026324c6904b2a9cb4b88d6d61c81d1\n')
+            self.assertEqual(fp.read(1), b'')
+            fp.close()
+            with self.assertRaises(ValueError):
+                fp.read(1)
+
+            # closing before the data is consumed stops the worker.
+            fp = af.open('demo/file2')
+            worker = fp.worker
+            fp.close()
+            worker.join(1)
+            self.assertFalse(worker.is_alive())
+
+            with self.assertRaises(KeyError):
+                af.open('demo/nosuchfile')
+
+    def test_open_solid(self):
+        with ArchiveFile(path('demo1.rar')) as af:
+            rf = af.archive_file
+            self.assertFalse(rf.solid)
+            # treated as solid, with room for a single entry in cache.
+            rf.solid = True
+            rf.scheduler = SolidRarScheduler(rf, cache_size=40)
+            scheduler = rf.scheduler
+            self.assertEqual(
+                af.open('file3').read(),
+                b'6d7fce9fee471194aa8b5b6e47267f03\n')
+            self.assertEqual(scheduler.passes, 1)
+            self.assertEqual(scheduler.position, 3)
+            # the pass continues forward for the entries ahead of it.
+            self.assertEqual(
+                af.open('file5').read(),
+                b'1dcca23355272056f04fe8bf20edfce0\n')
+            self.assertEqual(scheduler.passes, 1)
+            self.assertEqual(list(scheduler.cache), ['file5'])
+            self.assertEqual(
+                af.open('file5').read(),
+                b'1dcca23355272056f04fe8bf20edfce0\n')
+            # only the ones behind require another pass.
+            self.assertEqual(
+                af.open('file1').read(),
+                b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+            self.assertEqual(scheduler.passes, 2)
+            worker = scheduler.worker
+
+        worker.join(1)
+        self.assertFalse(worker.is_alive())
+        self.assertTrue(scheduler.closed)
+
+
+class ZipCentralDirectoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertRecordsMatch(self, target, offset=0):
+        with ZipFile(target) as zf:
+            infolist = zf.infolist()
+        with ArchiveFile(target) as af:
+            records = af.infolist()
+        self.assertEqual(len(records), len(infolist))
+        for record, info in zip(records, infolist):
+            self.assertEqual(record.filename, info.filename)
+            self.assertEqual(record.file_size, info.file_size)
+            self.assertEqual(record.compress_size, info.compress_size)
+            self.assertEqual(record.compress_type, info.compress_type)
+            self.assertEqual(record.header_offset, info.header_offset)
+            self.assertEqual(record.CRC, info.CRC)
+            self.assertEqual(record.flag_bits, info.flag_bits)
+            date, time = record.mtime >> 16, record.mtime & 0xffff
+            self.assertEqual((
+                (date >> 9) + 1980, (date >> 5) & 0xf, date & 0x1f,
+                time >> 11, (time >> 5) & 0x3f, (time & 0x1f) * 2,
+            ), info.date_time)
+        return records
+
+    def test_records(self):
+        for name in ('demo1.zip', 'demo2.zip', 'demo3.zip', 'demo4.zip'):
+            self.assertRecordsMatch(path(name))
+
+    def test_iterinfo(self):
+        with ArchiveFile(path('demo1.zip')) as af:
+            result = af.iterinfo()
+            self.assertFalse(isinstance(result, list))
+            self.assertEqual(
+                [record.filename for record in result],
+                ['file1', 'file2', 'file3', 'file4', 'file5', 'file6'])
+
+    def test_getinfo(self):
+        with ArchiveFile(path('demo2.zip')) as af:
+            record = af.getinfo('demo/file3')
+            self.assertTrue(isinstance(record, ZipRecord))
+            self.assertEqual(record.filename, 'demo/file3')
+            self.assertEqual(record.file_size, 33)
+            with self.assertRaises(KeyError):
+                af.getinfo('demo/nothing')
+
+    def test_unicode_and_long_names(self):
+        target = join(self.tmpdir, 'names.zip')
+        names = [u'こんにちは', 'x' * 2000, 'plain']
+        with ZipFile(target, 'w') as zf:
+            for name in names:
+                zf.writestr(name, name.encode('utf8'))
+        records = self.assertRecordsMatch(target)
+        self.assertEqual([r.filename for r in records], names)
+        with ArchiveFile(target) as af:
+            self.assertEqual(af.getinfo('x' * 2000).file_size, 2000)
+            self.assertEqual(
+                af.open(names[0]).read(), names[0].encode('utf8'))
+
+    def test_small_window(self):
+        with ArchiveFile(path('demo3.zip')) as af:
+            expected = [r for _, r in iter_zip_central(
+                af.source, af.central)]
+            results = [r for _, r in iter_zip_central(
+                af.source, af.central, window=64)]
+        self.assertEqual(results, expected)
+
+    def test_zip64(self):
+        target = join(self.tmpdir, 'zip64.zip')
+        limits = zipfile.ZIP64_LIMIT, zipfile.ZIP_FILECOUNT_LIMIT
+        # force zip64 structures to be written for small archives.
+        zipfile.ZIP64_LIMIT, zipfile.ZIP_FILECOUNT_LIMIT = 16, 2
+        try:
+            with ZipFile(target, 'w') as zf:
+                for i in range(5):
+                    zf.writestr('file%d' % i, b'data %d' % i * 10)
+        finally:
+            zipfile.ZIP64_LIMIT, zipfile.ZIP_FILECOUNT_LIMIT = limits
+
+        with open(target, 'rb') as fd:
+            self.assertIn(b'PK\x06\x06', fd.read())
+        self.assertRecordsMatch(target)
+        with ArchiveFile(target) as af:
+            self.assertEqual(af.central[2], 5)
+            self.assertEqual(af.open('file4').read(), b'data 4' * 10)
+
+    def test_prepended(self):
+        target = join(self.tmpdir, 'sfx.zip')
+        with open(target, 'wb') as fd:
+            fd.write(b'#!/bin/sh\nexit 0\n')
+            with open(path('demo2.zip'), 'rb') as src:
+                fd.write(src.read())
+        self.assertRecordsMatch(target)
+        with ArchiveFile(target) as af:
+            self.assertEqual(af.central[3], 17)
+            self.assertEqual(
+                af.open('demo/file1').read(),
+                b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+
+    def test_fallback_zipfile(self):
+        target = join(self.tmpdir, 'lzma.zip')
+        with ZipFile(target, 'w') as zf:
+            zf.writestr('lzma', b'lzma data', compress_type=zipfile.ZIP_LZMA)
+        with ArchiveFile(target) as af:
+            self.assertEqual(af.open('lzma').read(), b'lzma data')
+            self.assertTrue(isinstance(af.archive_file, ZipFile))
+        self.assertIsNone(af.archive_file.fp)
+
+    def test_bad_central_directory(self):
+        target = join(self.tmpdir, 'bad.zip')
+        with open(path('demo1.zip'), 'rb') as fd:
+            data = bytearray(fd.read())
+        with ArchiveFile(path('demo1.zip')) as af:
+            offset = af.central[0]
+        data[offset:offset + 4] = b'PKXX'
+        with open(target, 'wb') as fd:
+            fd.write(data)
+        with ArchiveFile(target) as af:
+            with self.assertRaises(BadArchiveFile):
+                af.infolist()
+
+    def test_multiple_disks(self):
+        target = join(self.tmpdir, 'disks.zip')
+        with open(path('demo1.zip'), 'rb') as fd:
+            data = bytearray(fd.read())
+        offset = data.rfind(b'PK\x05\x06')
+        data[offset + 4:offset + 6] = b'\x01\x00'
+        with open(target, 'wb') as fd:
+            fd.write(data)
+        with self.assertRaises(BadArchiveFile):
+            ArchiveFile(target)
+
+
+class ArchiveFileTarTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.data = b''.join(
+            str(i).encode('ascii') + b'\n' for i in range(200000))
+        cls.files = {
+            'dir/file1': b'file1 content\n',
+            'dir/file2': cls.data,
+            'empty': b'',
+        }
+        for name, mode in (('test.tar', 'w'), ('test.tar.gz', 'w:gz'),
+                           ('test.tgz', 'w:gz'), ('test.tar.xz', 'w:xz')):
+            with tarfile.open(join(cls.tmpdir, name), mode) as tf:
+                for filename in ('./dir', 'dir/file1', 'dir/file2', 'empty'):
+                    info = tarfile.TarInfo(filename)
+                    if filename == './dir':
+                        info.type = tarfile.DIRTYPE
+                        tf.addfile(info)
+                        continue
+                    info.size = len(cls.files[filename])
+                    tf.addfile(info, BytesIO(cls.files[filename]))
+                info = tarfile.TarInfo('link')
+                info.type = tarfile.SYMTYPE
+                info.linkname = 'empty'
+                tf.addfile(info)
+
+        # multiple blocks, by concatenating streams.
+        with open(join(cls.tmpdir, 'test.tar'), 'rb') as fd:
+            data = fd.read()
+        with open(join(cls.tmpdir, 'multi.txz'), 'wb') as fd:
+            for i in range(0, len(data), 1 << 18):
+                fd.write(lzma.compress(data[i:i + (1 << 18)], preset=1))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_archive_type(self):
+        self.assertEqual(archive_type('/tmp/a.b/demo.tar.gz'), 'tar.gz')
+        self.assertEqual(archive_type('demo.tgz'), 'tgz')
+        self.assertEqual(archive_type('demo.1.tar'), 'tar')
+        self.assertEqual(archive_type('demo.zip'), 'zip')
+        self.assertEqual(archive_type('demo.txt'), 'txt')
+        self.assertEqual(
+            archive_type('http://example.com/a.b/demo.tar.gz?v=1.tar'),
+            'tar.gz')
+
+    def test_tar(self):
+        for name in ('test.tar', 'test.tar.gz', 'test.tgz', 'test.tar.xz',
+                     'multi.txz'):
+            with ArchiveFile(join(self.tmpdir, name)) as af:
+                self.assertEqual(
+                    [(i.filename, i.file_size) for i in af.infolist()],
+                    [('dir/', 0), ('dir/file1', 14),
+                     ('dir/file2', len(self.data)), ('empty', 0)])
+                for filename, content in self.files.items():
+                    self.assertEqual(af.open(filename).read(), content)
+                with self.assertRaises(KeyError):
+                    af.getinfo('link')
+
+    def test_tar_gz_random_access(self):
+        with ArchiveFile(join(self.tmpdir, 'test.tar.gz')) as af:
+            tf = af.archive_file
+            self.assertIs(tf.stream_reader, GzipReader)
+            self.assertIsNone(af.open('dir/file2').crc)
+            self.assertTrue(tf.stream_index.size > len(self.data))
+            tf.stream_index.interval = 1 << 16
+            reader = af.open('dir/file2')
+            reader.seek(1000000)
+            self.assertEqual(reader.read(10), self.data[1000000:1000010])
+            self.assertTrue(len(tf.stream_index.points) > 1)
+            # resumes from a checkpoint rather than from the start.
+            reader.seek(10)
+            self.assertEqual(reader.read(10), self.data[10:20])
+            reader = af.open('dir/file2')
+            reader.seek(900000)
+            self.assertEqual(reader.read(), self.data[900000:])
+
+    def test_tar_xz_blocks(self):
+        with ArchiveFile(join(self.tmpdir, 'multi.txz')) as af:
+            tf = af.archive_file
+            self.assertTrue(len(tf.stream_index.blocks) > 4)
+            reader = af.open('dir/file2')
+            self.assertTrue(isinstance(reader.source, XzReader))
+            reader.seek(1000000)
+            self.assertEqual(reader.read(10), self.data[1000000:1000010])
+
+        with ArchiveFile(join(self.tmpdir, 'test.tar.xz')) as af:
+            reader = af.open('dir/file2')
+            self.assertTrue(isinstance(reader.source, XzStreamReader))
+
+    def test_tar_index_cache(self):
+        index_cache = IndexCache(join(self.tmpdir, 'index'))
+        target = join(self.tmpdir, 'test.tar.gz')
+        with ArchiveFile(target, index_cache=index_cache) as af:
+            infolist = af.infolist()
+
+        def scan(self):
+            raise AssertionError('archive scanned again')
+
+        original, IndexedTarFile._scan = IndexedTarFile._scan, scan
+        try:
+            with ArchiveFile(target, index_cache=index_cache) as af:
+                self.assertEqual(af.infolist(), infolist)
+                self.assertEqual(
+                    af.open('dir/file2').read(), self.files['dir/file2'])
+                self.assertEqual(
+                    af.archive_file.stream_index.size,
+                    index_cache.load(target, (
+                        os.stat(target).st_mtime,
+                        os.stat(target).st_size))['size'])
+        finally:
+            IndexedTarFile._scan = original
+
+    def test_tar_bad(self):
+        with self.assertRaises(FileNotFoundError):
+            ArchiveFile(join(self.tmpdir, 'missing.tar'))
+
+        target = join(self.tmpdir, 'empty.tar')
+        open(target, 'wb').close()
+        with self.assertRaises(BadArchiveFile):
+            ArchiveFile(target)
+
+        target = join(self.tmpdir, 'bad.tar')
+        with open(target, 'wb') as fd:
+            fd.write(b'not a tar file' * 100)
+        with self.assertRaises(BadArchiveFile):
+            ArchiveFile(target)
+
+        # truncated compressed stream.
+        with open(join(self.tmpdir, 'test.tar.gz'), 'rb') as fd:
+            data = fd.read()
+        target = join(self.tmpdir, 'truncated.tar.gz')
+        with open(target, 'wb') as fd:
+            fd.write(data[:len(data) // 2])
+        with self.assertRaises(BadArchiveFile):
+            ArchiveFile(target)
+
+
+class CompressedFileTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.data = b''.join(
+            str(i).encode('ascii') + b'\n' for i in range(300000))
+        with gzip.open(join(cls.tmpdir, 'app.log.gz'), 'wb') as fd:
+            fd.write(cls.data)
+        with bz2.BZ2File(join(cls.tmpdir, 'app.log.bz2'), 'wb',
+                         compresslevel=1) as fd:
+            fd.write(cls.data)
+        with open(join(cls.tmpdir, 'app.log.xz'), 'wb') as fd:
+            fd.write(lzma.compress(cls.data[:1000000], preset=1))
+            fd.write(lzma.compress(cls.data[1000000:], preset=1))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_compressed(self):
+        for name in ('app.log.gz', 'app.log.bz2', 'app.log.xz'):
+            with ArchiveFile(join(self.tmpdir, name)) as af:
+                self.assertEqual(
+                    af.infolist(), [('app.log', len(self.data))])
+                reader = af.open('app.log')
+                self.assertEqual(reader.read(), self.data)
+                reader.seek(len(self.data) - 100)
+                self.assertEqual(reader.read(), self.data[-100:])
+                reader.seek(1000)
+                self.assertEqual(reader.read(10), self.data[1000:1010])
+                with self.assertRaises(KeyError):
+                    af.open('app.log.gz')
+
+    def test_gzip_index(self):
+        index_cache = IndexCache(join(self.tmpdir, 'gzip_index'))
+        target = join(self.tmpdir, 'app.log.gz')
+        with ArchiveFile(target, index_cache=index_cache) as af:
+            cf = af.archive_file
+            # produced by the first pass.
+            self.assertIsNone(cf.index_thread)
+            self.assertEqual(cf.stream_index.size, len(self.data))
+            self.assertTrue(len(cf.stream_index.points) > 0)
+            # the tail is read from the closest checkpoint.
+            reader = af.open('app.log')
+            reader.seek(len(self.data) - 10)
+            self.assertTrue(reader.src_pos > 0)
+            self.assertEqual(reader.read(), self.data[-10:])
+
+        # the size is reused, with the checkpoints produced again.
+        with ArchiveFile(target, index_cache=index_cache) as af:
+            cf = af.archive_file
+            self.assertEqual(af.infolist(), [('app.log', len(self.data))])
+            cf.index_thread.join()
+            self.assertEqual(cf.stream_index.size, len(self.data))
+            self.assertTrue(len(cf.stream_index.points) > 0)
+
+    def test_gzip_multiple_members(self):
+        # the trailer only has the size of the last member.
+        target = join(self.tmpdir, 'members.log.gz')
+        with gzip.open(target, 'wb') as fd:
+            fd.write(self.data)
+        with gzip.open(target, 'ab') as fd:
+            fd.write(b'tail\n')
+        with ArchiveFile(target) as af:
+            self.assertEqual(
+                af.infolist(), [('members.log', len(self.data) + 5)])
+            self.assertEqual(
+                af.open('members.log').read(), self.data + b'tail\n')
+
+    def test_bzip2_index_cache(self):
+        index_cache = IndexCache(join(self.tmpdir, 'index'))
+        target = join(self.tmpdir, 'app.log.bz2')
+        with ArchiveFile(target, index_cache=index_cache) as af:
+            sizes = af.archive_file.stream_index.sizes
+            self.assertTrue(len(sizes) > 1)
+
+        def scan(self):
+            raise AssertionError('archive scanned again')
+
+        original, CompressedFile._scan_bz2 = CompressedFile._scan_bz2, scan
+        try:
+            with ArchiveFile(target, index_cache=index_cache) as af:
+                block_map = af.archive_file.stream_index
+                self.assertEqual(block_map.sizes, sizes)
+                self.assertEqual(block_map.known, len(sizes))
+                self.assertEqual(af.open('app.log').read(), self.data)
+        finally:
+            CompressedFile._scan_bz2 = original
+
+    def test_bad(self):
+        target = join(self.tmpdir, 'bad.gz')
+        with open(target, 'wb') as fd:
+            fd.write(b'not compressed')
+        with self.assertRaises(BadArchiveFile):
+            ArchiveFile(target)
+
+        target = join(self.tmpdir, 'short.gz')
+        with open(target, 'wb') as fd:
+            fd.write(b'\x1f\x8b')
+        with self.assertRaises(BadArchiveFile):
+            ArchiveFile(target)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    # serves server.files, with support for single range requests unless
+    # server.ranges is False.
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *a):
+        pass
+
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"%d"' % self.server.version
+        status, start, end = 200, 0, len(data)
+        requested = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if requested and self.server.ranges and if_range in (None, etag):
+            first, last = requested.split('=', 1)[1].split('-')
+            status, start, end = 206, int(first), min(int(last) + 1, len(data))
+        self.server.requests.append(requested)
+        self.server.sent += end - start
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(end - start))
+        if status == 206:
+            self.send_header(
+                'Content-Range', 'bytes %d-%d/%d' % (start, end - 1, len(data)))
+        self.end_headers()
+        self.wfile.write(data[start:end])
+
+
+class RangeHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class HttpFileTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.entries = {}
+        stream = BytesIO()
+        with ZipFile(stream, 'w') as zf:
+            for i in range(8):
+                name = 'data/file%d' % i
+                data = b''.join(
+                    hashlib.sha1(str((i, j)).encode('ascii')).digest()
+                    for j in range(1600))
+                cls.entries[name] = data
+                zf.writestr(name, data)
+        cls.raw = stream.getvalue()
+
+    def setUp(self):
+        self.server = RangeHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server.files = {
+            '/demo.zip': self.raw,
+            '/demo.zip?token=1': self.raw,
+            '/demo.rar': self.raw,
+        }
+        self.server.ranges = True
+        self.server.version = 1
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.sent = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def test_archive(self):
+        cache = BlockCache(1 << 20, block_size=4096)
+        with ArchiveFile(self.url + 'demo.zip', block_cache=cache) as af:
+            self.assertTrue(isinstance(af.source, HttpFile))
+            self.assertEqual(
+                sorted(info.filename for info in af.infolist()),
+                sorted(self.entries))
+            # only the end of the archive for the central directory.
+            self.assertTrue(self.server.sent <= 3 * 4096)
+            sent = self.server.sent
+            self.assertEqual(
+                af.open('data/file3').read(), self.entries['data/file3'])
+            self.assertTrue(
+                self.server.sent - sent <= len(self.entries['data/file3'])
+                + 3 * 4096)
+            # served from the cache.
+            sent = self.server.sent
+            self.assertEqual(
+                af.open('data/file3').read(), self.entries['data/file3'])
+            self.assertEqual(self.server.sent, sent)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_mapper(self):
+        mapper = DefaultMapper()
+        url = self.url + 'demo.zip?token=1'
+        self.assertTrue(mapper.load_archive(url))
+        self.assertEqual(
+            mapper.readfile('data/file5'), self.entries['data/file5'])
+        crc = zlib.crc32(self.entries['data/file5']) & 0xffffffff
+        self.assertEqual(
+            mapper.stamp('data/file5'), ('"1"', len(self.raw), crc))
+
+    def test_file_object(self):
+        hf = HttpFile(
+            self.url + 'demo.zip', BlockCache(1 << 20, block_size=4096))
+        self.assertEqual(hf.size, len(self.raw))
+        self.assertEqual(hf.stamp, ('"1"', len(self.raw)))
+        self.assertEqual(hf.read(4), self.raw[:4])
+        self.assertEqual(hf.pread(1 << 20, 100), self.raw[100:])
+        self.assertEqual(hf.pread(10, len(self.raw)), b'')
+        # runs of missing blocks are fetched with a single request.
+        self.assertEqual(self.server.requests, [
+            'bytes=0-0',
+            'bytes=0-4095',
+            'bytes=4096-%d' % (len(self.raw) - 1),
+        ])
+        # connected again as required.
+        hf.close()
+        hf.block_cache.blocks.clear()
+        self.assertEqual(hf.pread(4, 4), self.raw[4:8])
+        self.assertEqual(self.server.connections, 2)
+
+    def test_modified(self):
+        hf = HttpFile(self.url + 'demo.zip')
+        self.server.version = 2
+        with self.assertRaises(BadArchiveFile):
+            hf.pread(4, 0)
+
+    def test_errors(self):
+        with self.assertRaises(FileNotFoundError):
+            ArchiveFile(self.url + 'missing.zip')
+        with self.assertRaises(UnsupportedArchiveFile):
+            ArchiveFile(self.url + 'demo.rar')
+        self.server.ranges = False
+        with self.assertRaises(UnsupportedArchiveFile):
+            ArchiveFile(self.url + 'demo.zip')
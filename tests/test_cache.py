@@ -0,0 +1,221 @@
+import unittest
+import tempfile
+import shutil
+import os
+from os.path import exists
+from os.path import join
+
+from explosive.fuse.cache import BlockCache
+from explosive.fuse.cache import IndexCache
+from explosive.fuse.cache import SpillCache
+from explosive.fuse.cache import SpillEntry
+
+
+class SpillEntryTestCase(unittest.TestCase):
+
+    def test_add_covers(self):
+        entry = SpillEntry('name', (1, 2, 3), 100)
+        self.assertTrue(entry.covers(0, 0))
+        self.assertFalse(entry.covers(0, 1))
+        self.assertEqual(entry.add(10, 20), 10)
+        self.assertTrue(entry.covers(10, 20))
+        self.assertTrue(entry.covers(12, 15))
+        self.assertFalse(entry.covers(5, 15))
+        self.assertFalse(entry.covers(15, 25))
+
+        self.assertEqual(entry.add(30, 40), 10)
+        self.assertEqual(entry.extents, [[10, 20], [30, 40]])
+        self.assertFalse(entry.covers(10, 40))
+
+        # filling in the gap merges everything.
+        self.assertEqual(entry.add(15, 35), 10)
+        self.assertEqual(entry.extents, [[10, 40]])
+        self.assertTrue(entry.covers(10, 40))
+
+        # adjacent ranges are merged, too.
+        self.assertEqual(entry.add(40, 50), 10)
+        self.assertEqual(entry.extents, [[10, 50]])
+        self.assertEqual(entry.add(0, 10), 10)
+        self.assertEqual(entry.extents, [[0, 50]])
+        self.assertEqual(entry.filled, 50)
+
+
+class SpillCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = join(self.tmpdir, 'spill')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_write(self):
+        cache = SpillCache(self.path, 1024)
+        entry = cache.acquire(('/tmp/demo.zip', 'file1'), (1, 2, 3), 10)
+        self.assertIsNone(cache.read(entry, 4, 0))
+        self.assertTrue(cache.write(entry, 0, b'0123'))
+        self.assertEqual(cache.read(entry, 4, 0), b'0123')
+        self.assertEqual(cache.read(entry, 2, 1), b'12')
+        self.assertIsNone(cache.read(entry, 4, 2))
+        self.assertTrue(cache.write(entry, 4, b'456789'))
+        # reads are clipped to the size of the entry.
+        self.assertEqual(cache.read(entry, 20, 6), b'6789')
+        self.assertEqual(cache.read(entry, 20, 10), b'')
+        self.assertEqual(cache.used, 10)
+        cache.release(entry)
+        self.assertIsNone(entry.fd)
+
+    def test_sparse(self):
+        cache = SpillCache(self.path, 1 << 30)
+        entry = cache.acquire(('/tmp/demo.zip', 'file1'), (1, 2, 3), 1 << 30)
+        cache.write(entry, (1 << 30) - 4, b'tail')
+        self.assertEqual(cache.read(entry, 4, (1 << 30) - 4), b'tail')
+        st = os.stat(join(self.path, entry.name))
+        self.assertEqual(st.st_size, 1 << 30)
+        self.assertTrue(st.st_blocks * 512 < (1 << 20))
+
+    def test_eviction(self):
+        cache = SpillCache(self.path, 16)
+        entry1 = cache.acquire(('/tmp/demo.zip', 'file1'), (1, 2, 3), 10)
+        entry2 = cache.acquire(('/tmp/demo.zip', 'file2'), (1, 2, 3), 10)
+        self.assertTrue(cache.write(entry1, 0, b'0123456789'))
+        # entry1 is in use, so nothing can be made available
+        self.assertFalse(cache.write(entry2, 0, b'0123456789'))
+        cache.release(entry1)
+        self.assertTrue(cache.write(entry2, 0, b'0123456789'))
+        self.assertEqual(list(cache.entries.keys()), [entry2.name])
+        self.assertFalse(exists(join(self.path, entry1.name)))
+        self.assertEqual(cache.used, 10)
+
+    def test_lru_order(self):
+        cache = SpillCache(self.path, 20)
+        entries = [
+            cache.acquire(('/tmp/demo.zip', name), (1, 2, 3), 10)
+            for name in ('file1', 'file2', 'file3')]
+        cache.write(entries[0], 0, b'0123456789')
+        cache.write(entries[1], 0, b'0123456789')
+        # file1 is now the most recently used.
+        cache.read(entries[0], 1, 0)
+        cache.release(entries[0])
+        cache.release(entries[1])
+        cache.write(entries[2], 0, b'0123456789')
+        self.assertEqual(
+            sorted(cache.entries.keys()),
+            sorted([entries[0].name, entries[2].name]))
+
+    def test_persist_and_validate(self):
+        key = ('/tmp/demo.zip', 'file1')
+        cache = SpillCache(self.path, 1024)
+        entry = cache.acquire(key, (1.5, 2, 3), 10)
+        cache.write(entry, 2, b'2345')
+        # stray files are removed on reload.
+        with open(join(self.path, 'stray'), 'w') as fd:
+            fd.write('stray')
+        cache.close()
+
+        cache = SpillCache(self.path, 1024)
+        self.assertFalse(exists(join(self.path, 'stray')))
+        self.assertEqual(cache.used, 4)
+        entry = cache.acquire(key, (1.5, 2, 3), 10)
+        self.assertEqual(cache.read(entry, 4, 2), b'2345')
+        cache.release(entry)
+        cache.close()
+
+        # archive changed.
+        cache = SpillCache(self.path, 1024)
+        entry = cache.acquire(key, (2.5, 2, 3), 10)
+        self.assertIsNone(cache.read(entry, 4, 2))
+        self.assertEqual(cache.used, 0)
+
+    def test_stale_in_use(self):
+        key = ('/tmp/demo.zip', 'file1')
+        cache = SpillCache(self.path, 1024)
+        entry = cache.acquire(key, (1, 2, 3), 10)
+        self.assertIsNone(cache.acquire(key, (1, 2, 4), 10))
+        self.assertIs(cache.acquire(key, (1, 2, 3), 10), entry)
+        self.assertEqual(entry.refs, 2)
+
+    def test_corrupted_index(self):
+        os.makedirs(self.path)
+        with open(join(self.path, 'index.json'), 'w') as fd:
+            fd.write('{')
+        with open(join(self.path, 'leftover'), 'w') as fd:
+            fd.write('leftover')
+        cache = SpillCache(self.path, 1024)
+        self.assertEqual(len(cache.entries), 0)
+        self.assertFalse(exists(join(self.path, 'leftover')))
+
+    def test_shrunk_max_size(self):
+        cache = SpillCache(self.path, 1024)
+        entry = cache.acquire(('/tmp/demo.zip', 'file1'), (1, 2, 3), 10)
+        cache.write(entry, 0, b'0123456789')
+        cache.close()
+
+        cache = SpillCache(self.path, 8)
+        self.assertEqual(len(cache.entries), 0)
+        self.assertEqual(cache.used, 0)
+
+
+class IndexCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = join(self.tmpdir, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_save_load(self):
+        cache = IndexCache(self.path)
+        self.assertIsNone(cache.load('/tmp/demo.tar', (1.5, 2)))
+        cache.save('/tmp/demo.tar', (1.5, 2), {'records': [['file1', 1, 2]]})
+        cache = IndexCache(self.path)
+        self.assertEqual(cache.load('/tmp/demo.tar', (1.5, 2)), {
+            'records': [['file1', 1, 2]]})
+        # archive changed.
+        self.assertIsNone(cache.load('/tmp/demo.tar', (2.5, 2)))
+        self.assertIsNone(cache.load('/tmp/other.tar', (1.5, 2)))
+
+    def test_corrupted(self):
+        cache = IndexCache(self.path)
+        cache.save('/tmp/demo.tar', (1.5, 2), {})
+        with open(cache._filename('/tmp/demo.tar'), 'w') as fd:
+            fd.write('{')
+        self.assertIsNone(cache.load('/tmp/demo.tar', (1.5, 2)))
+
+
+class BlockCacheTestCase(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = BlockCache(10, block_size=4)
+        self.assertIsNone(cache.get(('file', 0)))
+        cache.put(('file', 0), b'0123')
+        self.assertIn(('file', 0), cache)
+        self.assertEqual(cache.get(('file', 0)), b'0123')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # replacing a block.
+        cache.put(('file', 0), b'01')
+        self.assertEqual(cache.used, 2)
+
+    def test_eviction(self):
+        cache = BlockCache(10, block_size=4)
+        cache.put(('file', 0), b'0123')
+        cache.put(('file', 1), b'4567')
+        # block 0 is now the most recently used.
+        cache.get(('file', 0))
+        cache.put(('file', 2), b'89ab')
+        self.assertEqual(list(cache.blocks), [('file', 0), ('file', 2)])
+        self.assertEqual(cache.used, 8)
+        # too large to be kept at all.
+        cache.put(('file', 3), b'0' * 11)
+        self.assertNotIn(('file', 3), cache)
+        self.assertEqual(cache.used, 8)
+
+    def test_discard(self):
+        cache = BlockCache(10, block_size=4)
+        cache.put(('file1', 0), b'0123')
+        cache.put(('file2', 0), b'4567')
+        cache.put(('file1', 1), b'89')
+        cache.discard('file1')
+        self.assertEqual(list(cache.blocks), [('file2', 0)])
+        self.assertEqual(cache.used, 4)
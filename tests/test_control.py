@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import unittest
+from os.path import dirname
+from os.path import exists
+from os.path import join
+
+from explosive.fuse.control import ControlServer
+from explosive.fuse.fs import ExplosiveFUSE
+from explosive.fuse.fs import ManagedExplosiveFUSE
+
+path = lambda p: join(dirname(__file__), 'data', p)
+
+
+class ControlServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.socket_path = join(self.tmpdir, 'control')
+
+    def test_execute(self):
+        fs = ExplosiveFUSE([path('demo1.zip')], include_arcname=True)
+        server = ControlServer(self.socket_path, fs)
+        self.addCleanup(server.stop)
+        self.assertEqual(server.execute([
+            'load ' + path('demo2.zip'),
+            'load ' + path('demo3.zip'),
+            'load ' + path('bad.zip'),
+            'load ' + path('demo2.zip'),
+            'unload ' + path('demo1.zip'),
+            'unload ' + path('demo4.zip'),
+            'load demo4.zip',
+            'remove ' + path('demo4.zip'),
+        ]), [
+            'ok load ' + path('demo2.zip'),
+            'ok load ' + path('demo3.zip'),
+            'error load %s: appears to be an invalid archive file' % path(
+                'bad.zip'),
+            'error load %s: already loaded' % path('demo2.zip'),
+            'ok unload ' + path('demo1.zip'),
+            'error unload %s: not loaded' % path('demo4.zip'),
+            'error load demo4.zip: path must be absolute',
+            'error remove %s: unknown command' % path('demo4.zip'),
+        ])
+        self.assertEqual(
+            sorted(fs.mapping.archives), [path('demo2.zip'), path('demo3.zip')])
+        self.assertEqual(
+            sorted(fs.readdir('/', None)),
+            ['.', '..', 'demo2.zip', 'demo3.zip'])
+
+    def test_execute_stats(self):
+        fs = ExplosiveFUSE([path('demo1.zip')], include_arcname=True)
+        server = ControlServer(self.socket_path, fs)
+        self.addCleanup(server.stop)
+        results = server.execute([
+            'stats',
+            'load ' + path('demo2.zip'),
+        ])
+        self.assertEqual(results[1], 'ok load ' + path('demo2.zip'))
+        self.assertTrue(results[0].startswith('ok stats '))
+        # as of the end of the batch.
+        stats = json.loads(results[0][len('ok stats '):])
+        self.assertEqual(stats['archives'], 2)
+        self.assertEqual(stats['open_entries'], 0)
+
+    def test_execute_reload(self):
+        fs = ExplosiveFUSE([path('demo1.zip')], include_arcname=True)
+        server = ControlServer(self.socket_path, fs)
+        self.addCleanup(server.stop)
+        loaded = fs.mapping.archives[path('demo1.zip')]
+        self.assertEqual(server.execute([
+            'unload ' + path('demo1.zip'),
+            'load ' + path('demo1.zip'),
+            'load ' + path('demo2.zip'),
+            'unload ' + path('demo2.zip'),
+        ]), [
+            'ok unload ' + path('demo1.zip'),
+            'ok load ' + path('demo1.zip'),
+            'ok load ' + path('demo2.zip'),
+            'ok unload ' + path('demo2.zip'),
+        ])
+        self.assertEqual(list(fs.mapping.archives), [path('demo1.zip')])
+        self.assertNotEqual(fs.mapping.archives[path('demo1.zip')], loaded)
+
+    def test_execute_managed(self):
+        fs = ManagedExplosiveFUSE(
+            '/mnt', '.manager', [path('demo1.zip')], include_arcname=True)
+        server = ControlServer(self.socket_path, fs)
+        self.addCleanup(server.stop)
+        server.execute([
+            'unload ' + path('demo1.zip'),
+            'load ' + path('demo2.zip'),
+        ])
+        self.assertEqual(
+            fs.symlinkfs.symlinks, {'demo2.zip': path('demo2.zip')})
+
+    def test_socket(self):
+        fs = ExplosiveFUSE([], control_socket=self.socket_path)
+        fs('init', '/')
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.socket_path)
+        stream = client.makefile('rwb')
+        stream.write(('load %s\nload %s\n\n' % (
+            path('demo1.zip'), path('bad.zip'))).encode('utf-8'))
+        stream.flush()
+        self.assertEqual(stream.readline(), (
+            'ok load %s\n' % path('demo1.zip')).encode('utf-8'))
+        self.assertEqual(stream.readline(), (
+            'error load %s: appears to be an invalid archive file\n' % path(
+                'bad.zip')).encode('utf-8'))
+        self.assertEqual(stream.readline(), b'\n')
+        self.assertEqual(list(fs.mapping.archives), [path('demo1.zip')])
+
+        # the last batch may be ended by the end of input.
+        stream.write(('unload %s\n' % path('demo1.zip')).encode('utf-8'))
+        stream.flush()
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual(stream.read(), (
+            'ok unload %s\n\n' % path('demo1.zip')).encode('utf-8'))
+        stream.close()
+        client.close()
+        self.assertEqual(fs.mapping.archives, {})
+
+        fs('destroy', '/')
+        fs.control_server.thread.join(5)
+        self.assertFalse(fs.control_server.thread.is_alive())
+        self.assertFalse(exists(self.socket_path))
+
+    def test_socket_mode(self):
+        umask = os.umask(0)
+        self.addCleanup(os.umask, umask)
+        server = ControlServer(self.socket_path, ExplosiveFUSE([]))
+        self.addCleanup(server.stop)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o600)
+
+    def test_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close()
+        fs = ExplosiveFUSE([])
+        server = ControlServer(self.socket_path, fs)
+        server.stop()
+
+        # one that is still being served is not taken over.
+        server = ControlServer(self.socket_path, fs)
+        self.addCleanup(server.stop)
+        with self.assertRaises(socket.error):
+            ControlServer(self.socket_path, fs)
+
+        with open(join(self.tmpdir, 'file'), 'w'):
+            pass
+        with self.assertRaises(socket.error):
+            ControlServer(join(self.tmpdir, 'file'), fs)
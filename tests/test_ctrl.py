@@ -1,5 +1,6 @@
 import sys
 import os
+import shutil
 from argparse import ArgumentParser
 from argparse import ArgumentError
 from contextlib import contextmanager
@@ -12,6 +13,9 @@ from subprocess import PIPE
 from tempfile import mkdtemp
 
 from explosive.fuse import ctrl
+from explosive.fuse import reader
+from explosive.fuse.cache import BlockCache
+from explosive.fuse.mapper import LazyArchive
 
 path = lambda p: join(dirname(__file__), 'data', p)
 
@@ -68,8 +72,46 @@ class PathMakerChoiceTestCase(unittest.TestCase):
         self.assertEqual(ap.dummy.__name__, 'flatten')
 
 
+class SizeTestCase(unittest.TestCase):
+
+    def test_size(self):
+        self.assertEqual(ctrl._size('1024'), 1024)
+        self.assertEqual(ctrl._size('2k'), 2048)
+        self.assertEqual(ctrl._size('1G'), 1 << 30)
+        with self.assertRaises(ValueError):
+            ctrl._size('G')
+        with self.assertRaises(ValueError):
+            ctrl._size('1.5G')
+
+
+class FuseOptionsTestCase(unittest.TestCase):
+
+    def test_fuse_options(self):
+        parser = ctrl.get_argparse()
+        options = lambda *a: ctrl._fuse_options(
+            parser.parse_args(list(a) + ['/tmp', 'somezip.zip']))
+        self.assertEqual(options(), {})
+        self.assertEqual(options('--throughput'), {
+            'max_read': 1 << 20, 'max_readahead': 1 << 20})
+        self.assertEqual(options('--throughput', '--max-read', '256K'), {
+            'max_read': 1 << 18, 'max_readahead': 1 << 20})
+        self.assertEqual(options('--max-readahead', '2M'), {
+            'max_readahead': 1 << 21})
+
+
 class IntegrationTestCase(unittest.TestCase):
 
+    def mount(self, args):
+        # return the operations and the arguments that PagedFUSE was
+        # called with, in place of mounting them.
+        calls = []
+        self.addCleanup(setattr, ctrl, 'PagedFUSE', ctrl.PagedFUSE)
+        ctrl.PagedFUSE = lambda *a, **kw: calls.append((a, kw))
+        with capture_stdio():
+            ctrl.main(args)
+        (operations, mountpoint), kw = calls[0]
+        return operations, kw
+
     def test_simple(self):
         with capture_stdio() as stdio:
             with self.assertRaises(SystemExit):
@@ -97,6 +139,146 @@ class IntegrationTestCase(unittest.TestCase):
             with self.assertRaises(SystemExit):
                 ctrl.main(['-m', '-d', '/tmp/to/no/such/dir', 'somezip.zip'])
 
+    def test_failure_with_spill_dir(self):
+        tmpdir = mkdtemp()
+        with capture_stdio() as stdio:
+            with self.assertRaises(SystemExit):
+                ctrl.main(['--spill-dir', join(tmpdir, 'spill'),
+                           '--spill-size', '16M', '/tmp/to/no/such/dir',
+                           'somezip.zip'])
+        self.assertTrue(os.path.isdir(join(tmpdir, 'spill')))
+
+    def test_failure_with_index_cache(self):
+        tmpdir = mkdtemp()
+        with capture_stdio() as stdio:
+            with self.assertRaises(SystemExit):
+                ctrl.main(['--index-cache', join(tmpdir, 'index'),
+                           '/tmp/to/no/such/dir', 'somezip.zip'])
+        self.assertTrue(os.path.isdir(join(tmpdir, 'index')))
+
+    def test_mount_with_block_cache(self):
+        fuse, kw = self.mount(['--block-cache', '64M', '/tmp',
+                               path('demo1.zip')])
+        block_cache = fuse.mapping.block_cache
+        self.assertTrue(isinstance(block_cache, BlockCache))
+        self.assertEqual(block_cache.max_size, 64 << 20)
+        fuse, kw = self.mount(['/tmp', path('demo1.zip')])
+        self.assertIsNone(fuse.mapping.block_cache)
+
+    def test_mount_with_throughput(self):
+        fuse, kw = self.mount([
+            '--throughput', '--max-read', '128K', '/tmp', path('demo1.zip')])
+        self.assertEqual(fuse.read_window, ctrl._throughput_read_window)
+        self.assertEqual(kw['max_read'], 1 << 17)
+        self.assertEqual(kw['max_readahead'], ctrl._throughput_max_read)
+        fuse, kw = self.mount(['/tmp', path('demo1.zip')])
+        self.assertIsNone(fuse.read_window)
+        self.assertNotIn('max_read', kw)
+
+    def test_failure_with_inflate(self):
+        backend = reader.inflate_backend
+        self.addCleanup(reader.set_inflate_backend, backend)
+        with capture_stdio() as stdio:
+            with self.assertRaises(SystemExit):
+                ctrl.main(['--inflate', 'zlib', '/tmp/to/no/such/dir',
+                           'somezip.zip'])
+        self.assertEqual(reader.inflate_backend, 'zlib')
+
+    def test_version_inflate(self):
+        backend = reader.inflate_backend
+        self.addCleanup(reader.set_inflate_backend, backend)
+        for args in (['--inflate', 'zlib', '-V'], ['-V', '--inflate=zlib']):
+            reader.set_inflate_backend(None)
+            with capture_stdio() as stdio:
+                in_, out, err = stdio
+                with self.assertRaises(SystemExit):
+                    ctrl.main(args)
+            self.assertIn('inflate backend: zlib\n', ''.join(out.items))
+
+    def test_invalid_inflate(self):
+        with capture_stdio() as stdio:
+            in_, out, err = stdio
+            with self.assertRaises(SystemExit):
+                ctrl.main(['--inflate', 'nothing', '/tmp', 'somezip.zip'])
+            self.assertIn(
+                "error: argument --inflate: invalid choice: 'nothing'",
+                err.items[-1])
+
+    def test_mount_with_watch(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fuse, kw = self.mount(['--watch', tmpdir, '/tmp'])
+        self.assertEqual(fuse.watch_dirs, [tmpdir])
+        # only started as the filesystem is initialized.
+        self.assertEqual(fuse.watchers, [])
+        fuse.init('/')
+        self.addCleanup(fuse.destroy, '/')
+        self.assertEqual([w.path for w in fuse.watchers], [tmpdir])
+
+    def test_invalid_watch(self):
+        with capture_stdio() as stdio:
+            in_, out, err = stdio
+            with self.assertRaises(SystemExit):
+                ctrl.main(['/tmp'])
+            self.assertTrue(err.items[-1].endswith(
+                'error: at least one archive, --watch DIR or '
+                '--control-socket PATH is required\n'))
+            with self.assertRaises(SystemExit):
+                ctrl.main(['--watch', '/tmp/to/no/such/dir', '/tmp'])
+            self.assertTrue(err.items[-1].endswith(
+                "error: --watch: `/tmp/to/no/such/dir` is not a directory\n"))
+
+    def test_mount_with_lazy(self):
+        fuse, kw = self.mount(['--lazy', '/tmp', path('demo1.zip')])
+        self.assertTrue(fuse.mapping.lazy)
+        # registered rather than indexed.
+        self.assertTrue(isinstance(
+            fuse.mapping.mapping['demo1.zip'], LazyArchive))
+        fuse, kw = self.mount(['/tmp', path('demo1.zip')])
+        self.assertFalse(fuse.mapping.lazy)
+
+    def test_invalid_lazy(self):
+        with capture_stdio() as stdio:
+            in_, out, err = stdio
+            with self.assertRaises(SystemExit):
+                ctrl.main([
+                    '--lazy', '--omit-arcname', '/tmp', 'somezip.zip'])
+            self.assertTrue(err.items[-1].endswith(
+                'error: --lazy cannot be used with --omit-arcname\n'))
+
+    def test_invalid_max_entries(self):
+        with capture_stdio() as stdio:
+            in_, out, err = stdio
+            for args in (['--omit-arcname'], ['--max-entries', '0']):
+                with self.assertRaises(SystemExit):
+                    ctrl.main(
+                        ['--max-entries', '100'] + args +
+                        ['/tmp', 'somezip.zip'])
+                self.assertTrue(err.items[-1].endswith(
+                    'error: --max-entries must be positive, and cannot be '
+                    'used with --omit-arcname\n'))
+
+    def test_invalid_mapped_index(self):
+        with capture_stdio() as stdio:
+            in_, out, err = stdio
+            for args in (['--nested'], ['--lazy'], ['--max-entries', '1']):
+                with self.assertRaises(SystemExit):
+                    ctrl.main(
+                        ['--mapped-index', '/tmp/index'] + args +
+                        ['/tmp', 'somezip.zip'])
+                self.assertTrue(err.items[-1].endswith(
+                    'error: --mapped-index cannot be used with --nested, '
+                    '--lazy or --max-entries\n'))
+
+    def test_invalid_spill_size(self):
+        with capture_stdio() as stdio:
+            in_, out, err = stdio
+            with self.assertRaises(SystemExit):
+                ctrl.main(['--spill-size', 'lots', '/tmp', 'somezip.zip'])
+            self.assertTrue(err.items[-1].endswith(
+                "error: argument --spill-size: invalid size value: 'lots'\n"
+            ))
+
     def test_invalid_layout_choice(self):
         with capture_stdio() as stdio:
             in_, out, err = stdio
@@ -1,15 +1,28 @@
 import unittest
 import tempfile
 import shutil
+import threading
+from hashlib import sha1
+from io import BytesIO
 from os.path import dirname
 from os.path import join
 
 from fuse import FuseOSError
 
+try:
+    from unrar.rarfile import RarFile
+except (ImportError, LookupError, OSError) as e:
+    RarFile = None
+
+from explosive.fuse.cache import SpillCache
 from explosive.fuse.fs import ExplosiveFUSE
 from explosive.fuse.fs import ManagedExplosiveFUSE
+from explosive.fuse.fs import PagedFUSE
+from explosive.fuse.fs import ReadWindow
 from explosive.fuse.fs import SymlinkFUSE
+from explosive.fuse.fs import SymlinkIndex
 from explosive.fuse import pathmaker
+from explosive.fuse import reader
 
 path = lambda p: join(dirname(__file__), 'data', p)
 
@@ -47,6 +60,25 @@ class BaseExplosiveFsTestCase(object):
         with self.assertRaises(FuseOSError):
             fs.getattr('/file1')
 
+    def test_lock_free(self):
+        fs = self.factory([path('demo1.zip')], include_arcname=True)
+        results = []
+
+        def read():
+            results.append(fs('getattr', '/demo1.zip/file1')['st_size'])
+            results.append(sorted(fs('readdir', '/demo1.zip', 0)))
+
+        # as held by another thread loading an archive.
+        with fs.lock, fs.mapping.edit():
+            fs.mapping.load_archive(path('demo2.zip'))
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(results, [33, [
+            '.', '..', 'file1', 'file2', 'file3', 'file4', 'file5', 'file6']])
+        self.assertEqual(fs('getattr', '/demo2.zip')['st_mode'], 0o40555)
+
     def test_open_release(self):
         fs = self.factory([path('demo1.zip')], include_arcname=True)
         fh = fs.open('/demo1.zip/file1', 0)
@@ -86,6 +118,142 @@ class BaseExplosiveFsTestCase(object):
         with self.assertRaises(FuseOSError):
             fs.read('/demo/dir1/file1', 1, 0, fh)
 
+    def test_read_spill_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        cache = SpillCache(tmpdir, 1024)
+        fs = self.factory([path('demo3.zip')],
+            include_arcname=False, overwrite=True, spill_cache=cache)
+        fh = fs.open('/demo/dir1/file1', 0)
+        self.assertEqual(fs.read('/demo/dir1/file1', 1, 2, fh), b'2')
+        self.assertEqual(fs.open_entries[fh][1], 3)
+        fp = fs.open_entries[fh][0]
+        # skipped data was also kept, so no reopening is required.
+        self.assertEqual(fs.read('/demo/dir1/file1', 2, 0, fh), b'b0')
+        self.assertIs(fs.open_entries[fh][0], fp)
+        fs.release('/demo/dir1/file1', fh)
+        fs.destroy('/')
+
+        # a new instance reuses what was persisted.
+        cache = SpillCache(tmpdir, 1024)
+        fs = self.factory([path('demo3.zip')],
+            include_arcname=False, overwrite=True, spill_cache=cache)
+        fh = fs.open('/demo/dir1/file1', 0)
+        spill = fs.open_entries[fh][3]
+        self.assertEqual(spill.extents, [[0, 3]])
+        self.assertEqual(fs.read('/demo/dir1/file1', 3, 0, fh), b'b02')
+        self.assertEqual(fs.open_entries[fh][1], 0)
+        self.assertEqual(
+            fs.read('/demo/dir1/file1', 40, 0, fh),
+            b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+        self.assertEqual(spill.extents, [[0, 33]])
+
+    @unittest.skipIf(RarFile is None, reason='unrar not found')
+    def test_read_spill_cache_rar(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        cache = SpillCache(tmpdir, 1024)
+        fs = self.factory([path('demo2.rar')],
+            include_arcname=False, overwrite=True, spill_cache=cache)
+        fs.skip_chunk = 4
+        fh = fs.open('/demo/file1', 0)
+        self.assertEqual(fs.read('/demo/file1', 2, 10, fh), b'04')
+        spill = fs.open_entries[fh][3]
+        self.assertEqual(spill.extents, [[0, 12]])
+        fp = fs.open_entries[fh][0]
+        # served from the spill without restarting the extraction.
+        self.assertEqual(fs.read('/demo/file1', 3, 0, fh), b'b02')
+        self.assertIs(fs.open_entries[fh][0], fp)
+        self.assertEqual(
+            fs.read('/demo/file1', 40, 0, fh),
+            b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+        self.assertEqual(spill.extents, [[0, 33]])
+        fs.release('/demo/file1', fh)
+
+    def test_read_window(self):
+        fs = self.factory([path('demo3.zip')],
+            include_arcname=False, overwrite=True, read_window=16)
+        fh = fs.open('/demo/dir1/file1', 0)
+        window = fs.open_entries[fh][4]
+        self.assertEqual(fs.read('/demo/dir1/file1', 4, 0, fh), b'b026')
+        self.assertEqual((window.offset, window.length), (0, 16))
+        self.assertEqual(fs.open_entries[fh][1], 16)
+        self.assertEqual(fs.read('/demo/dir1/file1', 4, 14, fh), b'a9cb')
+        self.assertEqual((window.offset, window.length), (16, 16))
+        self.assertEqual(fs.read('/demo/dir1/file1', 10, 30, fh), b'd1\n')
+        self.assertEqual((window.offset, window.length), (32, 1))
+        self.assertTrue(window.eof)
+        self.assertEqual(fs.read('/demo/dir1/file1', 10, 33, fh), b'')
+        # reading from before the window reopens.
+        fp = fs.open_entries[fh][0]
+        self.assertEqual(fs.read('/demo/dir1/file1', 2, 1, fh), b'02')
+        self.assertIsNot(fs.open_entries[fh][0], fp)
+        self.assertEqual((window.offset, window.length), (1, 16))
+        fs.release('/demo/dir1/file1', fh)
+
+    def test_read_window_past_end(self):
+        fs = self.factory([path('demo3.zip')],
+            include_arcname=False, overwrite=True, read_window=16)
+        fh = fs.open('/demo/dir1/file1', 0)
+        self.assertEqual(fs.read('/demo/dir1/file1', 10, 100, fh), b'')
+        self.assertEqual(fs.read('/demo/dir1/file1', 4, 0, fh), b'b026')
+        fs.release('/demo/dir1/file1', fh)
+
+    def test_read_window_spill_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        cache = SpillCache(tmpdir, 1024)
+        fs = self.factory([path('demo3.zip')], include_arcname=False,
+            overwrite=True, spill_cache=cache, read_window=16)
+        fh = fs.open('/demo/dir1/file1', 0)
+        spill = fs.open_entries[fh][3]
+        self.assertEqual(fs.read('/demo/dir1/file1', 2, 20, fh), b'88')
+        # both the skipped data and the whole window were kept.
+        self.assertEqual(spill.extents, [[0, 33]])
+        fs.release('/demo/dir1/file1', fh)
+
+    def test_stats(self):
+        fs = self.factory([path('demo3.zip')],
+            include_arcname=False, overwrite=True)
+        fh = fs.open('/demo/dir1/file1', 0)
+        stats = fs.stats()
+        self.assertEqual(stats['archives'], 1)
+        self.assertEqual(stats['open_entries'], 1)
+        self.assertEqual(stats['inflate_backend'], reader.inflate_backend)
+        fs.release('/demo/dir1/file1', fh)
+        self.assertEqual(fs.stats()['open_entries'], 0)
+        self.assertNotIn('archives_unindexed', stats)
+
+    def test_lazy(self):
+        fs = self.factory(
+            [path('demo1.zip'), path('demo3.zip')], include_arcname=True,
+            lazy=True)
+        self.assertEqual(fs.stats()['archives_unindexed'], 2)
+        self.assertEqual(fs('getattr', '/demo3.zip')['st_mode'], 0o40555)
+        self.assertEqual(fs.stats()['archives_unindexed'], 2)
+        fh = fs('open', '/demo3.zip/demo/dir1/file1', 0)
+        self.assertEqual(fs('read', '/demo3.zip/demo/dir1/file1', 5, 0, fh),
+            b'b0263')
+        fs('release', '/demo3.zip/demo/dir1/file1', fh)
+        self.assertEqual(fs.stats()['archives_unindexed'], 1)
+        self.assertEqual(sorted(fs('readdir', '/demo1.zip', 0)), [
+            '.', '..', 'file1', 'file2', 'file3', 'file4', 'file5', 'file6'])
+        self.assertEqual(fs.stats()['archives_unindexed'], 0)
+
+    def test_max_entries(self):
+        fs = self.factory(
+            [path('demo1.zip'), path('demo2.zip')], include_arcname=True,
+            max_entries=10)
+        fh = fs('open', '/demo1.zip/file1', 0)
+        self.assertEqual(fs('getattr', '/demo2.zip/demo/file1')['st_size'], 33)
+        # not evicted while open.
+        self.assertEqual(fs.stats()['indexed_entries'], 13)
+        self.assertEqual(fs('read', '/demo1.zip/file1', 5, 0, fh), b'b0263')
+        fs('release', '/demo1.zip/file1', fh)
+        self.assertEqual(fs('getattr', '/demo1.zip/file2')['st_size'], 33)
+        self.assertEqual(fs.stats()['indexed_entries'], 6)
+        self.assertEqual(fs.stats()['archives_unindexed'], 1)
+
     def test_read_no_such_path(self):
         fs = self.factory([path('demo3.zip')],
             include_arcname=False, overwrite=True)
@@ -165,11 +333,22 @@ class ManagedExplosiveFsTestCase(BaseExplosiveFsTestCase, unittest.TestCase):
         fs = self.factory([path('demo1.zip'), target], include_arcname=True)
         self.assertEqual(list(fs.mapping.mapping.keys()), ['demo1.zip'])
 
-        # Test to see that both entries are created, one with a suffix.
+        # Test to see that both entries are created, one with a suffix
+        # derived from its path.
+        suffixed = 'demo1.zip_' + sha1(target.encode('utf-8')).hexdigest()[:8]
         self.assertEqual(
             sorted(fs('readdir', '/.management', 0)),
-            ['.', '..', 'demo1.zip', 'demo1.zip_1'],
+            ['.', '..', 'demo1.zip', suffixed],
         )
+        self.assertEqual(fs.symlinkfs.symlinks[suffixed], target)
+
+        # the same names on the next mount, even with another archive
+        # taking the name that was free.
+        fs = self.factory([target, path('demo1.zip')], include_arcname=True)
+        self.assertEqual(fs.symlinkfs.symlinks, {
+            'demo1.zip': path('demo1.zip'),
+            suffixed: target,
+        })
 
         self.assertEqual(
             sorted(fs('readdir', '/', 0)),
@@ -214,6 +393,7 @@ class ManagedExplosiveFsTestCase(BaseExplosiveFsTestCase, unittest.TestCase):
                 'file1', 'file2', 'file3', 'file4', 'file5', 'file6'])
 
         fs('unlink', '/.management/demo1.zip')
+        fs.queue.join()
         self.assertEqual(sorted(fs('readdir', '/', 0)), [
             '.', '..', '.management', 'demo'])
 
@@ -249,13 +429,62 @@ class ManagedExplosiveFsTestCase(BaseExplosiveFsTestCase, unittest.TestCase):
         self.assertEqual(sorted(fs('readdir', '/.management', 0)), ['.', '..'])
 
         fs('symlink', '/.management/demo1.zip', path('demo1.zip'))
+        fs.queue.join()
         self.assertEqual(sorted(fs('readdir', '/', 0)), [
             '.', '..', '.management', 'file1', 'file2', 'file3', 'file4',
             'file5', 'file6',
         ])
 
         fs('unlink', '/.management/demo1.zip')
+        fs.queue.join()
+        self.assertEqual(fs('readdir', '/', 0), ['.', '..', '.management'])
+
+    def test_symlink_pending(self):
+        fs = ManagedExplosiveFUSE('/mnt', '.management', [])
+        # hold up the worker.
+        fs.lock.acquire()
+        fs('symlink', '/.management/demo1.zip', path('demo1.zip'))
+        self.assertEqual(sorted(fs('readdir', '/.management', 0)), [
+            '.', '..', 'demo1.zip', 'demo1.zip.pending'])
+        self.assertEqual(
+            fs('readlink', '/.management/demo1.zip.pending'),
+            path('demo1.zip'))
+        self.assertEqual(
+            fs('getattr', '/.management/demo1.zip.pending')['st_mode'],
+            0o120444)
+        # markers cannot be removed, and the archive cannot be added
+        # again while it is pending.
+        with self.assertRaises(FuseOSError):
+            fs('unlink', '/.management/demo1.zip.pending')
+        with self.assertRaises(FuseOSError):
+            fs('symlink', '/.management/again.zip', path('demo1.zip'))
         self.assertEqual(fs('readdir', '/', 0), ['.', '..', '.management'])
+        fs.lock.release()
+        fs.queue.join()
+        self.assertEqual(sorted(fs('readdir', '/.management', 0)), [
+            '.', '..', 'demo1.zip'])
+        self.assertEqual(len(fs('readdir', '/', 0)), 9)
+
+        # removed then added again before the worker gets to it.
+        fs.lock.acquire()
+        fs('unlink', '/.management/demo1.zip')
+        fs('symlink', '/.management/demo1.zip', path('demo1.zip'))
+        fs.lock.release()
+        fs.queue.join()
+        self.assertEqual(list(fs.mapping.archives), [path('demo1.zip')])
+        self.assertEqual(fs.pending, {})
+
+        # added then removed.
+        fs.lock.acquire()
+        fs('symlink', '/.management/demo2.zip', path('demo2.zip'))
+        fs('unlink', '/.management/demo2.zip')
+        fs.lock.release()
+        fs.queue.join()
+        self.assertEqual(list(fs.mapping.archives), [path('demo1.zip')])
+        self.assertEqual(sorted(fs('readdir', '/.management', 0)), [
+            '.', '..', 'demo1.zip'])
+        fs('destroy', '/')
+        fs.worker.join()
 
     def test_symlink_bad_archive(self):
         fs = ManagedExplosiveFUSE('/mnt', '.management', [])
@@ -265,6 +494,11 @@ class ManagedExplosiveFsTestCase(BaseExplosiveFsTestCase, unittest.TestCase):
             fs('symlink', '/.management/bad_archive', '/no_such_archive')
         self.assertEqual(fs.readdir('/.management', 0), ['.', '..'])
 
+        # only found to be invalid by the worker.
+        fs('symlink', '/.management/bad.zip', path('bad.zip'))
+        fs.queue.join()
+        self.assertEqual(fs.readdir('/.management', 0), ['.', '..'])
+
     def test_management_supercede_getattr_file_conflict(self):
         # test getattr actually get the directory version not the
         # file version.
@@ -280,12 +514,38 @@ class ManagedExplosiveFsTestCase(BaseExplosiveFsTestCase, unittest.TestCase):
         fs = ManagedExplosiveFUSE(
             '/mnt', 'demo1.zip', [], include_arcname=True)
         fs('symlink', '/demo1.zip/demo1.zip', path('demo1.zip'))
+        fs.queue.join()
         self.assertEqual(fs('readdir', '/', 0), ['.', '..', 'demo1.zip'])
         self.assertEqual(fs('readdir', '/demo1.zip', 0), [
             '.', '..', 'demo1.zip'])
         self.assertEqual(fs('getattr', '/demo1.zip')['st_mode'], 0o40555)
 
 
+class ReadWindowTestCase(unittest.TestCase):
+
+    def test_fill_short_reads(self):
+        class Reader(object):
+            def __init__(self, data):
+                self.fd = BytesIO(data)
+
+            def readinto(self, buffer):
+                # never more than 3 bytes at a time.
+                return self.fd.readinto(buffer[:3])
+
+        window = ReadWindow(8)
+        reader = Reader(b'0123456789')
+        window.fill(reader, 0)
+        self.assertEqual((window.length, window.eof), (8, False))
+        self.assertEqual(window.get(4, 2), b'2345')
+        self.assertEqual(window.get(4, 6), b'67')
+        self.assertEqual(window.get(4, 8), b'')
+        self.assertIsNone(window.get(4, 9))
+        window.fill(reader, 8)
+        self.assertEqual((window.length, window.eof), (2, True))
+        self.assertEqual(window.get(4, 8), b'89')
+        self.assertIsNone(window.get(4, 7))
+
+
 class SymlinkFUSETestCase(unittest.TestCase):
 
     def test_simple(self):
@@ -342,6 +602,57 @@ class SymlinkFUSETestCase(unittest.TestCase):
         self.assertEqual(
             fs.readdir('/some/nested/structure', 0), ['.', '..', 'here'])
 
+    def test_readdir_offset(self):
+        fs = SymlinkFUSE('/mnt', base_path='/.control')
+        fs.readdir_page_size = 3
+        for name in ('c', 'a', 'd', 'b'):
+            fs.symlinks[name] = '/home/' + name
+        fs.markers['a.pending'] = '/home/e'
+        self.assertEqual(fs.readdir('/.control', 0, 0), [
+            ('.', None, 1), ('..', None, 2), ('a', None, 3)])
+        self.assertEqual(fs.readdir('/.control', 0, 3), [
+            ('b', None, 4), ('c', None, 5), ('d', None, 6)])
+        self.assertEqual(fs.readdir('/.control', 0, 5), [
+            ('d', None, 6), ('a.pending', None, 7)])
+        self.assertEqual(fs.readdir('/.control', 0, 7), [])
+        # in full, without an offset.
+        self.assertEqual(fs.readdir('/.control', 0), [
+            '.', '..', 'a', 'b', 'c', 'd', 'a.pending'])
+        self.assertEqual(fs.readdir('/', 0, 0), ['.', '..', '.control'])
+
+    def test_paged_fuse_readdir(self):
+        class FileInfo(object):
+            class contents(object):
+                fh = 0
+
+        fs = SymlinkFUSE('/mnt', base_path='/.control')
+        fs.readdir_page_size = 2
+        names = ['%03d' % i for i in range(10)]
+        for name in names:
+            fs.symlinks[name] = '/home/' + name
+
+        fuse = PagedFUSE.__new__(PagedFUSE)
+        fuse.operations = fs
+        fuse.encoding = 'utf-8'
+        listed = []
+
+        def filler(buf, name, st, offset):
+            # a buffer with room for 3 entries.
+            if len(buf) == 3:
+                return 1
+            buf.append((name.decode('utf-8'), offset))
+            return 0
+
+        offset = 0
+        while True:
+            buf = []
+            fuse.readdir(b'/.control', buf, filler, offset, FileInfo)
+            if not buf:
+                break
+            listed.extend(name for name, _ in buf)
+            offset = buf[-1][1]
+        self.assertEqual(listed, ['.', '..'] + names)
+
     def test_rename(self):
         fs = SymlinkFUSE('/mnt', base_path='/.control')
         with self.assertRaises(FuseOSError):
@@ -369,6 +680,34 @@ class SymlinkFUSETestCase(unittest.TestCase):
         fs.symlink('/some/nested/structure/target2', '../../../../target')
         self.assertEqual(fs.symlinks['target2'], '/mnt/target')
 
+    def test_symlink_index(self):
+        symlinks = SymlinkIndex()
+        self.assertEqual(symlinks.add('/a/demo.zip'), 'demo.zip')
+        # the same name again for the same target.
+        self.assertEqual(symlinks.name_for('/a/demo.zip'), 'demo.zip')
+        suffix = sha1(b'/b/demo.zip').hexdigest()
+        self.assertEqual(symlinks.add('/b/demo.zip'), 'demo.zip_' + suffix[:8])
+        symlinks['demo.zip_' + sha1(b'/c/demo.zip').hexdigest()[:8]] = '/x'
+        self.assertEqual(
+            symlinks.add('/c/demo.zip'),
+            'demo.zip_' + sha1(b'/c/demo.zip').hexdigest())
+        symlinks['alpha'] = '/a/demo.zip'
+        self.assertEqual(symlinks.names, sorted(symlinks))
+        self.assertEqual(symlinks.targets['/a/demo.zip'], 'demo.zip')
+
+        self.assertEqual(symlinks.pop('demo.zip'), '/a/demo.zip')
+        self.assertIsNone(symlinks.pop('demo.zip', None))
+        with self.assertRaises(KeyError):
+            del symlinks['demo.zip']
+        del symlinks['alpha']
+        self.assertEqual(symlinks.names, sorted(symlinks))
+        self.assertNotIn('/a/demo.zip', symlinks.targets)
+        # replacing the target.
+        symlinks['demo.zip_' + suffix[:8]] = '/d/demo.zip'
+        self.assertEqual(symlinks.names, sorted(symlinks))
+        self.assertEqual(
+            symlinks.targets['/d/demo.zip'], 'demo.zip_' + suffix[:8])
+
     def test_unlink(self):
         fs = SymlinkFUSE('/mnt')
         fs.symlinks['else'] = '/home/else'
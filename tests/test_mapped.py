@@ -0,0 +1,223 @@
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from os.path import dirname
+from os.path import join
+from zipfile import ZipFile
+
+from explosive.fuse.fs import ExplosiveFUSE
+from explosive.fuse.mapped import MappedDirectory
+from explosive.fuse.mapped import MappedIndex
+from explosive.fuse.mapped import MappedMapper
+from explosive.fuse.mapped import write_index
+from explosive.fuse.mapped import write_run
+from explosive.fuse.mapper import DefaultMapper
+from explosive.fuse.mapper import FileEntry
+
+path = lambda p: join(dirname(__file__), 'data', p)
+
+
+class MappedIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, target, archives, **kw):
+        # write the runs of the records of every archive, then the index.
+        runs = []
+        for records in archives.values():
+            runs.append(tempfile.TemporaryFile())
+            self.addCleanup(runs[-1].close)
+            write_run(runs[-1], records, **kw)
+        return write_index(target, runs, list(archives))
+
+    def test_round_trip(self):
+        archives = OrderedDict([
+            ('/tmp/1.zip', [
+                (('b', 'c'), FileEntry('/tmp/1.zip', 'b/c', 3)),
+                (('b', 'a'), None),
+                (('d', 'e', 'f'), FileEntry('/tmp/1.zip', 'd/e/f', 0)),
+                # a directory entry for the root.
+                ((), None),
+            ]),
+            ('/tmp/2.zip', [
+                (('a',), FileEntry('/tmp/2.zip', 'a', 1)),
+                ((u'\xe9',), FileEntry('/tmp/2.zip', u'\xe9', 2)),
+            ]),
+        ])
+        target = join(self.tmpdir, 'index')
+        # sorted in runs of two records.
+        self.assertEqual(self.write(target, archives, run_size=2), 9)
+        index = MappedIndex(target)
+        self.assertEqual(len(index), 9)
+        self.assertEqual(index.listdir(0), ['a', 'b', 'd', u'\xe9'])
+        b = index.lookup(0, b'b')
+        self.assertEqual(index.listdir(b), ['a', 'c'])
+        self.assertTrue(index.is_dir(index.lookup(b, b'a')))
+        self.assertEqual(index.listdir(index.lookup(b, b'a')), [])
+        self.assertEqual(
+            index.entry(index.lookup(b, b'c')), ('/tmp/1.zip', 'b/c', 3))
+        self.assertEqual(
+            index.entry(index.lookup(0, u'\xe9'.encode('utf-8'))),
+            ('/tmp/2.zip', u'\xe9', 2))
+        e = index.lookup(index.lookup(0, b'd'), b'e')
+        self.assertEqual(
+            index.entry(index.lookup(e, b'f')), ('/tmp/1.zip', 'd/e/f', 0))
+        self.assertIsNone(index.lookup(0, b'c'))
+        self.assertIsNone(index.lookup(0, b'z'))
+
+    def test_empty(self):
+        target = join(self.tmpdir, 'index')
+        self.assertEqual(self.write(target, OrderedDict()), 1)
+        index = MappedIndex(target)
+        self.assertEqual(index.listdir(0), [])
+        self.assertIsNone(index.lookup(0, b'a'))
+        self.assertEqual(self.write(target, {'/tmp/1.zip': []}), 1)
+
+    def test_not_an_index(self):
+        target = join(self.tmpdir, 'index')
+        with open(target, 'wb') as fd:
+            fd.write(b'\0' * 64)
+        with self.assertRaises(ValueError):
+            MappedIndex(target)
+
+
+class MappedMapperTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.index_dir = join(self.tmpdir, 'index')
+
+    def assertSameMapping(self, m, d, path=''):
+        self.assertEqual(sorted(m.readdir(path)), sorted(d.readdir(path)))
+        for name in d.readdir(path):
+            child = path + '/' + name if path else name
+            info = d.traverse(child)
+            if isinstance(info, dict):
+                self.assertIsInstance(m.traverse(child), MappedDirectory)
+                self.assertSameMapping(m, d, child)
+            else:
+                self.assertEqual(m.traverse(child), info)
+
+    def test_same_as_default(self):
+        archives = [path('demo%d.zip' % i) for i in (1, 2, 3, 4)]
+        for kw in ({'include_arcname': True}, {}, {'overwrite': True}):
+            m = MappedMapper(self.index_dir, **kw)
+            d = DefaultMapper(**kw)
+            for archive_path in archives:
+                m.load_archive(archive_path)
+                d.load_archive(archive_path)
+            self.assertSameMapping(m, d)
+        # the index file is removed once mapped.
+        self.assertEqual(os.listdir(self.index_dir), [])
+
+    def test_conflicts(self):
+        # file entries and directories at the same paths, within and
+        # across archives.
+        names = [
+            ['a', 'b/c', 'd/', 'f'],
+            ['a/x', 'b', 'd', 'e/f/g', 'f'],
+            ['a', 'b/c', 'e/f', 'e/f/h', 'd/y', 'f/z'],
+        ]
+        archives = []
+        for i, members in enumerate(names):
+            archives.append(join(self.tmpdir, '%d.zip' % i))
+            with ZipFile(archives[-1], 'w') as zf:
+                for name in members:
+                    zf.writestr(name, name)
+        for kw in ({}, {'overwrite': True}):
+            m = MappedMapper(self.index_dir, **kw)
+            d = DefaultMapper(**kw)
+            with m.edit():
+                for archive_path in archives:
+                    m.load_archive(archive_path)
+                    d.load_archive(archive_path)
+            self.assertSameMapping(m, d)
+
+    def test_traverse_open(self):
+        m = MappedMapper(self.index_dir, path('demo3.zip'))
+        self.assertIsNone(m.traverse('missing'))
+        self.assertIsNone(m.traverse('demo/dir1/file1/nothing'))
+        self.assertEqual(m.readdir('demo/dir1/file1'), [])
+        self.assertEqual(m.readdir('missing'), [])
+        self.assertEqual(m.readfile('demo/dir1/file1')[:5], b'b0263')
+        idfe, fp = m.open('demo/dir1/file1')
+        fp.close()
+        self.assertEqual(idfe[0::2], (path('demo3.zip'), 'demo/dir1/file1'))
+        # unaffected by the loading of other archives.
+        m.load_archive(path('demo1.zip'))
+        self.assertEqual(m.open('demo/dir1/file1')[0], idfe)
+        self.assertIsNone(m.open('demo'))
+
+    def test_load_unload(self):
+        m = MappedMapper(self.index_dir, include_arcname=True)
+        self.assertEqual(m.index.version, 0)
+        with m.edit():
+            self.assertTrue(m.load_archive(path('demo1.zip')))
+            self.assertTrue(m.load_archive(path('demo2.zip')))
+            self.assertFalse(m.load_archive(path('bad.zip')))
+            # not published until the end of the edit.
+            self.assertEqual(m.readdir(''), [])
+        self.assertEqual(m.index.version, 1)
+        self.assertEqual(m.readdir(''), ['demo1.zip', 'demo2.zip'])
+        index = m.index
+
+        m.unload_archives([path('demo1.zip'), path('demo3.zip')])
+        self.assertEqual(m.index.version, 2)
+        self.assertEqual(list(m.archives), [path('demo2.zip')])
+        self.assertEqual(m.readdir(''), ['demo2.zip'])
+        # the previous index remains usable by its readers.
+        self.assertEqual(index.listdir(0), ['demo1.zip', 'demo2.zip'])
+
+        # nothing changed.
+        m.unload_archives([path('demo1.zip')])
+        self.assertEqual(m.index.version, 2)
+
+    def test_load_without_others(self):
+        # the other archives are not read again as one is loaded.
+        target = join(self.tmpdir, 'copy.zip')
+        shutil.copy(path('demo1.zip'), target)
+        m = MappedMapper(self.index_dir, include_arcname=True, pool_size=1)
+        m.load_archive(target)
+        m.load_archive(path('demo2.zip'))
+        self.assertNotIn(target, m.archive_pool)
+        os.remove(target)
+        self.assertTrue(m.load_archive(path('demo3.zip')))
+        self.assertEqual(
+            m.readdir(''), ['copy.zip', 'demo2.zip', 'demo3.zip'])
+        self.assertEqual(m.traverse('copy.zip/file1'), (target, 'file1', 33))
+        m.unload_archives([path('demo2.zip')])
+        self.assertEqual(m.readdir(''), ['copy.zip', 'demo3.zip'])
+        self.assertEqual(
+            sorted(m.runs), sorted([target, path('demo3.zip')]))
+
+    def test_unsupported(self):
+        for kw in ({'nested': True}, {'lazy': True}, {'max_entries': 1}):
+            with self.assertRaises(ValueError):
+                MappedMapper(self.index_dir, **kw)
+
+    def test_fs(self):
+        fs = ExplosiveFUSE(
+            [path('demo1.zip'), path('demo3.zip')], include_arcname=True,
+            mapped_index=self.index_dir)
+        self.assertEqual(fs.mapping.index.version, 1)
+        self.assertEqual(
+            sorted(fs('readdir', '/', None)),
+            ['.', '..', 'demo1.zip', 'demo3.zip'])
+        self.assertEqual(fs('getattr', '/demo3.zip/demo')['st_nlink'], 2)
+        fh = fs('open', '/demo1.zip/file1', os.O_RDONLY)
+        self.assertEqual(fs('read', '/demo1.zip/file1', 5, 0, fh), b'b0263')
+        fs.apply_changes([(path('demo2.zip'), fs.mapping.prepare_archive(
+            path('demo2.zip')))])
+        # still the same file entry, so it may be read from the start.
+        self.assertEqual(fs('read', '/demo1.zip/file1', 5, 0, fh), b'b0263')
+        fs('release', '/demo1.zip/file1', fh)
+        fs.apply_changes([
+            (path('demo1.zip'), None), (path('demo2.zip'), None)])
+        self.assertEqual(
+            sorted(fs('readdir', '/', None)), ['.', '..', 'demo3.zip'])
+        self.assertEqual(fs.stats()['archives'], 1)
@@ -1,10 +1,21 @@
+import os
+import shutil
+import tarfile
+import tempfile
 import unittest
+from io import BytesIO
 from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
 from zipfile import ZipInfo
 from os.path import dirname
 from os.path import join
 
+from explosive.fuse.cache import BlockCache
+from explosive.fuse.cache import IndexCache
 from explosive.fuse.mapper import DefaultMapper
+from explosive.fuse.mapper import LazyArchive
+from explosive.fuse.mapper import NESTED_SEP
+from explosive.fuse.mapper import NestedArchive
 
 path = lambda p: join(dirname(__file__), 'data', p)
 
@@ -380,6 +391,194 @@ class DefaultMapperTestCase(unittest.TestCase):
         self.assertEqual(m.archives, {})
         self.assertEqual(m.archive_ifilenames, {})
 
+    def test_copy_on_write(self):
+        m = DefaultMapper()
+        m.load_archive(path('demo4.zip'))
+        published = m.mapping
+        demo = published['demo']
+        dir1 = demo['dir1']
+        m.load_archive(path('demo2.zip'))
+        # the published version is left as it was.
+        self.assertIsNot(m.mapping, published)
+        self.assertIs(published['demo'], demo)
+        self.assertEqual(sorted(published['demo']), ['dir1', 'dir2'])
+        self.assertEqual(len(m.readdir('demo')), 8)
+        # with the unchanged directories shared.
+        self.assertIs(m.mapping['demo']['dir1'], dir1)
+
+        loaded = m.mapping
+        m.unload_archive(path('demo4.zip'))
+        self.assertEqual(sorted(dir1), ['file1', 'file3', 'file5'])
+        self.assertEqual(len(loaded['demo']), 8)
+        self.assertEqual(sorted(m.readdir('')), ['demo'])
+        self.assertEqual(len(m.readdir('demo')), 6)
+
+    def test_edit(self):
+        m = DefaultMapper(include_arcname=True)
+        m.load_archive(path('demo1.zip'))
+        published = m.mapping
+        with m.edit():
+            m.unload_archive(path('demo1.zip'))
+            m.load_archive(path('demo2.zip'))
+            # nothing is published until the end.
+            self.assertIs(m.mapping, published)
+        self.assertEqual(sorted(published), ['demo1.zip'])
+        self.assertEqual(sorted(m.mapping), ['demo2.zip'])
+
+    def test_lazy(self):
+        m = DefaultMapper(include_arcname=True, lazy=True)
+        self.assertTrue(m.load_archive(path('demo1.zip')))
+        self.assertTrue(m.load_archive(path('demo2.zip')))
+        # missing ones are reported as they would be otherwise.
+        self.assertFalse(m.load_archive(path('no_such_archive.zip')))
+        self.assertEqual(
+            sorted(m.archives), [path('demo1.zip'), path('demo2.zip')])
+        self.assertEqual(m.archive_ifilenames, {})
+        self.assertEqual(m.archive_pool, {})
+        lazy = m.traverse('demo1.zip')
+        self.assertTrue(isinstance(lazy, LazyArchive))
+
+        # indexed once traversed into.
+        self.assertEqual(m.traverse('demo1.zip/file1'), (
+            path('demo1.zip'), 'file1', 33))
+        self.assertEqual(list(m.lazy_archives), [path('demo2.zip')])
+        self.assertEqual(list(m.archive_ifilenames), [path('demo1.zip')])
+        self.assertEqual(m.readdir('demo2.zip'), ['demo'])
+        self.assertEqual(m.lazy_archives, {})
+        # a stale reference to it resolves to its replacement.
+        self.assertIs(m._load_lazy(lazy), m.mapping['demo1.zip'])
+
+        m.unload_archive(path('demo1.zip'))
+        self.assertEqual(sorted(m.mapping), ['demo2.zip'])
+
+    def test_lazy_unload(self):
+        m = DefaultMapper(include_arcname=True, lazy=True)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        target = join(tmpdir, 'demo1.zip')
+        shutil.copy(path('demo2.zip'), target)
+        m.load_archive(path('demo1.zip'))
+        m.load_archive(target)
+        self.assertEqual(
+            m.traverse('demo1.zip').archive_paths, [path('demo1.zip'), target])
+        m.unload_archive(path('demo1.zip'))
+        self.assertEqual(m.traverse('demo1.zip').archive_paths, [target])
+        m.unload_archive(target)
+        self.assertEqual(m.mapping, {})
+        self.assertEqual(m.archives, {})
+        self.assertEqual(m.lazy_archives, {})
+
+    def test_lazy_merged(self):
+        m = DefaultMapper(include_arcname=True, lazy=True)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        target = join(tmpdir, 'demo1.zip')
+        shutil.copy(path('demo2.zip'), target)
+        m.load_archive(path('demo1.zip'))
+        # one sharing its directory is loaded along with it.
+        m.load_archive(target, m.prepare_archive(target))
+        self.assertEqual(m.lazy_archives, {})
+        self.assertEqual(len(m.readdir('demo1.zip')), 7)
+
+        # not lazy without the name of the archive.
+        m = DefaultMapper(lazy=True)
+        m.load_archive(path('demo1.zip'))
+        self.assertEqual(len(m.readdir('')), 6)
+
+    def test_lazy_bad_archive(self):
+        m = DefaultMapper(include_arcname=True, lazy=True)
+        self.assertTrue(m.load_archive(path('bad.zip')))
+        self.assertEqual(list(m.archives), [path('bad.zip')])
+        self.assertEqual(m.readdir('bad.zip'), [])
+        self.assertEqual(m.archives, {})
+        self.assertEqual(m.mapping, {})
+
+    def test_evict(self):
+        m = DefaultMapper(include_arcname=True, max_entries=10)
+        self.assertTrue(m.lazy)
+        m.load_archive(path('demo1.zip'))
+        m.load_archive(path('demo2.zip'))
+        self.assertEqual(len(m.readdir('demo1.zip')), 6)
+        af = m.archive_pool[path('demo1.zip')]
+        self.assertEqual(m.indexed_entries, 6)
+
+        # demo1.zip is evicted to make room for demo2.zip.
+        self.assertEqual(m.readdir('demo2.zip'), ['demo'])
+        self.assertEqual(list(m.indexed), ['demo2.zip'])
+        self.assertEqual(m.indexed_entries, 7)
+        self.assertTrue(isinstance(m.traverse('demo1.zip'), LazyArchive))
+        self.assertEqual(list(m.lazy_archives), [path('demo1.zip')])
+        self.assertEqual(
+            sorted(m.reverse_mapping),
+            sorted(m.archive_ifilenames[path('demo2.zip')]))
+        self.assertEqual(
+            sorted(m.archives), [path('demo1.zip'), path('demo2.zip')])
+
+        # indexed again from the archive that was left open.
+        self.assertEqual(m.traverse('demo1.zip/file1'), (
+            path('demo1.zip'), 'file1', 33))
+        self.assertIs(m.archive_pool[path('demo1.zip')], af)
+        self.assertEqual(list(m.indexed), ['demo1.zip'])
+        self.assertTrue(isinstance(m.traverse('demo2.zip'), LazyArchive))
+
+        m.unload_archive(path('demo1.zip'))
+        self.assertEqual(m.indexed_entries, 0)
+        self.assertEqual(m.indexed, {})
+
+    def test_evict_lru_pinned(self):
+        m = DefaultMapper(include_arcname=True, max_entries=14)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        for name in ('a.zip', 'b.zip', 'c.zip'):
+            shutil.copy(path('demo1.zip'), join(tmpdir, name))
+            m.load_archive(join(tmpdir, name))
+        m.traverse('a.zip/file1')
+        m.traverse('b.zip/file1')
+        # a.zip is now the most recently used.
+        m.traverse('a.zip/file2')
+        m.traverse('c.zip/file1')
+        self.assertEqual(list(m.indexed), ['a.zip', 'c.zip'])
+
+        # not while a file entry within is open.
+        m.pin('a.zip/file2')
+        m.traverse('b.zip/file1')
+        self.assertEqual(list(m.indexed), ['a.zip', 'b.zip'])
+        m.unpin('a.zip/file2')
+        self.assertEqual(dict(m.pinned), {})
+        m.traverse('c.zip/file1')
+        self.assertEqual(list(m.indexed), ['b.zip', 'c.zip'])
+
+    def test_evict_removed(self):
+        m = DefaultMapper(include_arcname=True, max_entries=6)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        target = join(tmpdir, 'a.zip')
+        shutil.copy(path('demo1.zip'), target)
+        m.load_archive(target)
+        m.load_archive(path('demo1.zip'))
+        m.traverse('a.zip/file1')
+        os.unlink(target)
+        m.traverse('demo1.zip/file1')
+        # dropped entirely, as it can no longer be indexed again.
+        self.assertEqual(list(m.archives), [path('demo1.zip')])
+        self.assertEqual(sorted(m.mapping), ['demo1.zip'])
+        self.assertNotIn(target, m.archive_pool)
+
+    def test_unload_archives(self):
+        m = DefaultMapper(include_arcname=True)
+        with ZipFile(path('demo2.zip')) as zf:
+            m._load_infolist('/tmp/demo1.zip', zf.infolist())
+            m._load_infolist('/tmp/demo2.zip', zf.infolist())
+            m._load_infolist('/tmp/demo3.zip', zf.infolist())
+        m.unload_archives(['/tmp/demo1.zip', '/tmp/demo3.zip', '/tmp/x.zip'])
+        self.assertEqual(list(m.archives), ['/tmp/demo2.zip'])
+        # same as unloading them one at a time.
+        self.assertEqual(list(m.mapping['demo2.zip']), ['demo'])
+        self.assertEqual(m.mapping['demo1.zip'], {})
+        self.assertEqual(m.mapping['demo3.zip'], {})
+        self.assertEqual(sorted(m.reverse_mapping), sorted(
+            m.archive_ifilenames['/tmp/demo2.zip']))
+
     def test_unload_infolist_multiple(self):
         demo = path('demo2.zip')
 
@@ -625,6 +824,33 @@ class DefaultMapperTestCase(unittest.TestCase):
         m.load_archive(object())
         self.assertEqual(m.mapping, {})
 
+    def test_mapping_bad_central_directory(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        data = BytesIO()
+        with ZipFile(data, 'w') as zf:
+            for i in range(3):
+                zf.writestr('f%d' % i, b'file')
+        raw = data.getvalue()
+        # the signature of the second record of the central directory.
+        i = raw.index(b'PK\x01\x02', raw.index(b'PK\x01\x02') + 4)
+        target = join(tmpdir, 'c.zip')
+        with open(target, 'wb') as fd:
+            fd.write(raw[:i] + b'XX' + raw[i + 2:])
+
+        m = DefaultMapper(include_arcname=True)
+        self.assertFalse(m.load_archive(target))
+        self.assertEqual(m.mapping, {})
+        self.assertEqual(m.archives, {})
+        self.assertEqual(m.archive_ifilenames, {})
+        self.assertEqual(dict(m.reverse_mapping), {})
+
+        outer = join(tmpdir, 'outer.zip')
+        with ZipFile(outer, 'w') as zf:
+            zf.write(target, 'c.zip')
+        m = DefaultMapper(outer, nested=True)
+        self.assertEqual(m.readdir('c.zip'), [])
+
     def test_mapping_simple(self):
         target = path('demo1.zip')
         m = DefaultMapper(target)
@@ -796,3 +1022,176 @@ class DefaultMapperTestCase(unittest.TestCase):
         m = DefaultMapper()
         m._load_infolist('/nowhere/no_such_file.zip', [zipinfo('demo.txt')])
         self.assertFalse(m.open('demo.txt'))
+
+    def test_mapping_pool(self):
+        demo3 = path('demo3.zip')
+        demo4 = path('demo4.zip')
+        m = DefaultMapper(pool_size=1)
+        m.load_archive(demo3)
+        af = m.archive_pool[demo3]
+        self.assertEqual(m.open('demo/dir1/file1')[1].read(1), b'b')
+        # the same instance is reused.
+        self.assertIs(m.archive_pool[demo3], af)
+
+        m.load_archive(demo4)
+        self.assertEqual(list(m.archive_pool.keys()), [demo4])
+        self.assertTrue(af.closed)
+
+        # reopened on demand.
+        self.assertEqual(m.open('demo/dir1/file1')[1].read(1), b'b')
+        self.assertEqual(list(m.archive_pool.keys()), [demo3])
+
+        m.unload_archive(demo3)
+        self.assertEqual(list(m.archive_pool.keys()), [])
+
+    def test_mapping_stamp(self):
+        target = path('demo1.zip')
+        m = DefaultMapper(target)
+        st = os.stat(target)
+        with ZipFile(target) as zf:
+            crc = zf.getinfo('file1').CRC
+        self.assertEqual(m.stamp('file1'), (st.st_mtime, st.st_size, crc))
+        self.assertIsNone(m.stamp(''))
+        self.assertIsNone(m.stamp('nowhere'))
+
+        m._load_infolist('/nowhere/no_such_file.zip', [zipinfo('demo.txt')])
+        self.assertIsNone(m.stamp('demo.txt'))
+
+    def test_mapping_block_cache(self):
+        cache = BlockCache(1 << 20)
+        target = path('demo3.zip')
+        m = DefaultMapper(target, block_cache=cache)
+        self.assertTrue(cache.used > 0)
+        misses = cache.misses
+        m.archive_pool.clear()
+        # the reopened archive is read from the shared cache.
+        self.assertEqual(
+            m.readfile('demo/dir1/file1'),
+            b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+        self.assertEqual(cache.misses, misses)
+
+    def test_reload_modified(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        target = join(tmpdir, 'demo.zip')
+        shutil.copy(path('demo1.zip'), target)
+        cache = BlockCache(1 << 20)
+        m = DefaultMapper(target, block_cache=cache)
+        key = m.archive_keys[target]
+        self.assertFalse(m.reload_modified(target))
+        self.assertTrue(m.open('file1'))
+
+        # rewritten in place.
+        with open(path('demo3.zip'), 'rb') as src:
+            with open(target, 'r+b') as fd:
+                fd.write(src.read())
+        self.assertNotEqual(m._archive_key(target), key)
+        self.assertEqual(m.readdir(''), [
+            'file1', 'file2', 'file3', 'file4', 'file5', 'file6'])
+        # the stale entry is no longer there once checked.
+        self.assertFalse(m.open('file1'))
+        self.assertEqual(m.readdir(''), ['demo'])
+        self.assertFalse(any(k[0] == key for k in cache.blocks))
+        self.assertEqual(m.archive_keys[target], m._archive_key(target))
+        self.assertTrue(m.open('demo/dir1/file1'))
+
+        os.unlink(target)
+        self.assertFalse(m.open('demo/dir1/file1'))
+        self.assertEqual(m.archives, {})
+        self.assertEqual(m.archive_keys, {})
+        # nothing further to unload.
+        m.unload_archive(target)
+
+    def test_prepare_archive(self):
+        m = DefaultMapper()
+        target = path('demo3.zip')
+        prepared = m.prepare_archive(target)
+        # nothing is modified until loaded.
+        self.assertEqual(m.mapping, {})
+        self.assertEqual(len(prepared[1]), 18)
+        self.assertTrue(m.load_archive(target, prepared))
+        self.assertEqual(
+            m.readfile('demo/dir1/file1'),
+            b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+        self.assertIsNone(m.prepare_archive(path('bad.zip')))
+        self.assertIsNone(m.prepare_archive(path('no_such_file.zip')))
+
+    def test_mapping_tar(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            target = join(tmpdir, 'demo.tar.gz')
+            with tarfile.open(target, 'w:gz') as tf:
+                info = tarfile.TarInfo('dir/file1')
+                info.size = 5
+                tf.addfile(info, BytesIO(b'file1'))
+            m = DefaultMapper(target, index_cache=IndexCache(
+                join(tmpdir, 'index')))
+            self.assertEqual(m.mapping, {
+                'dir': {'file1': (target, 'dir/file1', 5)}})
+            self.assertEqual(m.readfile('dir/file1'), b'file1')
+            st = os.stat(target)
+            self.assertEqual(
+                m.stamp('dir/file1'), (st.st_mtime, st.st_size, None))
+            self.assertEqual(len(os.listdir(join(tmpdir, 'index'))), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_mapping_nested(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            inner = BytesIO()
+            with ZipFile(inner, 'w', ZIP_DEFLATED) as zf:
+                zf.writestr('dir/file1', b'inner file1')
+                zf.writestr('file2', b'inner file2' * 100000)
+            tar = BytesIO()
+            with tarfile.open(fileobj=tar, mode='w:gz') as tf:
+                info = tarfile.TarInfo('tarfile')
+                info.size = 7
+                tf.addfile(info, BytesIO(b'tarfile'))
+            target = join(tmpdir, 'outer.zip')
+            with ZipFile(target, 'w', ZIP_DEFLATED) as zf:
+                zf.writestr('inner.zip', inner.getvalue())
+                zf.writestr('stored/inner.tar.gz', tar.getvalue())
+                zf.writestr('bad.zip', b'not a zip file')
+                zf.writestr('file3', b'outer file3')
+
+            m = DefaultMapper(target, nested=True)
+            self.assertEqual(
+                sorted(m.readdir('')),
+                ['bad.zip', 'file3', 'inner.zip', 'stored'])
+            # presented as a directory, without reading it.
+            nested = m.traverse('inner.zip')
+            self.assertTrue(isinstance(nested, NestedArchive))
+            self.assertFalse(nested.loaded)
+
+            self.assertEqual(sorted(m.readdir('inner.zip')), ['dir', 'file2'])
+            self.assertTrue(nested.loaded)
+            self.assertEqual(m.traverse('inner.zip/dir/file1'), (
+                target + NESTED_SEP + 'inner.zip', 'dir/file1', 11))
+            self.assertEqual(m.readfile('inner.zip/dir/file1'), b'inner file1')
+            self.assertEqual(
+                m.readfile('inner.zip/file2'), b'inner file2' * 100000)
+            # read with random access through the outer entry.
+            _, reader = m.open('inner.zip/file2')
+            reader.seek(990000)
+            self.assertEqual(reader.read(11), b'inner file2')
+            st = os.stat(target)
+            with ZipFile(inner) as zf:
+                crc = zf.getinfo('file2').CRC
+            self.assertEqual(
+                m.stamp('inner.zip/file2'), (st.st_mtime, st.st_size, crc))
+
+            # loaded on traversal into it, too.
+            self.assertEqual(
+                m.readfile('stored/inner.tar.gz/tarfile'), b'tarfile')
+            self.assertEqual(m.readdir('bad.zip'), [])
+            self.assertIsNone(m.traverse('bad.zip/file'))
+
+            m.unload_archive(target)
+            self.assertEqual(m.nested_archives, {})
+            self.assertEqual(list(m.archive_pool), [])
+            # disabled by default.
+            m = DefaultMapper(target)
+            self.assertEqual(m.traverse('inner.zip')[0], target)
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,612 @@
+import bz2
+import sys
+import unittest
+import tempfile
+import shutil
+import random
+import zlib
+from bisect import bisect_right
+from os.path import join
+try:
+    from gzip import compress as gzip_compress
+except ImportError:  # pragma: no cover
+    # python 2
+    from gzip import GzipFile
+    from io import BytesIO
+
+    def gzip_compress(data):
+        fd = BytesIO()
+        with GzipFile(fileobj=fd, mode='wb') as gz:
+            gz.write(data)
+        return fd.getvalue()
+from zipfile import ZipFile
+from zipfile import ZIP_BZIP2
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
+
+from explosive.fuse import reader as reader_module
+from explosive.fuse.archive import ArchiveFile
+from explosive.fuse.archive import LocalFile
+from explosive.fuse.exception import BadArchiveFile
+from explosive.fuse.reader import Bzip2BlockMap
+from explosive.fuse.reader import Bzip2Reader
+from explosive.fuse.reader import GzipReader
+from explosive.fuse.reader import InflateCheckpoints
+from explosive.fuse.reader import InflateReader
+from explosive.fuse.reader import StoredReader
+from explosive.fuse.reader import XzBlockMap
+from explosive.fuse.reader import XzReader
+from explosive.fuse.reader import XzStreamReader
+from explosive.fuse.reader import bz2_block_decompress
+from explosive.fuse.reader import bz2_scan
+from explosive.fuse.reader import inflate_backends
+from explosive.fuse.reader import set_inflate_backend
+from explosive.fuse.reader import lzma
+from explosive.fuse.reader import xz_block_decompress
+from explosive.fuse.reader import xz_index
+from explosive.fuse.reader import xz_reader
+from explosive.fuse.reader import zip_data_offset
+
+
+def make_data(size, seed=0):
+    # compressible, but not trivially so.
+    rng = random.Random(seed)
+    words = [b'alpha', b'beta', b'gamma', b'delta', b'\n', b' ']
+    chunks = []
+    total = 0
+    while total < size:
+        word = rng.choice(words)
+        chunks.append(word)
+        total += len(word)
+    return b''.join(chunks)[:size]
+
+
+class ZipReaderTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.target = join(cls.tmpdir, 'test.zip')
+        cls.data = make_data(3 << 20)
+        with ZipFile(cls.target, 'w') as zf:
+            zf.writestr('deflated', cls.data, compress_type=ZIP_DEFLATED)
+            zf.writestr('stored', cls.data[:4096], compress_type=ZIP_STORED)
+            zf.writestr('empty', b'', compress_type=ZIP_DEFLATED)
+            zf.writestr(
+                'zeros', b'\0' * (8 << 20), compress_type=ZIP_DEFLATED)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def reader(self, cls, name, verify=True, index=None):
+        lf = LocalFile(self.target)
+        with ZipFile(self.target) as zf:
+            info = zf.getinfo(name)
+        return cls(lf, zip_data_offset(lf, info.header_offset),
+                   info.compress_size, info.file_size,
+                   info.CRC if verify else None, index=index)
+
+    def test_data_offset_bad(self):
+        lf = LocalFile(self.target)
+        with self.assertRaises(BadArchiveFile):
+            zip_data_offset(lf, 1)
+        with self.assertRaises(BadArchiveFile):
+            zip_data_offset(lf, lf.size - 4)
+
+    def test_inflate_read_all(self):
+        reader = self.reader(InflateReader, 'deflated')
+        self.assertEqual(reader.read(), self.data)
+        self.assertEqual(reader.read(), b'')
+        self.assertEqual(reader.tell(), len(self.data))
+
+    def test_inflate_read_chunks(self):
+        reader = self.reader(InflateReader, 'deflated')
+        # small compressed chunks to exercise refills.
+        reader.chunk_size = 4096
+        results = []
+        while True:
+            chunk = reader.read(65536)
+            if not chunk:
+                break
+            # never produce more than requested.
+            self.assertTrue(len(chunk) <= 65536)
+            results.append(chunk)
+        self.assertEqual(b''.join(results), self.data)
+
+    def test_inflate_read_compressible(self):
+        # highly compressible, such that all the input is consumed well
+        # before the output is produced.
+        reader = self.reader(InflateReader, 'zeros')
+        buf = bytearray(4096)
+        total = 0
+        while True:
+            chunk = reader.read(4096)
+            if not chunk:
+                break
+            self.assertTrue(len(chunk) <= 4096)
+            total += len(chunk)
+        self.assertEqual(total, 8 << 20)
+
+        reader = self.reader(InflateReader, 'zeros')
+        total = 0
+        while True:
+            written = reader.readinto(buf)
+            if not written:
+                break
+            total += written
+        self.assertEqual(total, 8 << 20)
+
+    def test_inflate_readinto(self):
+        reader = self.reader(InflateReader, 'deflated')
+        buf = bytearray(100000)
+        self.assertEqual(reader.readinto(buf), 100000)
+        self.assertEqual(bytes(buf), self.data[:100000])
+        self.assertEqual(reader.readinto(buf), 100000)
+        self.assertEqual(bytes(buf), self.data[100000:200000])
+
+    def test_inflate_seek(self):
+        reader = self.reader(InflateReader, 'deflated')
+        self.assertEqual(reader.seek(1000000), 1000000)
+        self.assertEqual(reader.read(10), self.data[1000000:1000010])
+        self.assertEqual(reader.seek(10), 10)
+        self.assertEqual(reader.read(10), self.data[10:20])
+        self.assertEqual(reader.seek(-10, 2), len(self.data) - 10)
+        self.assertEqual(reader.read(), self.data[-10:])
+        self.assertEqual(reader.seek(-20, 1), len(self.data) - 20)
+        self.assertEqual(reader.read(), self.data[-20:])
+
+    def test_inflate_checkpoints(self):
+        index = InflateCheckpoints(interval=1 << 16)
+        reader = self.reader(InflateReader, 'deflated', index=index)
+        self.assertEqual(reader.seek(2000000), 2000000)
+        self.assertTrue(len(index.points) > 4)
+        self.assertEqual(reader.read(10), self.data[2000000:2000010])
+        target = index.points[3][0] + 10
+        self.assertEqual(reader.seek(target), target)
+        # resumed from the checkpoint, which cannot be verified.
+        self.assertTrue(reader.src_pos > reader.start)
+        self.assertIsNone(reader.crc)
+        self.assertEqual(reader.read(10), self.data[target:target + 10])
+        self.assertEqual(reader.seek(-10, 2), len(self.data) - 10)
+        self.assertEqual(reader.read(), self.data[-10:])
+
+    def test_inflate_bad_crc(self):
+        reader = self.reader(InflateReader, 'deflated')
+        reader.crc ^= 1
+        with self.assertRaises(BadArchiveFile):
+            reader.read()
+
+        # not verified.
+        reader = self.reader(InflateReader, 'deflated', verify=False)
+        self.assertEqual(reader.read(), self.data)
+
+    def test_inflate_truncated(self):
+        reader = self.reader(InflateReader, 'deflated')
+        reader.end = reader.source.size + 10
+        # push all the way past to the end of the mapped file.
+        reader.src_pos = reader.source.size
+        with self.assertRaises(BadArchiveFile):
+            reader.read(10)
+
+    def test_inflate_empty(self):
+        reader = self.reader(InflateReader, 'empty')
+        self.assertEqual(reader.read(), b'')
+
+    def test_stored(self):
+        reader = self.reader(StoredReader, 'stored')
+        self.assertEqual(reader.read(10), self.data[:10])
+        self.assertEqual(reader.seek(4000), 4000)
+        self.assertEqual(reader.read(), self.data[4000:4096])
+        self.assertEqual(reader.seek(0), 0)
+        self.assertEqual(reader.read(), self.data[:4096])
+        with reader:
+            pass
+        self.assertTrue(reader.closed)
+
+    def test_stored_bad_crc(self):
+        reader = self.reader(StoredReader, 'stored')
+        reader.crc ^= 1
+        with self.assertRaises(BadArchiveFile):
+            reader.read()
+
+    def test_archive_file_open(self):
+        with ArchiveFile(self.target) as af:
+            deflated = af.open('deflated')
+            stored = af.open('stored')
+        self.assertTrue(isinstance(deflated, InflateReader))
+        self.assertTrue(isinstance(stored, StoredReader))
+        self.assertEqual(deflated.read(), self.data)
+        self.assertEqual(stored.read(), self.data[:4096])
+
+        with ArchiveFile(self.target) as af:
+            self.assertIsNone(af.open('deflated', verify=False).crc)
+
+
+class BytesSource(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+
+    def pread(self, size, offset):
+        return self.data[offset:offset + size]
+
+
+class Bzip2TestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.target = join(cls.tmpdir, 'test.zip')
+        cls.data = make_data(1 << 20, seed=1)
+        # smallest block size to produce many blocks.
+        cls.compressed = bz2.compress(cls.data, 1)
+        with ZipFile(cls.target, 'w') as zf:
+            zf.writestr('bzip2', cls.data, compress_type=ZIP_BZIP2,
+                        compresslevel=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_scan(self):
+        source = BytesSource(self.compressed)
+        bounds = bz2_scan(source, 0, source.size)
+        self.assertTrue(len(bounds) > 3)
+        # first block follows the header.
+        self.assertEqual(bounds[0][0], 32)
+        # blocks are contiguous.
+        for (_, end), (start, _) in zip(bounds, bounds[1:]):
+            self.assertEqual(end, start)
+        # small windows should produce the same results.
+        self.assertEqual(bz2_scan(source, 0, source.size, window=4096), bounds)
+
+        # offset into a larger source.
+        source = BytesSource(b'padding' + self.compressed + b'padding')
+        self.assertEqual(bz2_scan(source, 7, source.size - 7), bounds)
+
+    def test_block_decompress(self):
+        source = BytesSource(self.compressed)
+        bounds = bz2_scan(source, 0, source.size)
+        result = b''.join(
+            bz2_block_decompress(source, 0, b) for b in bounds)
+        self.assertEqual(result, self.data)
+
+    def test_multiple_streams(self):
+        source = BytesSource(self.compressed + self.compressed)
+        bounds = bz2_scan(source, 0, source.size)
+        reader = Bzip2Reader(
+            source, 0, source.size, len(self.data) * 2,
+            index=Bzip2BlockMap(bounds))
+        self.assertEqual(reader.read(), self.data + self.data)
+
+    def test_block_map(self):
+        block_map = Bzip2BlockMap([(0, 10), (10, 20), (20, 30)])
+        self.assertIsNone(block_map.locate(0))
+        block_map.set_size(1, 100)
+        self.assertIsNone(block_map.locate(0))
+        block_map.set_size(0, 100)
+        self.assertEqual(block_map.offsets, [0, 100, 200])
+        self.assertEqual(block_map.locate(0), 0)
+        self.assertEqual(block_map.locate(150), 1)
+        self.assertIsNone(block_map.locate(200))
+        block_map.merge(1)
+        self.assertEqual(block_map.bounds, [(0, 10), (10, 30)])
+        self.assertEqual(block_map.offsets, [0, 100])
+
+    def reader(self):
+        lf = LocalFile(self.target)
+        with ZipFile(self.target) as zf:
+            info = zf.getinfo('bzip2')
+        return Bzip2Reader(lf, zip_data_offset(lf, info.header_offset),
+                           info.compress_size, info.file_size, info.CRC)
+
+    def test_read_sequential(self):
+        reader = self.reader()
+        results = []
+        while True:
+            chunk = reader.read(65536)
+            if not chunk:
+                break
+            results.append(chunk)
+        self.assertEqual(b''.join(results), self.data)
+        self.assertEqual(reader.index.known, len(reader.index.bounds))
+
+    def test_read_bad_crc(self):
+        reader = self.reader()
+        reader.crc ^= 1
+        with self.assertRaises(BadArchiveFile):
+            reader.read()
+
+    def test_read_random(self):
+        reader = self.reader()
+        self.assertEqual(reader.seek(900000), 900000)
+        self.assertEqual(reader.read(100), self.data[900000:900100])
+        self.assertIsNone(reader.crc)
+        self.assertEqual(reader.seek(10), 10)
+        self.assertEqual(reader.read(100), self.data[10:110])
+        # reading across blocks.
+        boundary = reader.index.offsets[2]
+        reader.seek(boundary - 50)
+        self.assertEqual(reader.read(100), self.data[boundary - 50:][:100])
+        reader.close()
+        self.assertTrue(reader.closed)
+
+    def test_false_boundary(self):
+        reader = self.reader()
+        original = list(reader.index.bounds)
+        bounds = list(original)
+        # split the second block in the middle.
+        start, end = bounds[1]
+        bounds[1:2] = [(start, (start + end) // 2), ((start + end) // 2, end)]
+        reader = Bzip2Reader(
+            reader.source, reader.start, reader.end - reader.start,
+            reader.file_size, reader.crc, index=Bzip2BlockMap(bounds))
+        self.assertEqual(reader.read(), self.data)
+        self.assertEqual(reader.index.bounds, original)
+
+    def test_false_last_block(self):
+        source = BytesSource(self.compressed)
+        bounds = bz2_scan(source, 0, source.size)
+        start, end = bounds[-1]
+        bounds[-1] = (start, end - 8)
+        reader = Bzip2Reader(
+            source, 0, source.size, len(self.data),
+            index=Bzip2BlockMap(bounds))
+        with self.assertRaises(BadArchiveFile):
+            reader.read()
+
+    def test_archive_file_index(self):
+        with ArchiveFile(self.target) as af:
+            reader = af.open('bzip2')
+            self.assertTrue(isinstance(reader, Bzip2Reader))
+            reader.seek(500000)
+            reader.read(10)
+            # the block map is kept and reused.
+            self.assertIs(af.entry_index['bzip2'], reader.index)
+            self.assertIs(af.open('bzip2').index, reader.index)
+
+
+class GzipReaderTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data = make_data(1 << 20, seed=2)
+        cls.compressed = gzip_compress(cls.data)
+
+    def reader(self, compressed, index=None):
+        source = BytesSource(compressed)
+        return GzipReader(source, 0, source.size, sys.maxsize, index=index)
+
+    def test_read_all(self):
+        reader = self.reader(self.compressed)
+        self.assertEqual(reader.read(), self.data)
+        self.assertEqual(reader.file_size, len(self.data))
+        self.assertEqual(reader.index.size, len(self.data))
+
+    def test_checkpoints(self):
+        index = InflateCheckpoints(interval=1 << 16)
+        reader = self.reader(self.compressed, index=index)
+        reader.feed_size = 4096
+        self.assertEqual(reader.seek(900000), 900000)
+        self.assertEqual(reader.read(10), self.data[900000:900010])
+        self.assertTrue(len(index.points) > 4)
+        positions = [pos for pos, _, _ in index.points]
+        self.assertEqual(positions, sorted(positions))
+        self.assertIsNone(index.find(positions[0] - 1))
+        self.assertEqual(index.find(positions[1])[0], positions[1])
+
+        # resuming from a checkpoint that was not the start.
+        target = positions[2] + 10
+        self.assertEqual(reader.seek(target), target)
+        self.assertTrue(reader.src_pos > 0)
+        self.assertEqual(reader.read(10), self.data[target:target + 10])
+
+        # a new reader sharing the index.
+        reader = self.reader(self.compressed, index=index)
+        self.assertEqual(reader.pread(10, 500000), self.data[500000:500010])
+        self.assertEqual(reader.seek(-10, 2), len(self.data) - 10)
+        self.assertEqual(reader.read(), self.data[-10:])
+
+    def test_read_compressible(self):
+        reader = self.reader(gzip_compress(b'\0' * (8 << 20)))
+        total = 0
+        while True:
+            chunk = reader.read(4096)
+            if not chunk:
+                break
+            self.assertTrue(len(chunk) <= 4096)
+            total += len(chunk)
+        self.assertEqual(total, 8 << 20)
+
+    def test_multiple_members(self):
+        compressed = self.compressed + gzip_compress(b'tail') + b'\0' * 8
+        reader = self.reader(compressed)
+        self.assertEqual(reader.read(), self.data + b'tail')
+
+    def test_truncated(self):
+        reader = self.reader(self.compressed[:-100])
+        with self.assertRaises(BadArchiveFile):
+            reader.read()
+
+    def test_bad_crc(self):
+        compressed = bytearray(self.compressed)
+        compressed[-5] ^= 1
+        reader = self.reader(bytes(compressed))
+        with self.assertRaises(BadArchiveFile):
+            reader.read()
+
+
+class InflateBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = reader_module.inflate_backend
+
+    def tearDown(self):
+        set_inflate_backend(self.backend)
+
+    def test_select(self):
+        with self.assertRaises(ValueError):
+            set_inflate_backend('nothing')
+        self.assertEqual(set_inflate_backend('zlib'), 'zlib')
+        self.assertIs(reader_module.inflate, zlib)
+        self.assertTrue(reader_module.inflate_copyable)
+        self.assertEqual(set_inflate_backend('auto'), set_inflate_backend())
+        self.assertIn(
+            reader_module.inflate_backend,
+            [name for name, _ in inflate_backends])
+
+    def test_backends(self):
+        data = make_data(1 << 20, seed=3)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(data) + compressor.flush()
+        compressed = gzip_compress(data)
+        for name, _ in inflate_backends:
+            try:
+                set_inflate_backend(name)
+            except ValueError:
+                continue
+            inflate = reader_module.inflate
+            source = BytesSource(deflated)
+            reader = InflateReader(
+                source, 0, source.size, len(data),
+                zlib.crc32(data) & 0xffffffff)
+            self.assertIsInstance(
+                reader.decompressor, type(inflate.decompressobj()))
+            self.assertEqual(reader.read(), data)
+
+            # checkpoints require decompressors that can be copied,
+            # otherwise zlib is used instead.
+            source = BytesSource(compressed)
+            reader = GzipReader(source, 0, source.size, sys.maxsize)
+            expected = inflate if reader_module.inflate_copyable else zlib
+            self.assertIsInstance(
+                reader.decompressor, type(expected.decompressobj()))
+            self.assertEqual(reader.seek(900000), 900000)
+            self.assertEqual(reader.read(10), data[900000:900010])
+            self.assertEqual(reader.seek(10), 10)
+            self.assertEqual(reader.read(10), data[10:20])
+
+            reader = GzipReader(
+                BytesSource(compressed[:-5] + b'\xff' + compressed[-4:]),
+                0, source.size, sys.maxsize)
+            with self.assertRaises(BadArchiveFile):
+                reader.read()
+
+
+@unittest.skipIf(lzma is None, 'lzma not available')
+class XzTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data = make_data(1 << 20, seed=3)
+        # concatenated streams produce multiple blocks, with the various
+        # types of checks and stream padding in between.
+        cls.chunks = [cls.data[i:i + 100000]
+                      for i in range(0, len(cls.data), 100000)]
+        checks = [lzma.CHECK_CRC64, lzma.CHECK_CRC32, lzma.CHECK_SHA256,
+                  lzma.CHECK_NONE]
+        cls.compressed = b''.join(
+            lzma.compress(chunk, check=checks[i % 4], preset=1) +
+            b'\0' * 4 * (i % 2)
+            for i, chunk in enumerate(cls.chunks))
+        cls.single = lzma.compress(cls.data, preset=1)
+
+    def test_index(self):
+        source = BytesSource(self.compressed)
+        blocks = xz_index(source, 0, source.size)
+        self.assertEqual(len(blocks), len(self.chunks))
+        self.assertEqual(
+            [block.uncompressed_size for block in blocks],
+            [len(chunk) for chunk in self.chunks])
+        self.assertEqual(blocks[1].uncompressed_offset, 100000)
+        for block, chunk in zip(blocks, self.chunks):
+            self.assertEqual(xz_block_decompress(source, block), chunk)
+
+        # offset into a larger source.
+        source = BytesSource(b'padding' + self.compressed + b'padding')
+        self.assertEqual(
+            [block.offset - 7 for block in xz_index(
+                source, 7, source.size - 7)],
+            [block.offset for block in blocks])
+
+    def test_index_bad(self):
+        for data in (self.single[:-1], self.single[1:],
+                     b'\0' * 12 + self.single[12:], b'not xz' * 10):
+            source = BytesSource(data)
+            with self.assertRaises(BadArchiveFile):
+                xz_index(source, 0, source.size)
+
+    def test_block_bad(self):
+        data = bytearray(self.single)
+        data[100] ^= 1
+        source = BytesSource(bytes(data))
+        blocks = xz_index(source, 0, source.size)
+        with self.assertRaises(BadArchiveFile):
+            xz_block_decompress(source, blocks[0])
+
+    def test_reader(self):
+        source = BytesSource(self.compressed)
+        reader = xz_reader(source, 0, source.size, len(self.data))
+        self.assertTrue(isinstance(reader, XzReader))
+        self.assertEqual(reader.index.size, len(self.data))
+        results = []
+        while True:
+            chunk = reader.read(65536)
+            if not chunk:
+                break
+            results.append(chunk)
+        self.assertEqual(b''.join(results), self.data)
+
+        self.assertEqual(reader.seek(650000), 650000)
+        self.assertEqual(reader.read(10), self.data[650000:650010])
+        # reading across multiple blocks.
+        self.assertEqual(reader.pread(250000, 10), self.data[10:250010])
+        self.assertEqual(reader.seek(-10, 2), len(self.data) - 10)
+        self.assertEqual(reader.read(), self.data[-10:])
+        reader.close()
+        self.assertTrue(reader.closed)
+
+    def test_stream_reader(self):
+        source = BytesSource(self.single)
+        reader = xz_reader(source, 0, source.size, len(self.data))
+        self.assertTrue(isinstance(reader, XzStreamReader))
+        self.assertEqual(reader.read(), self.data)
+        self.assertEqual(reader.seek(10), 10)
+        self.assertEqual(reader.read(10), self.data[10:20])
+
+        # multiple streams with padding.
+        source = BytesSource(self.compressed)
+        reader = XzStreamReader(source, 0, source.size, len(self.data))
+        reader.chunk_size = 4096
+        self.assertEqual(reader.read(), self.data)
+
+    def test_stream_reader_seek(self):
+        source = BytesSource(self.compressed)
+        blocks = xz_index(source, 0, source.size)
+        reads = []
+        pread = source.pread
+        source.pread = lambda size, offset: (
+            reads.append(offset) or pread(size, offset))
+        reader = XzStreamReader(
+            source, 0, source.size, len(self.data), index=XzBlockMap(blocks))
+        reader.chunk_size = 4096
+        self.assertEqual(reader.pread(10, 650000), self.data[650000:650010])
+        self.assertEqual(reader.pread(10, 640000), self.data[640000:640010])
+        self.assertEqual(reader.pread(10, 950000), self.data[950000:950010])
+        self.assertEqual(reader.pread(10, 50000), self.data[50000:50010])
+        # only from the start of the blocks with the positions.
+        self.assertEqual(
+            sorted(set(bisect_right([b.offset for b in blocks], offset) - 1
+                       for offset in reads)), [0, 6, 9])
+        self.assertEqual(reader.seek(0), 0)
+        self.assertEqual(reader.read(), self.data)
+        self.assertEqual(reader.seek(0, 2), len(self.data))
+        self.assertEqual(reader.read(), b'')
+
+    def test_stream_reader_truncated(self):
+        source = BytesSource(self.single[:-100])
+        reader = XzStreamReader(source, 0, source.size, len(self.data))
+        with self.assertRaises(BadArchiveFile):
+            reader.read()
@@ -0,0 +1,212 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from hashlib import sha1
+from os.path import dirname
+from os.path import join
+
+from explosive.fuse.fs import ExplosiveFUSE
+from explosive.fuse.fs import ManagedExplosiveFUSE
+from explosive.fuse.mapper import DefaultMapper
+from explosive.fuse.watch import DirectoryWatcher
+from explosive.fuse.watch import Inotify
+from explosive.fuse.watch import IN_CLOSE_WRITE
+from explosive.fuse.watch import IN_DELETE
+
+path = lambda p: join(dirname(__file__), 'data', p)
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+class InotifyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_events(self):
+        inotify = Inotify()
+        self.addCleanup(inotify.close)
+        wd = inotify.add_watch(self.tmpdir, IN_CLOSE_WRITE | IN_DELETE)
+        self.assertEqual(inotify.read(0), [])
+        with open(join(self.tmpdir, 'demo.zip'), 'wb'):
+            pass
+        os.unlink(join(self.tmpdir, 'demo.zip'))
+        self.assertEqual(inotify.read(1), [
+            (wd, IN_CLOSE_WRITE, 0, 'demo.zip'),
+            (wd, IN_DELETE, 0, 'demo.zip'),
+        ])
+        with self.assertRaises(OSError):
+            inotify.add_watch(join(self.tmpdir, 'missing'), IN_DELETE)
+
+
+class DirectoryWatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.mapper = DefaultMapper(include_arcname=True)
+        self.changes = []
+        # the number of changes for every call to apply.
+        self.applied = []
+
+    def apply(self, changes):
+        self.applied.append(len(changes))
+        for archive_path, prepared in changes:
+            self.changes.append((archive_path, prepared is not None))
+            if archive_path in self.mapper.archives:
+                self.mapper.unload_archive(archive_path)
+            if prepared is not None:
+                self.mapper.load_archive(archive_path, prepared)
+
+    def watch(self, **kw):
+        kw.setdefault('debounce', 0.05)
+        watcher = DirectoryWatcher(
+            self.tmpdir, self.mapper.prepare_archive, self.apply, **kw)
+        self.addCleanup(watcher.thread.join)
+        self.addCleanup(watcher.stop)
+        watcher.start()
+        return watcher
+
+    def test_initial_scan(self):
+        shutil.copy(path('demo1.zip'), join(self.tmpdir, 'demo1.zip'))
+        shutil.copy(path('bad.zip'), join(self.tmpdir, 'bad.zip'))
+        with open(join(self.tmpdir, 'notes.txt'), 'w') as fd:
+            fd.write('not an archive')
+        watcher = self.watch()
+        wait_for(lambda: watcher.batches == 1)
+        self.assertEqual(
+            list(self.mapper.archives), [join(self.tmpdir, 'demo1.zip')])
+        # bad archives are not applied.
+        self.assertEqual(
+            self.changes, [(join(self.tmpdir, 'demo1.zip'), True)])
+
+    def test_changes(self):
+        watcher = self.watch()
+        wait_for(lambda: watcher.batches == 1)
+        target = join(self.tmpdir, 'demo.zip')
+        shutil.copy(path('demo1.zip'), target)
+        wait_for(lambda: watcher.batches == 2)
+        self.assertEqual(
+            sorted(self.mapper.readdir('demo.zip')),
+            ['file1', 'file2', 'file3', 'file4', 'file5', 'file6'])
+
+        # replaced by renaming another archive over it.
+        shutil.copy(path('demo2.zip'), join(self.tmpdir, 'demo.zip.part'))
+        os.rename(join(self.tmpdir, 'demo.zip.part'), target)
+        wait_for(lambda: watcher.batches == 3)
+        self.assertEqual(self.mapper.readdir('demo.zip'), ['demo'])
+
+        os.unlink(target)
+        wait_for(lambda: watcher.batches == 4)
+        self.assertEqual(self.mapper.archives, {})
+        self.assertEqual(self.changes, [
+            (target, True), (target, True), (target, False)])
+
+    def test_batching(self):
+        watcher = self.watch(debounce=0.5, max_delay=10)
+        wait_for(lambda: watcher.batches == 1)
+        target = join(self.tmpdir, 'demo.zip')
+        for i in range(5):
+            shutil.copy(path('demo%d.zip' % (i % 2 + 1)), target)
+            shutil.copy(path('demo3.zip'), join(self.tmpdir, '%d.zip' % i))
+        os.unlink(join(self.tmpdir, '4.zip'))
+        wait_for(lambda: watcher.batches == 2)
+        # only the last event for every archive was applied.
+        self.assertEqual(sorted(self.changes), sorted(
+            [(target, True)] +
+            [(join(self.tmpdir, '%d.zip' % i), True) for i in range(4)]))
+        # the last copy was of demo1.zip
+        self.assertEqual(len(self.mapper.readdir('demo.zip')), 6)
+
+    def test_batch_size(self):
+        for i in range(5):
+            shutil.copy(path('demo1.zip'), join(self.tmpdir, '%d.zip' % i))
+        watcher = self.watch(batch_size=2)
+        wait_for(lambda: watcher.batches == 1)
+        # the archives of the batch were prepared before being applied.
+        self.assertEqual(self.applied, [2, 2, 1])
+        self.assertEqual(len(self.mapper.archives), 5)
+
+    def test_max_delay(self):
+        watcher = self.watch(debounce=1, max_delay=0.2)
+        wait_for(lambda: watcher.batches == 1)
+        target = join(self.tmpdir, 'demo.zip')
+        start = time.time()
+        shutil.copy(path('demo1.zip'), target)
+        while watcher.batches == 1 and time.time() - start < 2:
+            # events keep arriving more often than debounce.
+            os.utime(target, None)
+            with open(target, 'ab'):
+                pass
+            time.sleep(0.05)
+        self.assertEqual(watcher.batches, 2)
+        self.assertIn(target, self.mapper.archives)
+
+    def test_directory_removed(self):
+        watcher = self.watch()
+        wait_for(lambda: watcher.batches == 1)
+        os.rmdir(self.tmpdir)
+        watcher.thread.join(5)
+        self.assertFalse(watcher.thread.is_alive())
+        self.assertIsNone(watcher.inotify.fd)
+        os.mkdir(self.tmpdir)
+
+
+class WatchedExplosiveFsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def start(self, fs):
+        fs('init', '/')
+        self.addCleanup(fs, 'destroy', '/')
+        watcher = fs.watchers[0]
+        watcher.debounce = 0.05
+        return watcher
+
+    def test_watch(self):
+        shutil.copy(path('demo1.zip'), join(self.tmpdir, 'demo1.zip'))
+        fs = ExplosiveFUSE(
+            [path('demo2.zip')], include_arcname=True,
+            watch_dirs=[self.tmpdir])
+        # not until the filesystem is initialized.
+        self.assertEqual(len(fs.mapping.archives), 1)
+        watcher = self.start(fs)
+        wait_for(lambda: watcher.batches == 1)
+        self.assertEqual(
+            sorted(fs('readdir', '/', None)),
+            ['.', '..', 'demo1.zip', 'demo2.zip'])
+        os.unlink(join(self.tmpdir, 'demo1.zip'))
+        wait_for(lambda: watcher.batches == 2)
+        self.assertEqual(
+            sorted(fs('readdir', '/', None)), ['.', '..', 'demo2.zip'])
+
+    def test_watch_managed(self):
+        fs = ManagedExplosiveFUSE(
+            '/mnt', '.manager', [path('demo1.zip')], include_arcname=True,
+            watch_dirs=[self.tmpdir])
+        watcher = self.start(fs)
+        wait_for(lambda: watcher.batches == 1)
+        target = join(self.tmpdir, 'demo1.zip')
+        shutil.copy(path('demo1.zip'), target)
+        wait_for(lambda: watcher.batches == 2)
+        self.assertEqual(fs.symlinkfs.symlinks, {
+            'demo1.zip': path('demo1.zip'),
+            'demo1.zip_' + sha1(target.encode('utf-8')).hexdigest()[:8]:
+                target,
+        })
+        os.unlink(target)
+        wait_for(lambda: watcher.batches == 3)
+        self.assertEqual(fs.symlinkfs.symlinks, {
+            'demo1.zip': path('demo1.zip'),
+        })